@@ -44,26 +44,144 @@ def createCacheRemoveCallback(w, k, f):
 
 PROFILING = False
 
+class _StrongLRU:
+    """
+    A bounded collection of strong references to the most recently used
+    values of a L{FinalizingCache}, which keeps those values from being
+    finalized just because nothing else refers to them at the moment.
+
+    @ivar capacity: the largest number of values I will hold.
+
+    @ivar _entries: a C{dict} mapping keys to the nodes of a circular doubly
+    linked list, in order of use.  Each node is a list of the previous node,
+    the next node, the key and the value.  The least recently used node
+    follows C{_root}, the most recently used one precedes it.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def touch(self, key, value):
+        """
+        Note that C{value} has just been used, evicting the least recently
+        used value if that puts me over capacity.
+        """
+        entries = self._entries
+        root = self._root
+        node = entries.get(key)
+        if node is not None:
+            if node[3] is value:
+                prev, next = node[0], node[1]
+                prev[1] = next
+                next[0] = prev
+                last = root[0]
+                node[0] = last
+                node[1] = root
+                last[1] = root[0] = node
+                return
+            self.discard(key)
+        last = root[0]
+        node = [last, root, key, value]
+        last[1] = root[0] = entries[key] = node
+        self.evictOverflow()
+
+
+    def evictOverflow(self):
+        """
+        Drop least recently used values until I am within capacity.
+        """
+        while len(self._entries) > self.capacity:
+            key = self._root[1][2]
+            self.discard(key)
+            log.msg(interface=iaxiom.IStatEvent, stat_cache_evictions=1,
+                    key=key)
+
+
+    def discard(self, key):
+        """
+        Drop the value for C{key}, if I have one.
+        """
+        node = self._entries.pop(key, None)
+        if node is not None:
+            prev, next = node[0], node[1]
+            prev[1] = next
+            next[0] = prev
+            del node[:]
+
+
+    def clear(self):
+        """
+        Drop all of my values.
+        """
+        self._entries.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+
+
 class FinalizingCache:
     """Possibly useful for infrastructure?  This would be a nice addition (or
     perhaps even replacement) for twisted.python.finalize.
+
+    @ivar strong: C{None}, or a L{_StrongLRU} holding the most recently used
+    values, if this cache has been given a strong capacity.
     """
-    def __init__(self):
+    def __init__(self, strongCapacity=0):
         self.data = {}
+        self.strong = None
+        self.setStrongCapacity(strongCapacity)
         if not PROFILING:
             # see docstring for 'has'
             self.has = self.data.has_key
 
+    def setStrongCapacity(self, capacity):
+        """
+        Change the number of recently used values this cache keeps strong
+        references to, so that they stay cached even when nothing else refers
+        to them.
+
+        @param capacity: a non-negative C{int}.  0 disables strong
+        references altogether.
+        """
+        if capacity < 0:
+            raise ValueError("capacity must not be negative: %r" % (capacity,))
+        if not capacity:
+            self.strong = None
+        elif self.strong is None:
+            self.strong = _StrongLRU(capacity)
+        else:
+            self.strong.capacity = capacity
+            self.strong.evictOverflow()
+
+    def clearStrong(self):
+        """
+        Drop all strong references held by this cache.  Values which are not
+        referred to by anything else will be finalized and removed.
+        """
+        if self.strong is not None:
+            self.strong.clear()
+
     def cache(self, key, value):
         fin = value.__finalizer__()
         assert key not in self.data, "Duplicate cache key: %r %r %r" % (key, value, self.data[key])
         self.data[key] = ref(value, createCacheRemoveCallback(
                 ref(self), key, fin))
+        if self.strong is not None:
+            self.strong.touch(key, value)
         return value
 
     def uncache(self, key, value):
         assert self.get(key) is value
         del self.data[key]
+        if self.strong is not None:
+            self.strong.discard(key)
 
     def has(self, key):
         """Does the cache have this key?
@@ -86,5 +204,6 @@ class FinalizingCache:
             raise CacheFault(
                 "FinalizingCache has %r but its value is no more." % (key,))
         log.msg(interface=iaxiom.IStatEvent, stat_cache_hits=1, key=key)
+        if self.strong is not None:
+            self.strong.touch(key, o)
         return o
-
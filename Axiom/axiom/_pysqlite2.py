@@ -85,6 +85,19 @@ class Cursor(object):
 
 
     def execute(self, sql, args=()):
+        return self._execute(self._cursor.execute, sql, args)
+
+
+    def executemany(self, sql, argsList):
+        """
+        Execute C{sql} once for each sequence of arguments in C{argsList}.
+
+        @type argsList: C{list}
+        """
+        return self._execute(self._cursor.executemany, sql, argsList)
+
+
+    def _execute(self, method, sql, args):
         try:
             try:
                 blockedTime = 0.0
@@ -113,7 +126,7 @@ class Cursor(object):
                     # information between multiple processes.
                     while 1:
                         try:
-                            return self._cursor.execute(sql, args)
+                            return method(sql, args)
                         except dbapi2.OperationalError, e:
                             if e.args[0] == 'database is locked':
                                 now = self.time()
@@ -135,7 +148,7 @@ class Cursor(object):
                             stat_cursor_blocked_time=blockedTime)
             except dbapi2.OperationalError, e:
                 if e.args[0] == 'database schema has changed':
-                    return self._cursor.execute(sql, args)
+                    return method(sql, args)
                 raise
         except (dbapi2.ProgrammingError,
                 dbapi2.InterfaceError,
@@ -143,6 +156,18 @@ class Cursor(object):
             raise self._connection.identifySQLError(sql, args, e)
 
 
+    def fetchmany(self, size):
+        """
+        Retrieve at most C{size} more rows from the result of the last
+        statement executed with this cursor.
+
+        @type size: C{int}
+
+        @return: a C{list} of rows, empty when the result is exhausted.
+        """
+        return self._cursor.fetchmany(size)
+
+
     def lastRowID(self):
         return self._cursor.lastrowid
 
@@ -44,6 +44,15 @@ SELECT *DATABASE*.axiom_types.typename, *DATABASE*.axiom_types.module, *DATABASE
         AND *DATABASE*.axiom_types.oid = *DATABASE*.axiom_objects.type_id
 """
 
+# Like TYPEOF_QUERY, but for many objects at once.  The IN clause needs one
+# bind parameter per object, so it must be filled in before use.
+TYPEOF_MANY_QUERY = """
+SELECT *DATABASE*.axiom_objects.oid, *DATABASE*.axiom_types.typename, *DATABASE*.axiom_types.module, *DATABASE*.axiom_types.version
+    FROM *DATABASE*.axiom_types, *DATABASE*.axiom_objects
+    WHERE *DATABASE*.axiom_objects.oid IN (%s)
+        AND *DATABASE*.axiom_types.oid = *DATABASE*.axiom_objects.type_id
+"""
+
 HAS_SCHEMA_FEATURE = ("SELECT COUNT(oid) FROM *DATABASE*.sqlite_master "
                       "WHERE type = ? AND name = ?")
 
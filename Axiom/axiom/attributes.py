@@ -500,6 +500,23 @@ class SQLAttribute(inmemory, Comparable):
                 st._rejectChanges -= 1
 
 
+def _queryStructure(comparison):
+    """
+    Describe the SQL that an L{IComparison} generates without regard to the
+    values it compares against, so that the SQL can be reused for other
+    comparisons with the same structure.
+
+    @return: a hashable object which is equal for any two comparisons which
+    generate the same SQL from L{IComparison.getQuery}, or C{None} if the
+    comparison cannot describe itself this way.
+    """
+    structure = getattr(comparison, '_queryStructure', None)
+    if structure is None:
+        return None
+    return structure()
+
+
+
 class TwoAttributeComparison:
     implements(IComparison)
     def __init__(self, leftAttribute, operationString, rightAttribute):
@@ -524,6 +541,11 @@ class TwoAttributeComparison:
         return []
 
 
+    def _queryStructure(self):
+        return (self.__class__, self.leftAttribute, self.operationString,
+                self.rightAttribute)
+
+
     def __repr__(self):
         return ' '.join((self.leftAttribute.fullyQualifiedName(),
                          self.operationString,
@@ -547,6 +569,9 @@ class AttributeValueComparison:
     def getInvolvedTables(self):
         return [self.attribute.type]
 
+    def _queryStructure(self):
+        return (self.__class__, self.attribute, self.operationString)
+
     def __repr__(self):
         return ' '.join((self.attribute.fullyQualifiedName(),
                          self.operationString,
@@ -572,6 +597,9 @@ class NullComparison:
     def getInvolvedTables(self):
         return [self.attribute.type]
 
+    def _queryStructure(self):
+        return (self.__class__, self.attribute, self.negate)
+
 class LikeFragment:
     def getLikeArgs(self):
         return []
@@ -582,10 +610,20 @@ class LikeFragment:
     def getLikeTables(self):
         return []
 
+    def _likeStructure(self):
+        """
+        Return a hashable object which is the same for any two fragments which
+        generate the same SQL, or None if that cannot be determined.
+        """
+        return None
+
 class LikeNull(LikeFragment):
     def getLikeQuery(self, st):
         return "NULL"
 
+    def _likeStructure(self):
+        return self.__class__
+
 class LikeValue(LikeFragment):
     def __init__(self, value):
         self.value = value
@@ -596,6 +634,9 @@ class LikeValue(LikeFragment):
     def getLikeArgs(self):
         return [self.value]
 
+    def _likeStructure(self):
+        return self.__class__
+
 class LikeColumn(LikeFragment):
     def __init__(self, attribute):
         self.attribute = attribute
@@ -606,6 +647,9 @@ class LikeColumn(LikeFragment):
     def getLikeTables(self):
         return [self.attribute.type]
 
+    def _likeStructure(self):
+        return (self.__class__, self.attribute)
+
 
 class LikeComparison:
     implements(IComparison)
@@ -643,6 +687,15 @@ class LikeComparison:
                         pyval, None, store))
         return l
 
+    def _queryStructure(self):
+        parts = []
+        for lf in self.likeParts:
+            part = lf._likeStructure()
+            if part is None:
+                return None
+            parts.append(part)
+        return (self.__class__, self.attribute, self.negate, tuple(parts))
+
 
 
 class AggregateComparison:
@@ -681,6 +734,15 @@ class AggregateComparison:
                     t for t in cond.getInvolvedTables() if t not in tables])
         return tables
 
+    def _queryStructure(self):
+        structures = []
+        for cond in self.conditions:
+            structure = _queryStructure(cond)
+            if structure is None:
+                return None
+            structures.append(structure)
+        return (self.__class__, tuple(structures))
+
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__,
                            ', '.join(map(repr, self.conditions)))
@@ -779,6 +841,18 @@ class SequenceComparison:
         return [self.attribute.type]
 
 
+    def _queryStructure(self):
+        if self.containerClause == self._columnContainer:
+            container = self.container
+        elif self.containerClause == self._sequenceContainer:
+            self._sequenceContainer(None)
+            container = len(self._sequence)
+        else:
+            # The subselect SQL is cached on this comparison already.
+            return None
+        return (self.__class__, self.attribute, self.negate, container)
+
+
 
 class AND(AggregateComparison):
     """
@@ -822,6 +896,13 @@ class TableOrderComparisonWrapper(object):
         return self.comparison.getArgs(store)
 
 
+    def _queryStructure(self):
+        structure = _queryStructure(self.comparison)
+        if structure is None:
+            return None
+        return (self.__class__, tuple(self.tables), structure)
+
+
 
 class boolean(SQLAttribute):
     sqltype = 'BOOLEAN'
@@ -1156,6 +1237,13 @@ class reference(integer):
         if dbval is None:
             return None
 
+        if not oself.__legacy__:
+            prefetcher = getattr(oself, '_referencePrefetcher', None)
+            if (prefetcher is not None
+                and not oself.store.objectCache.has(dbval)):
+                # Load this referent along with those of the other items
+                # which were loaded by the same query.
+                prefetcher.prefetch(self)
         referee = oself.store.getItemByID(dbval, default=None, autoUpgrade=not oself.__legacy__)
         if referee is None and self.whenDeleted is not reference.NULLIFY:
 
@@ -5,7 +5,7 @@ Utilities for performing repetitive tasks over potentially large sets
 of data over an extended period of time.
 """
 
-import weakref, datetime, os, sys
+import weakref, datetime, os, sys, time
 
 from zope.interface import implements
 
@@ -22,6 +22,19 @@ from axiom.dependency import installOn
 
 VERBOSE = False
 
+# The fewest and most seconds BatchProcessingService waits between steps while
+# there is more work to do.
+MIN_BUSY_DELAY = 0.0
+MAX_BUSY_DELAY = 1.0
+
+# The seconds BatchProcessingService waits between steps when there is no more
+# work to do.
+IDLE_DELAY = 10.0
+
+# How many seconds late the reactor may be in waking BatchProcessingService up
+# before it starts waiting longer between steps to let other work through.
+MAX_REACTOR_LAG = 0.05
+
 _processors = weakref.WeakValueDictionary()
 
 
@@ -170,6 +183,30 @@ class _ReliableListener(item.Item):
     subprocess.
     """)
 
+    unitsProcessed = attributes.inmemory(doc="""
+    The number of work units processed by this listener since it was loaded.
+    """)
+
+    processingTime = attributes.inmemory(doc="""
+    The number of seconds spent in L{step} processing those work units.
+    """)
+
+    def activate(self):
+        self.unitsProcessed = 0
+        self.processingTime = 0.0
+
+
+    def throughput(self):
+        """
+        Return the number of work units processed per second spent processing
+        by this listener since it was loaded, or C{None} if it has not
+        processed any.
+        """
+        if not self.processingTime:
+            return None
+        return self.unitsProcessed / self.processingTime
+
+
     def __repr__(self):
         return '<ReliableListener %s %r #%r>' % ({iaxiom.REMOTE: 'remote',
                                                   iaxiom.LOCAL: 'local'}[self.style],
@@ -187,17 +224,17 @@ class _ReliableListener(item.Item):
                              item=item)
 
 
-    def _forwardWork(self, workUnitType):
+    def _forwardWork(self, workUnitType, limit=2):
         if VERBOSE:
             log.msg("%r looking forward from %r" % (self, self.forwardMark,))
         return self.store.query(
             workUnitType,
             workUnitType.storeID > self.forwardMark,
             sort=workUnitType.storeID.ascending,
-            limit=2)
+            limit=limit)
 
 
-    def _backwardWork(self, workUnitType):
+    def _backwardWork(self, workUnitType, limit=2):
         if VERBOSE:
             log.msg("%r looking backward from %r" % (self, self.backwardMark,))
         if self.backwardMark == 0:
@@ -206,13 +243,13 @@ class _ReliableListener(item.Item):
             workUnitType,
             workUnitType.storeID < self.backwardMark,
             sort=workUnitType.storeID.descending,
-            limit=2)
+            limit=limit)
 
 
-    def _extraWork(self):
+    def _extraWork(self, limit=2):
         return self.store.query(_ReliableTracker,
                                 _ReliableTracker.listener == self,
-                                limit=2)
+                                limit=limit)
 
 
     def _doOneWork(self, workUnit, failureType):
@@ -229,6 +266,113 @@ class _ReliableListener(item.Item):
 
 
     def step(self):
+        """
+        Give the listener up to its C{batchSize} work units to process, the
+        ones specially added with L{addItem} first, then new ones, then old
+        ones, and then call its C{stepFinished} method, if it has one.
+
+        @raise _NoWorkUnits: if there was no work to do.
+        @raise _ProcessingFailure: if the listener failed to process the first
+            work unit.
+        @return: C{True} if there is more work to do, C{False} otherwise.
+        """
+        batchSize = getattr(self.listener, 'batchSize', 1)
+        started = time.time()
+        if batchSize == 1:
+            more = self._stepOne()
+            processed = 1
+        else:
+            more, processed = self.store.transact(self._stepMany, batchSize)
+        stepFinished = getattr(self.listener, 'stepFinished', None)
+        if stepFinished is not None:
+            stepFinished()
+        elapsed = time.time() - started
+        self.unitsProcessed += processed
+        self.processingTime += elapsed
+        log.msg(interface=iaxiom.IStatEvent,
+                stat_batch_units=processed,
+                stat_batch_time=elapsed,
+                reliableListener=self.storeID)
+        return more
+
+
+    def _stepMany(self, batchSize):
+        """
+        Process up to C{batchSize} work units.  Each one after the first is
+        processed in a savepoint; if one of those fails, its changes are
+        reverted and the batch ends before it, so that the next step fails on
+        it first and the failure is handled as usual.  Must be run in a
+        transaction.
+
+        @return: a two-tuple of whether there is more work to do and the
+            number of work units processed.
+        """
+        processed = 0
+        forwardMark = self.forwardMark
+        backwardMark = self.backwardMark
+        more = False
+        try:
+            for workTracker in self._extraWork(batchSize + 1):
+                if processed == batchSize:
+                    more = True
+                    break
+                self._doBatchedWork(
+                    processed, self._doTrackedWork, workTracker)
+                processed += 1
+
+            if not more:
+                for workUnit in self._forwardWork(
+                    self.processor.workUnitType, batchSize - processed + 1):
+                    if processed == batchSize:
+                        more = True
+                        break
+                    self._doBatchedWork(
+                        processed, self._doOneWork,
+                        workUnit, _ForwardProcessingFailure)
+                    forwardMark = workUnit.storeID
+                    processed += 1
+
+            if not more:
+                for workUnit in self._backwardWork(
+                    self.processor.workUnitType, batchSize - processed + 1):
+                    if processed == batchSize:
+                        more = True
+                        break
+                    self._doBatchedWork(
+                        processed, self._doOneWork,
+                        workUnit, _BackwardProcessingFailure)
+                    backwardMark = workUnit.storeID
+                    processed += 1
+        except _ProcessingFailure:
+            if not processed:
+                raise
+            more = True
+
+        if not processed:
+            raise _NoWorkUnits()
+        self.forwardMark = forwardMark
+        self.backwardMark = backwardMark
+        return more, processed
+
+
+    def _doBatchedWork(self, processed, f, *a):
+        """
+        Call C{f(*a)}, in a savepoint unless it is the first work unit of a
+        batch.
+        """
+        if processed:
+            self.store._savepoint(f, *a)
+        else:
+            f(*a)
+
+
+    def _doTrackedWork(self, workTracker):
+        item = workTracker.item
+        workTracker.deleteFromStore()
+        self._doOneWork(item, _TrackedProcessingFailure)
+
+
+    def _stepOne(self):
         first = True
         for workTracker in self._extraWork():
             if first:
@@ -891,6 +1035,25 @@ class CallItemMethod(juice.Command):
                  ('method', juice.String())]
 
 
+
+class AddSubStore(juice.Command):
+    """
+    Begin batch processing for a newly created substore of the site store.
+    """
+    commandName = 'Add-Sub-Store'
+    arguments = [('storepath', juice.Path())]
+
+
+
+class RemoveSubStore(juice.Command):
+    """
+    Stop batch processing for a substore which has been deleted from the site
+    store.
+    """
+    commandName = 'Remove-Sub-Store'
+    arguments = [('storepath', juice.Path())]
+
+
 class BatchProcessingControllerService(service.Service):
     """
     Controls starting, stopping, and passing messages to the system process in
@@ -959,6 +1122,33 @@ class BatchProcessingControllerService(service.Service):
             ResumeProcessor(storepath=storepath, storeid=storeID).do)
 
 
+    def subStoreAdded(self, storepath):
+        """
+        Tell the batch process, if it is running, about a new substore.  If it
+        is not running, it will find the substore when it starts.
+
+        @type storepath: L{twisted.python.filepath.FilePath}
+        """
+        return self._notify(AddSubStore(storepath=storepath))
+
+
+    def subStoreRemoved(self, storepath):
+        """
+        Tell the batch process, if it is running, that a substore is gone.
+
+        @type storepath: L{twisted.python.filepath.FilePath}
+        """
+        return self._notify(RemoveSubStore(storepath=storepath))
+
+
+    def _notify(self, command):
+        if not self.running or self.batchController.mode != 'ready':
+            return defer.succeed(None)
+        d = command.do(self.batchController.juice)
+        d.addErrback(log.err, "Notifying batch process failed")
+        return d
+
+
 
 class _SubStoreBatchChannel(object):
     """
@@ -987,6 +1177,33 @@ class _SubStoreBatchChannel(object):
 
 
 
+def _notifySubStoreChange(siteStore, storepath, added):
+    """
+    Notify the batch process of a site store, if there is one, that a substore
+    has been added or removed.
+
+    @param siteStore: the L{axiom.store.Store} containing the substore.
+    @param storepath: the L{twisted.python.filepath.FilePath} of the substore,
+        or C{None} for an in-memory substore, which is ignored.
+    @param added: C{True} if the substore was added, C{False} if it was
+        removed.
+    """
+    if storepath is None or siteStore.parent is not None:
+        return
+    services = siteStore._axiom_service
+    if services is None:
+        return
+    try:
+        controller = services.getServiceNamed("Batch Processing Controller")
+    except KeyError:
+        return
+    if added:
+        controller.subStoreAdded(storepath)
+    else:
+        controller.subStoreRemoved(storepath)
+
+
+
 def storeBatchServiceSpecialCase(st, pups):
     if st.parent is not None:
         return _SubStoreBatchChannel(st)
@@ -995,7 +1212,37 @@ def storeBatchServiceSpecialCase(st, pups):
 
 
 class BatchProcessingProtocol(JuiceChild):
+    """
+    Protocol run by the batch process, which processes remote work in the
+    site store's substores.
+
+    New substores are announced by the site store's process with
+    L{AddSubStore} and deleted ones with L{RemoveSubStore}.  The site store is
+    also polled occasionally for substores created since the last one seen,
+    and less often for all of its substores, so that any which were deleted
+    are forgotten, in case an announcement was missed.
+
+    @ivar maxOpenSubStores: the most substores to have open at once.  When
+        there are more substores than this, the least recently used ones are
+        closed to make room for others, so that they all get a turn.
+
+    @ivar subStoresPerPoll: when there are more than C{maxOpenSubStores}
+        substores, the number of closed ones to open each poll.
+
+    @ivar fullPollInterval: the number of polls between those which look at
+        all of the site store's substores, rather than only new ones.
+
+    @ivar subStores: a C{dict} mapping the paths of open substores to the
+        L{BatchProcessingService}s for them.
+
+    @ivar clock: the L{IReactorTime} provider used to schedule polling.
+    """
     siteStore = None
+    clock = reactor
+
+    maxOpenSubStores = 100
+    subStoresPerPoll = 10
+    fullPollInterval = 30
 
     def __init__(self, service=None, issueGreeting=False):
         juice.Juice.__init__(self, issueGreeting)
@@ -1019,7 +1266,22 @@ class BatchProcessingProtocol(JuiceChild):
 
         self.siteStore = store.Store(storepath, debug=False)
         self.subStores = {}
+        # Paths of all known substores, in the order they were found, and
+        # the same paths as a set, for testing membership.
+        self._knownSubStores = []
+        self._knownSubStorePaths = set()
+        # Paths of open substores, least recently used first.
+        self._openOrder = []
+        # The index into _knownSubStores from which to look for substores to
+        # open.
+        self._nextSubStore = 0
+        # The storeID of the newest SubStore found by polling.
+        self._subStoreMark = 0
+        # The number of polls since the last one which looked at all
+        # SubStores.
+        self._pollsSinceFullPoll = 0
         self.pollCall = task.LoopingCall(self._pollSubStores)
+        self.pollCall.clock = self.clock
         self.pollCall.start(10.0)
 
         return {}
@@ -1028,32 +1290,201 @@ class BatchProcessingProtocol(JuiceChild):
 
 
     def command_SUSPEND_PROCESSOR(self, storepath, storeid):
-        return self.subStores[storepath.path].suspend(storeid).addCallback(lambda ign: {})
+        return self._useSubStore(storepath.path).suspend(storeid).addCallback(lambda ign: {})
     command_SUSPEND_PROCESSOR.command = SuspendProcessor
 
 
     def command_RESUME_PROCESSOR(self, storepath, storeid):
-        return self.subStores[storepath.path].resume(storeid).addCallback(lambda ign: {})
+        return self._useSubStore(storepath.path).resume(storeid).addCallback(lambda ign: {})
     command_RESUME_PROCESSOR.command = ResumeProcessor
 
 
     def command_CALL_ITEM_METHOD(self, storepath, storeid, method):
-        return self.subStores[storepath.path].call(storeid, method).addCallback(lambda ign: {})
+        return self._useSubStore(storepath.path).call(storeid, method).addCallback(lambda ign: {})
     command_CALL_ITEM_METHOD.command = CallItemMethod
 
 
+    def command_ADD_SUB_STORE(self, storepath):
+        if self._knowSubStore(storepath.path):
+            self._fillSubStores()
+        return {}
+    command_ADD_SUB_STORE.command = AddSubStore
+
+
+    def command_REMOVE_SUB_STORE(self, storepath):
+        self._forgetSubStore(storepath.path)
+        return {}
+    command_REMOVE_SUB_STORE.command = RemoveSubStore
+
+
+    def _knowSubStore(self, path):
+        """
+        Add the substore at C{path} to those which are opened in turn, if it is
+        not already one of them.
+
+        @return: C{True} if the substore was not already known, C{False}
+            otherwise.
+        """
+        if path in self._knownSubStorePaths:
+            return False
+        self._knownSubStorePaths.add(path)
+        self._knownSubStores.append(path)
+        return True
+
+
+    def _forgetSubStore(self, path):
+        """
+        Close the substore at C{path} if it is open, and stop trying to open
+        it.
+        """
+        self._forgetSubStores(set([path]))
+
+
+    def _forgetSubStores(self, paths):
+        """
+        Close the substores at C{paths} which are open, and stop trying to open
+        any of them.
+
+        @param paths: a C{set} of substore paths.
+        """
+        for path in paths:
+            if path in self.subStores:
+                self._closeSubStore(path)
+        if not paths & self._knownSubStorePaths:
+            return
+        self._knownSubStorePaths -= paths
+        known = []
+        nextSubStore = self._nextSubStore
+        for index, path in enumerate(self._knownSubStores):
+            if path in paths:
+                if index < nextSubStore:
+                    self._nextSubStore -= 1
+            else:
+                known.append(path)
+        self._knownSubStores = known
+
+
+    def _useSubStore(self, path):
+        """
+        Return the L{BatchProcessingService} for the substore at C{path},
+        opening it if necessary, and note that it was used.
+
+        @raise KeyError: if the substore could not be opened.
+        """
+        if path in self.subStores:
+            self._openOrder.remove(path)
+            self._openOrder.append(path)
+        elif not self._openSubStore(path):
+            raise KeyError(path)
+        return self.subStores[path]
+
+
+    def _openSubStore(self, path):
+        """
+        Open the substore at C{path} and start processing it, closing the least
+        recently used substores if too many are open.
+
+        @return: C{True} if the substore was opened, C{False} otherwise.
+        """
+        from axiom import store
+
+        while len(self.subStores) >= self.maxOpenSubStores:
+            if not self._closeLeastRecentlyUsed():
+                break
+        try:
+            s = store.Store(path, debug=False)
+        except eaxiom.SQLError, e:
+            # Generally, database is locked.
+            log.msg("Opening sub-Store failed with SQLError: %r" % (e,))
+            return False
+        except:
+            log.msg("Opening sub-Store failed with bad error:")
+            log.err()
+            return False
+        self._knowSubStore(path)
+        self.subStores[path] = BatchProcessingService(s, style=iaxiom.REMOTE)
+        self.subStores[path].setServiceParent(self.service)
+        self._openOrder.append(path)
+        if VERBOSE:
+            log.msg("Added SubStore " + path)
+        return True
+
+
+    def _closeSubStore(self, path):
+        """
+        Stop processing the substore at C{path} and close it.
+        """
+        svc = self.subStores.pop(path)
+        self._openOrder.remove(path)
+        running = svc.running
+        svc.disownServiceParent()
+        if not running and svc.store.connection is not None:
+            # Stopping the service closes its store, so close it here if the
+            # service was never started.
+            svc.store.close()
+        if VERBOSE:
+            log.msg("Removed SubStore " + path)
+
+
+    def _closeLeastRecentlyUsed(self):
+        """
+        Close the least recently used substore, skipping those with suspended
+        processors, which would be resumed by closing them.
+
+        @return: C{True} if a substore was closed, C{False} otherwise.
+        """
+        for path in self._openOrder:
+            if not self.subStores[path].suspended:
+                self._closeSubStore(path)
+                return True
+        return False
+
+
+    def _fillSubStores(self):
+        """
+        Open substores which are not open yet: all of them, if they fit within
+        C{maxOpenSubStores}, otherwise the next C{subStoresPerPoll} of them in
+        turn.
+        """
+        known = self._knownSubStores
+        closed = len(known) - len(self.subStores)
+        if closed <= 0:
+            return
+        if len(known) <= self.maxOpenSubStores:
+            budget = closed
+        else:
+            budget = min(closed, self.subStoresPerPoll)
+        for i in xrange(len(known)):
+            if not budget:
+                break
+            if self._nextSubStore >= len(known):
+                self._nextSubStore = 0
+            path = known[self._nextSubStore]
+            self._nextSubStore += 1
+            if path not in self.subStores:
+                self._openSubStore(path)
+                budget -= 1
+
+
     def _pollSubStores(self):
-        from axiom import store, substore
+        from axiom import substore
 
         # Any service which has encountered an error will have logged it and
-        # then stopped.  Prune those here, so that they are noticed as missing
-        # below and re-added.
+        # then stopped.  Close those here, so that they are opened again
+        # below.
         for path, svc in self.subStores.items():
             if not svc.running:
-                del self.subStores[path]
+                self._closeSubStore(path)
 
+        fullPoll = self._pollsSinceFullPoll + 1 >= self.fullPollInterval
+        if fullPoll:
+            comparison = None
+        else:
+            comparison = substore.SubStore.storeID > self._subStoreMark
         try:
-            paths = set([p.path for p in self.siteStore.query(substore.SubStore).getColumn("storepath")])
+            newSubStores = list(self.siteStore.query(
+                    substore.SubStore, comparison,
+                    sort=substore.SubStore.storeID.ascending))
         except eaxiom.SQLError, e:
             # Generally, database is locked.
             log.msg("SubStore query failed with SQLError: %r" % (e,))
@@ -1062,32 +1493,30 @@ class BatchProcessingProtocol(JuiceChild):
             log.msg("SubStore query failed with bad error:")
             log.err()
         else:
-            for removed in set(self.subStores) - paths:
-                self.subStores[removed].disownServiceParent()
-                del self.subStores[removed]
-                if VERBOSE:
-                    log.msg("Removed SubStore " + removed)
-            for added in paths - set(self.subStores):
-                try:
-                    s = store.Store(added, debug=False)
-                except eaxiom.SQLError, e:
-                    # Generally, database is locked.
-                    log.msg("Opening sub-Store failed with SQLError: %r" % (e,))
-                except:
-                    log.msg("Opening sub-Store failed with bad error:")
-                    log.err()
-                else:
-                    self.subStores[added] = BatchProcessingService(s, style=iaxiom.REMOTE)
-                    self.subStores[added].setServiceParent(self.service)
-                    if VERBOSE:
-                        log.msg("Added SubStore " + added)
+            if fullPoll:
+                self._pollsSinceFullPoll = 0
+                existing = set([subStore.storepath.path
+                                for subStore in newSubStores
+                                if subStore.storepath is not None])
+                self._forgetSubStores(self._knownSubStorePaths - existing)
+            else:
+                self._pollsSinceFullPoll += 1
+            for subStore in newSubStores:
+                self._subStoreMark = subStore.storeID
+                if subStore.storepath is not None:
+                    self._knowSubStore(subStore.storepath.path)
+        self._fillSubStores()
 
 
 
 class BatchProcessingService(service.Service):
     """
     Steps over the L{iaxiom.IBatchProcessor} powerups for a single L{axiom.store.Store}.
+
+    @ivar clock: the L{IReactorTime} provider used to wait between steps.
     """
+    clock = reactor
+
     def __init__(self, store, style=iaxiom.LOCAL):
         self.store = store
         self.style = style
@@ -1117,17 +1546,53 @@ class BatchProcessingService(service.Service):
     def processWhileRunning(self):
         """
         Run tasks until stopService is called.
+
+        While there is work to do, wait between steps for at least as long as
+        the last one took, and for longer when the reactor is slow to wake
+        this up, so that batch processing does not starve other work.
         """
         work = self.step()
-        for result, more in work:
+        delay = MIN_BUSY_DELAY
+        lag = 0.0
+        while True:
+            started = self.clock.seconds()
+            try:
+                result, more = work.next()
+            except StopIteration:
+                break
+            stepTime = self.clock.seconds() - started
             yield result
             if not self.running:
                 break
             if more:
-                delay = 0.1
+                delay = self._busyDelay(delay, stepTime, lag)
+                wait = delay
             else:
-                delay = 10.0
-            yield task.deferLater(reactor, delay, lambda: None)
+                delay = MIN_BUSY_DELAY
+                wait = IDLE_DELAY
+            sleepStarted = self.clock.seconds()
+            yield task.deferLater(self.clock, wait, lambda: None)
+            if not self.running:
+                # Stopped while waiting, which closed the store.
+                break
+            lag = max(0.0, self.clock.seconds() - sleepStarted - wait)
+
+
+    def _busyDelay(self, delay, stepTime, lag):
+        """
+        Determine how long to wait before the next step when there is more work
+        to do.
+
+        @param delay: the number of seconds waited before the last step.
+        @param stepTime: the number of seconds the last step took.
+        @param lag: the number of seconds later than requested that the reactor
+            woke this service up before the last step.
+        """
+        if lag > MAX_REACTOR_LAG:
+            delay = max(delay * 2, lag)
+        else:
+            delay = delay / 2
+        return min(max(delay, stepTime, MIN_BUSY_DELAY), MAX_BUSY_DELAY)
 
 
     def step(self):
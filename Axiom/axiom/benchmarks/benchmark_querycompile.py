@@ -0,0 +1,53 @@
+
+"""
+Benchmark the per-query overhead of running many small queries which differ
+only in the values they compare against.
+
+Pass C{uncached} as an argument to measure the cost of generating each
+query's SQL from scratch and locating its call site, as every query did
+before L{Store.queryCache} and L{Store.queryCallSites}.
+"""
+
+import sys
+
+from epsilon.scripts import benchmark
+
+from axiom.store import Store
+from axiom.item import Item
+from axiom.attributes import integer, text, AND
+
+N = 10000
+
+class QueriedItem(Item):
+    a = integer(indexed=True)
+    b = text()
+
+
+
+def main(argv):
+    uncached = 'uncached' in argv[1:]
+    s = Store("TEMPORARY.axiom")
+    s.queryCallSites = uncached
+
+    def createItems():
+        for x in xrange(100):
+            QueriedItem(store=s, a=x, b=unicode(x))
+    s.transact(createItems)
+
+    def runQueries():
+        for x in xrange(N):
+            if uncached:
+                s.queryCache.clear()
+            s.findFirst(QueriedItem,
+                        AND(QueriedItem.a == x % 100,
+                            QueriedItem.b != u''),
+                        sort=QueriedItem.a.descending)
+
+    benchmark.start()
+    s.transact(runQueries)
+    benchmark.stop()
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -255,6 +255,16 @@ class IReliableListener(Interface):
     {IReliableListener} providers are given to
     L{IBatchProcessor.addReliableListener} and will then have L{processItem}
     called with items handled by that processor.
+
+    Providers may also have a C{batchSize} attribute, the number of items to
+    process in a single transaction.  It defaults to 1.  Larger batches
+    process a large backlog of items much faster.
+
+    Providers may also have a C{stepFinished} method, which is called with no
+    arguments after each batch of items has been processed, in the
+    transaction which records that they have been.  Providers which defer work
+    from L{processItem} must finish it there, or it will be lost if the
+    process exits before they do.
     """
 
     def processItem(item):
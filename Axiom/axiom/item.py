@@ -496,6 +496,10 @@ class Item(Empowered, slotmachine._Strict):
     # A mapping from interfaces to in-memory powerups.
     _inMemoryPowerups = inmemory()
 
+    # The store._ReferencePrefetcher for the query which most recently loaded
+    # this item, or None.
+    _referencePrefetcher = inmemory()
+
     def _currentlyValidAsReferentFor(self, store):
         """
         Is this object currently valid as a reference?  Objects which will be
@@ -587,6 +591,7 @@ class Item(Empowered, slotmachine._Strict):
         """
         self._axiom_service = None
         self._inMemoryPowerups = {}
+        self._referencePrefetcher = None
         self.__dirty__ = {}
         to__store = kw.pop('__store', None)
         to__everInserted = kw.pop('__everInserted', False)
@@ -705,11 +710,36 @@ class Item(Empowered, slotmachine._Strict):
             if not self.__legacy__:
                 self.store.objectCache.uncache(self.storeID, self)
             return
-        self.__dirty__.clear()
-        dbattrs = self.store.querySQL(
+        self._reload(self._selectRows()[0])
+
+
+    def _revertToSavepoint(self):
+        """
+        Discard the in-memory changes made to this item since a savepoint was
+        established, when it had already been changed earlier in the same
+        transaction.  The database is expected to have been rolled back to the
+        savepoint already.  See L{axiom.store.Store._savepoint}.
+        """
+        rows = self._selectRows()
+        if rows:
+            self._reload(rows[0])
+        # Otherwise it was deleted before the savepoint and stays that way.
+
+
+    def _selectRows(self):
+        return self.store.querySQL(
             self._baseSelectSQL(self.store),
-            [self.storeID])[0]
+            [self.storeID])
+
+
+    def _reload(self, dbattrs):
+        """
+        Discard all in-memory changes to this item, replacing its attributes
+        with values loaded from the database.
 
+        @param dbattrs: the row of this item's table for this item.
+        """
+        self.__dirty__.clear()
         for data, (name, atr) in zip(dbattrs, self.getSchema()):
             atr.loaded(self, data)
 
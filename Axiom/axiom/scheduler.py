@@ -1,6 +1,6 @@
 # -*- test-case-name: axiom.test.test_scheduler -*-
 
-import warnings
+import time, warnings
 
 from zope.interface import implements
 
@@ -11,7 +11,7 @@ from twisted.python import log, failure
 
 from epsilon.extime import Time
 
-from axiom.iaxiom import IScheduler
+from axiom.iaxiom import IScheduler, IStatEvent
 from axiom.item import Item, declareLegacyItem
 from axiom.attributes import AND, timestamp, reference, integer, inmemory, bytes
 from axiom.dependency import uninstallFrom
@@ -39,9 +39,17 @@ class TimedEvent(Item):
     runnable = reference()
 
     running = inmemory(doc='True if this event is currently running.')
+    deleting = inmemory(
+        doc='True if this event has been deleted in the current transaction.')
 
     def activate(self):
         self.running = False
+        self.deleting = False
+
+
+    def deleteFromStore(self, deleteObject=True):
+        Item.deleteFromStore(self, deleteObject)
+        self.deleting = True
 
 
     def _rescheduleFromRun(self, newTime):
@@ -108,6 +116,24 @@ class _WackyControlFlow(Exception):
 MAX_WORK_PER_TICK = 10
 
 class SchedulerMixin:
+    """
+    Implementation of L{IScheduler} in terms of L{TimedEvent}s in C{store}.
+
+    @ivar eventsPerTransaction: C{None} to run each due event in a
+        transaction of its own, looking for the next due event before each
+        one.  Otherwise, the number of due events to load at once and run in a
+        single transaction.  Each event runs in a savepoint, so an event which
+        fails is handled as it would be otherwise, without undoing the work of
+        the others.  This is much faster when many events are due at once,
+        for example after a restart.
+
+    @ivar transactionsPerTick: when C{eventsPerTransaction} is not C{None},
+        the number of transactions to run in each tick, if there are enough
+        due events to fill them, before returning control to the reactor.
+    """
+    eventsPerTransaction = None
+    transactionsPerTick = 1
+
     def _oneTick(self, now):
         theEvent = self._getNextEvent(now)
         if theEvent is None:
@@ -130,22 +156,75 @@ class SchedulerMixin:
             return theEventL[0]
 
 
+    def _batchTick(self, now):
+        """
+        Run as many as C{eventsPerTransaction} due events, each in a
+        savepoint.  Must be run in a transaction.
+
+        @return: a two-tuple of the number of events run and the number of
+            those which failed.
+        """
+        events = list(self.store.query(TimedEvent,
+                                       TimedEvent.time <= now,
+                                       sort=TimedEvent.time.ascending,
+                                       limit=self.eventsPerTransaction))
+        for event in events:
+            # The query only finds events which still exist.
+            event.deleting = False
+        workUnitsPerformed = 0
+        errors = 0
+        for event in events:
+            # An event which ran earlier in this batch may have deleted or
+            # rescheduled this one.
+            if event.deleting or event.time > now:
+                continue
+            try:
+                self.store._savepoint(event.invokeRunnable)
+            except:
+                failureObj = failure.Failure()
+                event.handleError(now, failureObj)
+                log.err(failureObj)
+                errors += 1
+            workUnitsPerformed += 1
+            self.lastEventAt = now
+        return workUnitsPerformed, errors
+
+
     def tick(self):
         now = self.now()
         self.nextEventAt = None
-        workBeingDone = True
         workUnitsPerformed = 0
         errors = 0
-        while workBeingDone and workUnitsPerformed < MAX_WORK_PER_TICK:
-            try:
-                workBeingDone = self.store.transact(self._oneTick, now)
-            except _WackyControlFlow, wcf:
-                self.store.transact(wcf.eventObject.handleError, now, wcf.failureObject)
-                log.err(wcf.failureObject)
-                errors += 1
-                workBeingDone = True
-            if workBeingDone:
-                workUnitsPerformed += 1
+        if self.eventsPerTransaction is None:
+            workBeingDone = True
+            while workBeingDone and workUnitsPerformed < MAX_WORK_PER_TICK:
+                try:
+                    workBeingDone = self.store.transact(self._oneTick, now)
+                except _WackyControlFlow, wcf:
+                    self.store.transact(wcf.eventObject.handleError, now, wcf.failureObject)
+                    log.err(wcf.failureObject)
+                    errors += 1
+                    workBeingDone = True
+                if workBeingDone:
+                    workUnitsPerformed += 1
+        else:
+            started = time.time()
+            for i in xrange(self.transactionsPerTick):
+                ran, failed = self.store.transact(self._batchTick, now)
+                workUnitsPerformed += ran
+                errors += failed
+                if ran < self.eventsPerTransaction:
+                    break
+            elapsed = time.time() - started
+            if elapsed > 0:
+                rate = workUnitsPerformed / elapsed
+            else:
+                rate = 0.0
+            log.msg(interface=IStatEvent,
+                    stat_scheduler_events=workUnitsPerformed,
+                    stat_scheduler_errors=errors,
+                    stat_scheduler_tick_time=elapsed,
+                    scheduler_events_per_second=rate)
         x = list(self.store.query(TimedEvent, sort=TimedEvent.time.ascending, limit=1))
         if x:
             self._transientSchedule(x[0].time, now)
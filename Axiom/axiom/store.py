@@ -8,7 +8,8 @@ This module holds the Axiom Store class and related classes, such as queries.
 from epsilon import hotfix
 hotfix.require('twisted', 'filepath_copyTo')
 
-import time, os, itertools, warnings, sys, operator, weakref
+import time, os, itertools, warnings, sys, weakref, base64
+from ast import literal_eval
 
 from zope.interface import implements
 
@@ -49,6 +50,23 @@ _requiredTableIndexes = weakref.WeakKeyDictionary()
 # up opening stores significantly.
 _inMemorySchemaCache = weakref.WeakKeyDictionary()
 
+# The default number of rows fetched from the database at once by
+# BaseQuery.stream.
+STREAM_CHUNK_SIZE = 100
+
+# The largest number of storeIDs Store.getItemsByIDs will put into the IN
+# clause of a single statement.  SQLite limits the number of bind parameters
+# a statement may have, to 999 by default.
+MAX_IDS_PER_QUERY = 500
+
+# The number of consecutive results of an ItemQuery whose references are
+# loaded together when one of them is first dereferenced.
+REFERENCE_PREFETCH_WINDOW = 100
+
+# The number of distinct query statements a Store remembers the SQL for (see
+# BaseQuery._sqlAndArgs).
+QUERY_CACHE_SIZE = 1000
+
 
 
 class NoEmptyItems(Exception):
@@ -268,6 +286,7 @@ class BaseQuery:
         """
         tableAliases = []
         self.fromClauseParts = []
+        self._aliased = False
         for table in tables:
             # The indirect calls to store.getTableName() will create the tables
             # if needed. (XXX That's bad, actually.   They should get created
@@ -277,6 +296,7 @@ class BaseQuery:
             if tableAlias is None:
                 self.fromClauseParts.append(tableName)
             else:
+                self._aliased = True
                 tableAliases.append(tableAlias)
                 self.fromClauseParts.append('%s AS %s' % (tableName,
                                                           tableAlias))
@@ -311,6 +331,51 @@ class BaseQuery:
         else:
             assert self.offset is None, 'Offset specified without limit'
 
+        key = self._queryCacheKey(verb, subject)
+        if key is None:
+            sqlstr = self._statementSQL(verb, subject)
+        else:
+            cache = self.store.queryCache
+            try:
+                sqlstr = cache[key]
+            except KeyError:
+                sqlstr = self._statementSQL(verb, subject)
+                if len(cache) >= QUERY_CACHE_SIZE:
+                    cache.clear()
+                cache[key] = sqlstr
+        if limitClause:
+            sqlstr = sqlstr + ' ' + ' '.join(limitClause)
+        return (sqlstr, self.args)
+
+
+    def _queryCacheKey(self, verb, subject):
+        """
+        Determine the key under which the SQL for this query is kept in
+        L{Store.queryCache}: everything the statement depends on except the
+        values being compared against, which are passed as bind parameters,
+        and the limit and offset, which are appended to it.
+
+        @return: a hashable object, or C{None} if this query's SQL must be
+        generated anew.
+        """
+        if self._aliased:
+            # Placeholder aliases are handed out per query.
+            return None
+        if self.comparison is None:
+            structure = ()
+        else:
+            structure = attributes._queryStructure(self.comparison)
+            if structure is None:
+                return None
+        return (verb, subject, self.tableClass, structure,
+                tuple(self.sort.orderColumns()))
+
+
+    def _statementSQL(self, verb, subject):
+        """
+        Generate the SQL for this query, up to but not including its LIMIT
+        and OFFSET clause.
+        """
         sqlParts = [verb, subject]
         if self.fromClauseParts:
             sqlParts.extend(['FROM', ', '.join(self.fromClauseParts)])
@@ -318,24 +383,30 @@ class BaseQuery:
             sqlParts.extend(['WHERE', self.comparison.getQuery(self.store)])
         if self.sortClauseParts:
             sqlParts.extend(['ORDER BY', ', '.join(self.sortClauseParts)])
-        if limitClause:
-            sqlParts.append(' '.join(limitClause))
-        sqlstr = ' '.join(sqlParts)
-        return (sqlstr, self.args)
+        return ' '.join(sqlParts)
 
 
-    def _runQuery(self, verb, subject):
-        # XXX ideally this should be creating an SQL cursor and iterating
-        # through that so we don't have to load the whole query into memory,
-        # but right now Store's interface to SQL is all through one cursor.
-        # I'm not sure how to do this and preserve the chokepoint so that we
-        # can do, e.g. transaction fallbacks.
+    def _runQuery(self, verb, subject, chunkSize=None):
+        """
+        Execute this query with a particular SQL verb and query target.
+
+        @param chunkSize: C{None} to load all of the resulting rows into
+        memory before returning them in a C{list}, or an C{int} to run the
+        query on a dedicated cursor and return an iterator which fetches rows
+        from it at most that many at a time (see L{Store.streamSQL}).
+        """
         t = time.time()
         if not self.store.autocommit:
             self.store.checkpoint()
         sqlstr, sqlargs = self._sqlAndArgs(verb, subject)
-        sqlResults = self.store.querySQL(sqlstr, sqlargs)
-        cs = self.locateCallSite()
+        if chunkSize is None:
+            sqlResults = self.store.querySQL(sqlstr, sqlargs)
+        else:
+            sqlResults = self.store.streamSQL(sqlstr, sqlargs, chunkSize)
+        if self.store.queryCallSites:
+            cs = self.locateCallSite()
+        else:
+            cs = None
         log.msg(interface=iaxiom.IStatEvent,
                 querySite=cs, queryTime=time.time() - t, querySQL=sqlstr)
         return sqlResults
@@ -350,7 +421,7 @@ class BaseQuery:
         return (frame.f_code.co_filename, frame.f_lineno)
 
 
-    def _selectStuff(self, verb='SELECT'):
+    def _selectStuff(self, verb='SELECT', chunkSize=None):
         """
         Return a generator which yields the massaged results of this query with
         a particular SQL verb.
@@ -362,8 +433,12 @@ class BaseQuery:
         @param verb: a str containing the SQL verb to execute.  This really
         must be some variant of 'SELECT', the only two currently implemented
         being 'SELECT' and 'SELECT DISTINCT'.
+
+        @param chunkSize: C{None} to load every row before yielding the first
+        result, or an C{int} giving the maximum number of rows to load from
+        the database at once.
         """
-        sqlResults = self._runQuery(verb, self._queryTarget)
+        sqlResults = self._runQuery(verb, self._queryTarget, chunkSize)
         for row in sqlResults:
             yield self._massageData(row)
 
@@ -423,6 +498,31 @@ class BaseQuery:
         return self._selectStuff('SELECT')
 
 
+    def stream(self, chunkSize=STREAM_CHUNK_SIZE):
+        """
+        Iterate the results of this query without loading all of them into
+        memory first.
+
+        Iterating a query directly retrieves every row of the result before
+        yielding the first one.  The iterator returned by this method instead
+        runs the query on its own cursor and retrieves rows from it as they
+        are needed, so the memory it uses does not grow with the size of the
+        result.
+
+        As with iterating the query directly, pending changes are written to
+        the database before the query is run.  Changes made while the
+        iterator is being consumed may or may not be reflected in the results
+        which have not been retrieved yet.
+
+        @param chunkSize: the maximum number of rows to retrieve from the
+        database at once.
+        @type chunkSize: L{int}
+
+        @return: an iterable which yields all the results of this query.
+        """
+        return self._selectStuff('SELECT', chunkSize)
+
+
     _selfiter = None
     def next(self):
         """
@@ -457,6 +557,156 @@ def _isColumnUnique(col):
     """
     return isinstance(col, _StoreIDComparer)
 
+class _KeysetComparison(object):
+    """
+    An L{iaxiom.IComparison} which matches the rows which come after a
+    particular row in an ordering, by comparing the values of the ordering's
+    columns with the values of those columns for that row.
+
+    Like SQLite, this considers NULL to be less than any other value.
+    """
+    implements(iaxiom.IComparison)
+
+    def __init__(self, orderColumns, values):
+        """
+        @param orderColumns: a C{list} of 2-tuples of columns and directions,
+        as returned by L{iaxiom.IOrdering.orderColumns}.  The last column must
+        be unique.
+
+        @param values: a C{list} of the database values of each of those
+        columns for the row after which to match.
+        """
+        self.orderColumns = orderColumns
+        self.values = values
+
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (
+            self.__class__.__name__, self.orderColumns, self.values)
+
+
+    def getInvolvedTables(self):
+        tables = []
+        for column, direction in self.orderColumns:
+            if column.type not in tables:
+                tables.append(column.type)
+        return tables
+
+
+    def _sqlAndArgs(self, store):
+        """
+        Generate the SQL for this comparison, which is a disjunction with one
+        term for each column: the row is equal to the given row in all of the
+        preceding columns and after it in this column.
+        """
+        alternatives = []
+        args = []
+        equalities = []
+        equalityArgs = []
+        for (column, direction), value in zip(self.orderColumns, self.values):
+            name = column.getColumnName(store)
+            nullable = getattr(column, 'allowNone', False)
+            if value is None:
+                if direction == 'ASC':
+                    alternatives.append(equalities + ['%s NOT NULL' % (name,)])
+                    args.extend(equalityArgs)
+                equalities = equalities + ['%s IS NULL' % (name,)]
+            else:
+                if direction == 'ASC':
+                    after = '%s > ?' % (name,)
+                elif nullable:
+                    after = '(%s < ? OR %s IS NULL)' % (name, name)
+                else:
+                    after = '%s < ?' % (name,)
+                alternatives.append(equalities + [after])
+                args.extend(equalityArgs + [value])
+                equalities = equalities + ['%s = ?' % (name,)]
+                equalityArgs = equalityArgs + [value]
+
+        if not alternatives:
+            # Nothing comes after this row.
+            return '(0)', []
+
+        sql = '(' + ' OR '.join([
+                '(' + ' AND '.join(terms) + ')'
+                for terms in alternatives]) + ')'
+
+        # Let SQLite use an index on the first column to skip directly to the
+        # right place, rather than scanning for the first matching row.
+        (column, direction), value = self.orderColumns[0], self.values[0]
+        if value is not None:
+            if direction == 'ASC':
+                bound = '%s >= ?'
+            elif not getattr(column, 'allowNone', False):
+                bound = '%s <= ?'
+            else:
+                bound = None
+            if bound is not None:
+                sql = '(%s AND %s)' % (
+                    bound % (column.getColumnName(store),), sql)
+                args = [value] + args
+        return sql, args
+
+
+    def getQuery(self, store):
+        return self._sqlAndArgs(store)[0]
+
+
+    def getArgs(self, store):
+        return self._sqlAndArgs(store)[1]
+
+
+    def _queryStructure(self):
+        return (self.__class__, tuple(self.orderColumns),
+                tuple([value is None for value in self.values]))
+
+
+
+class _ReferencePrefetcher(object):
+    """
+    The rows of consecutive results of an L{ItemQuery}, kept so that when a
+    reference attribute of one of those results is first dereferenced, the
+    referents of all of them can be loaded with L{Store.getItemsByIDs}.
+
+    @ivar prefetched: a C{dict} mapping reference attributes to the C{list}
+    of referents loaded for them.  This keeps the referents in the object
+    cache for as long as any of the results refers to this prefetcher.
+    """
+    def __init__(self, store, tableClass, rows):
+        self.store = store
+        self.tableClass = tableClass
+        self.rows = rows
+        self.prefetched = {}
+
+
+    def prefetch(self, attribute):
+        """
+        Load the referents of C{attribute} for all of my rows, if that has not
+        been done already.
+
+        @param attribute: a L{attributes.reference} from my item type's
+        schema.
+        """
+        if attribute in self.prefetched:
+            return
+        self.prefetched[attribute] = []
+        for index, (name, attr) in enumerate(self.tableClass.getSchema()):
+            if attr is attribute:
+                break
+        else:
+            return
+        storeIDs = [row[index + 1] for row in self.rows
+                    if row[index + 1] is not None]
+        # Upgrading an item may have arbitrary side-effects (including
+        # deleting the item being dereferenced), so leave that to the
+        # individual dereference which actually needs the referent.  Items
+        # which need upgrading are not cached, so loading them here does not
+        # help, but does not hurt either.
+        self.prefetched[attribute] = self.store.getItemsByIDs(
+            storeIDs, default=None, autoUpgrade=False)
+
+
+
 class ItemQuery(BaseQuery):
     """
     This class is a query whose results will be Item instances.  This is the
@@ -476,7 +726,27 @@ class ItemQuery(BaseQuery):
                      ])))
 
 
-    def paginate(self, pagesize=20):
+    def _selectStuff(self, verb='SELECT', chunkSize=None):
+        """
+        Override L{BaseQuery._selectStuff} to associate each group of
+        consecutive results with a L{_ReferencePrefetcher}, so that
+        dereferencing a reference attribute of one result loads the referents
+        of the whole group at once.
+        """
+        sqlResults = iter(self._runQuery(verb, self._queryTarget, chunkSize))
+        windowSize = chunkSize or REFERENCE_PREFETCH_WINDOW
+        while True:
+            rows = list(itertools.islice(sqlResults, windowSize))
+            if not rows:
+                break
+            prefetcher = _ReferencePrefetcher(self.store, self.tableClass, rows)
+            for row in rows:
+                result = self._massageData(row)
+                result._referencePrefetcher = prefetcher
+                yield result
+
+
+    def paginate(self, pagesize=20, resumeFrom=None):
         """
         Split up the work of gathering a result set into multiple smaller
         'pages', allowing very large queries to be iterated without blocking
@@ -486,83 +756,162 @@ class ItemQuery(BaseQuery):
         query directly, using this method allows the work to obtain the results
         to be performed on demand, over a series of different transaction.
 
+        Each page is found by seeking past the last result of the previous
+        page in the query's sort order, to which the result type's storeID is
+        added as a final tiebreaker, rather than by counting results from the
+        beginning.  The cost of finding a page therefore does not depend on
+        how many results came before it.  The sort may only involve attributes
+        of the result type.
+
         @param pagesize: the number of results gather in each chunk of work.
         (This is mostly for testing paginate's implementation.)
         @type pagesize: L{int}
 
+        @param resumeFrom: C{None} to start with the first result of this
+        query, or a token previously returned by L{paginationToken} for this
+        query to start with the result after the one that token was created
+        for.
+        @type resumeFrom: L{str}
+
+        @raise ValueError: if C{pagesize} is not positive, if the query's sort
+        involves attributes of other types, or if C{resumeFrom} is not a
+        token for this query.
+
         @return: an iterable which yields all the results of this query.
         """
-
-        sort = self.sort
-        oc = list(sort.orderColumns())
-        if not oc:
-            # You can't have an unsorted pagination.
-            sort = self.tableClass.storeID.ascending
-            oc = list(sort.orderColumns())
-        if len(oc) != 1:
-            raise RuntimeError("%d-column sorts not supported yet with paginate" %(len(oc),))
-        sortColumn = oc[0][0]
-        if oc[0][1] == 'ASC':
-            sortOp = operator.gt
+        if pagesize < 1:
+            raise ValueError("pagesize must be positive: %r" % (pagesize,))
+        orderColumns = self._paginationOrder()
+        if resumeFrom is None:
+            values = None
         else:
-            sortOp = operator.lt
-        if _isColumnUnique(sortColumn):
-            # This is the easy case.  There is never a tie to be broken, so we
-            # can just remember our last value and yield from there.  Right now
-            # this only happens when the column is a storeID, but hopefully in
-            # the future we will have more of this.
-            tiebreaker = None
+            values = self._decodePaginationToken(resumeFrom, orderColumns)
+        return self._paginate(pagesize, orderColumns, values)
+
+
+    def paginationToken(self, result):
+        """
+        Create a token identifying the position of one of this query's results
+        in the order in which L{paginate} yields them, so that pagination can
+        later be resumed after it, even by a different L{ItemQuery} with the
+        same sort.
+
+        @param result: an item of this query's result type.
+
+        @return: an opaque, printable L{str} suitable for use as the
+        C{resumeFrom} argument to L{paginate}.
+        """
+        orderColumns = self._paginationOrder()
+        encoded = []
+        for value in self._paginationValues(result, orderColumns):
+            if isinstance(value, buffer):
+                encoded.append(('b', str(value)))
+            else:
+                encoded.append(('v', value))
+        return base64.urlsafe_b64encode(repr(
+                (self._paginationSignature(orderColumns), tuple(encoded))))
+
+
+    def _paginationOrder(self):
+        """
+        Determine the columns by which L{paginate} orders this query's
+        results: the columns of this query's sort, followed by the storeID of
+        the result type unless that is already included.
+
+        @return: a C{list} of 2-tuples of columns and directions, as returned
+        by L{iaxiom.IOrdering.orderColumns}.
+        """
+        orderColumns = list(self.sort.orderColumns())
+        for column, direction in orderColumns:
+            if column.type is not self.tableClass:
+                raise ValueError(
+                    "paginate only supports sorts on attributes of %r, not %r"
+                    % (self.tableClass, column))
+            if _isColumnUnique(column):
+                # Nothing after a unique column can affect the order.
+                del orderColumns[orderColumns.index((column, direction)) + 1:]
+                break
         else:
-            tiebreaker = self.tableClass.storeID
-
-        tied = lambda a, b: (sortColumn.__get__(a) ==
-                             sortColumn.__get__(b))
-        def _AND(a, b):
-            if a is None:
-                return b
-            return attributes.AND(a, b)
-
-        results = list(self.store.query(self.tableClass, self.comparison,
-                                        sort=sort, limit=pagesize + 1))
-        while results:
-            if len(results) == 1:
-                # XXX TODO: reject 0 pagesize.  If the length of the result set
-                # is 1, there's no next result to test for a tie with, so we
-                # must be at the end, and we should just yield the result and finish.
-                yield results[0]
-                return
-            for resultidx in range(len(results) - 1):
-                # check for a tie.
-                result = results[resultidx]
-                nextResult = results[resultidx + 1]
-                if tied(result, nextResult):
-                    # Yield any ties first, in the appropriate order.
-                    lastTieBreaker = tiebreaker.__get__(result)
-                    # Note that this query is _NOT_ limited: currently large ties
-                    # will generate arbitrarily large amounts of work.
-                    trq = self.store.query(
-                        self.tableClass,
-                        _AND(self.comparison,
-                             sortColumn == sortColumn.__get__(result)))
-                    tiedResults = list(trq)
-                    tiedResults.sort(key=lambda rslt: (sortColumn.__get__(result),
-                                                       tiebreaker.__get__(result)))
-                    for result in tiedResults:
-                        yield result
-                    # re-start the query here ('result' is set to the
-                    # appropriate value by the inner loop)
-                    break
-                else:
-                    yield result
+            orderColumns.append((self.tableClass.storeID, 'ASC'))
+        return orderColumns
+
+
+    def _paginationSignature(self, orderColumns):
+        """
+        Describe an ordering as a tuple of column names and directions, to
+        recognize tokens created for a different ordering.
+        """
+        return tuple([(column.getShortColumnName(self.store), direction)
+                      for (column, direction) in orderColumns])
+
 
-            lastSortValue = sortColumn.__get__(result) # hooray namespace pollution
+    def _paginationValues(self, result, orderColumns):
+        """
+        Get the database values of the given columns for one result.
+        """
+        values = []
+        for column, direction in orderColumns:
+            if _isColumnUnique(column):
+                values.append(result.storeID)
+            else:
+                values.append(getattr(result, column.dbunderlying))
+        return values
+
+
+    def _decodePaginationToken(self, token, orderColumns):
+        """
+        Convert a token created by L{paginationToken} back into the database
+        values it encodes.
+
+        @raise ValueError: if C{token} was not created by L{paginationToken}
+        for a query with the same ordering as this one.
+        """
+        try:
+            signature, encoded = literal_eval(
+                base64.urlsafe_b64decode(str(token)))
+            values = []
+            for kind, value in encoded:
+                if kind == 'b':
+                    value = buffer(value)
+                values.append(value)
+        except (TypeError, ValueError, SyntaxError):
+            raise ValueError("Malformed pagination token: %r" % (token,))
+        if (signature != self._paginationSignature(orderColumns)
+            or len(values) != len(orderColumns)):
+            raise ValueError(
+                "Pagination token %r does not match this query" % (token,))
+        return values
+
+
+    def _paginate(self, pagesize, orderColumns, values):
+        """
+        Generate the results for L{paginate}.
+
+        @param values: the database values of C{orderColumns} for the result
+        before the first one to yield, or C{None} to start at the beginning.
+        """
+        sort = attributes.CompoundOrdering([
+                attributes.SimpleOrdering(column, direction)
+                for (column, direction) in orderColumns])
+        while True:
+            comparison = self.comparison
+            if values is not None:
+                after = _KeysetComparison(orderColumns, values)
+                if comparison is None:
+                    comparison = after
+                else:
+                    comparison = attributes.AND(comparison, after)
             results = list(self.store.query(
-                    self.tableClass,
-                    _AND(self.comparison,
-                         sortOp(sortColumn,
-                                sortColumn.__get__(result))),
-                    sort=sort,
-                    limit=pagesize + 1))
+                    self.tableClass, comparison, sort=sort, limit=pagesize))
+            if results:
+                # Remember where this page ends before yielding, in case the
+                # application changes the results.
+                values = self._paginationValues(results[-1], orderColumns)
+            for result in results:
+                yield result
+            if len(results) < pagesize:
+                return
+
 
     def _massageData(self, row):
         """
@@ -809,6 +1158,14 @@ class _DistinctQuery(object):
         return self.query._selectStuff('SELECT DISTINCT')
 
 
+    def stream(self, chunkSize=STREAM_CHUNK_SIZE):
+        """
+        Iterate the distinct results of the wrapped query without loading all
+        of them into memory first.  See L{BaseQuery.stream}.
+        """
+        return self.query._selectStuff('SELECT DISTINCT', chunkSize)
+
+
     def count(self):
         """
         Count the number of distinct results of the wrapped query.
@@ -1053,6 +1410,10 @@ class Store(Empowered):
     # non-zero will reject database changes with a ChangeRejected exception.
     _rejectChanges = 0
 
+    # The items which have joined the current transaction since the innermost
+    # savepoint was established, or None if there is no savepoint.
+    _savepointJoined = None
+
     # The following method and attributes are the ad-hoc interface required as
     # targets of attributes.reference attributes.  (In other words, the store
     # is a little bit like a fake item.)  These should probably eventually be
@@ -1078,7 +1439,8 @@ class Store(Empowered):
     storeID = STORE_SELF_ID
 
 
-    def __init__(self, dbdir=None, filesdir=None, debug=False, parent=None, idInParent=None):
+    def __init__(self, dbdir=None, filesdir=None, debug=False, parent=None, idInParent=None,
+                 strongCacheSize=0):
         """
         Create a store.
 
@@ -1100,6 +1462,11 @@ class Store(Empowered):
         L{axiom.substore.Substore}, the storeID of the item within its parent
         which opened it.
 
+        @param strongCacheSize: the number of most recently loaded or used
+        items to keep strong references to, so that they are not dropped from
+        the item cache as soon as the application stops referring to them.
+        The default, 0, keeps only weak references.
+
         @raises: C{ValueError} if both C{dbdir} and C{filesdir} are specified.
         """
         if parent is not None or idInParent is not None:
@@ -1119,10 +1486,18 @@ class Store(Empowered):
         self.statementCache = {} # non-normalized => normalized qmark SQL
                                  # statements
 
+        self.queryCache = {} # query structure => SQL text, see
+                             # BaseQuery._sqlAndArgs
+
+        # Whether queries should find and log the code which ran them.  This
+        # walks the stack for every query, so turn it off if nothing is
+        # interested in the querySite of IStatEvents.
+        self.queryCallSites = True
+
         self.activeTables = {}  # tables which have had items added/removed
                                 # this run
 
-        self.objectCache = _fincache.FinalizingCache()
+        self.objectCache = _fincache.FinalizingCache(strongCacheSize)
 
         self.tableQueries = {}  # map typename: query string w/ storeID
                                 # parameter.  a typename is a persistent
@@ -1761,6 +2136,12 @@ class Store(Empowered):
         if self._rejectChanges:
             raise errors.ChangeRejected()
         if self.transaction is not None:
+            root = self
+            while root.attachedToParent:
+                root = root.parent
+            if (root._savepointJoined is not None and
+                item not in self.transaction):
+                root._savepointJoined.append(item)
             self.transaction.add(item)
             self.touched.add(item)
 
@@ -1821,6 +2202,81 @@ class Store(Empowered):
         finally:
             self._cleanupTxnState()
 
+    def _savepoint(self, f, *a, **k):
+        """
+        Execute C{f(*a, **k)} within the current transaction, such that if it
+        raises an exception, the changes it made are reverted but the changes
+        made earlier in the transaction are kept.
+
+        This must only be called while a transaction is in progress (see
+        L{transact}).
+
+        @return: Whatever C{f(*a, **kw)} returns.
+        @raise: Whatever C{f(*a, **kw)} raises, or a database exception.
+        """
+        assert self.transaction is not None, "no transaction in progress"
+        if self.attachedToParent:
+            return self.parent._savepoint(f, *a, **k)
+        # Items changed in memory before the savepoint must be reloaded from
+        # the database if f changes them, so put their changes there first.
+        self.checkpoint()
+        # Rather than copying the transaction's items, note those which join
+        # it from now on; the rest were part of it before the savepoint.
+        outerJoined = self._savepointJoined
+        joined = self._savepointJoined = []
+        tablesBefore = [(st, len(st.tablesCreatedThisTransaction))
+                        for st in [self] + self._attachedChildren.values()]
+        try:
+            self.cursor.execute("SAVEPOINT axiom_savepoint")
+            try:
+                result = f(*a, **k)
+            except:
+                exc = Failure()
+                try:
+                    self.cursor.execute("ROLLBACK TO SAVEPOINT axiom_savepoint")
+                    self.cursor.execute("RELEASE SAVEPOINT axiom_savepoint")
+                    self._savepointRollback(joined, tablesBefore)
+                except:
+                    log.err(exc)
+                    raise
+                raise
+            self.cursor.execute("RELEASE SAVEPOINT axiom_savepoint")
+        finally:
+            self._savepointJoined = outerJoined
+        if outerJoined is not None:
+            outerJoined.extend(joined)
+        return result
+
+
+    def _savepointRollback(self, joined, tablesBefore):
+        """
+        Bring in-memory state back in line with the database after it has been
+        rolled back to a savepoint.
+
+        @param joined: a C{list} of the items which joined the transaction
+        after the savepoint was established.
+
+        @param tablesBefore: a C{list} of two-tuples of stores and the number
+        of tables they had created in this transaction when the savepoint was
+        established.
+        """
+        joined = set(joined)
+        self._rejectChanges += 1
+        try:
+            for item in list(self.transaction):
+                if item in joined:
+                    item.revert()
+                    self.transaction.remove(item)
+                else:
+                    item._revertToSavepoint()
+        finally:
+            self._rejectChanges -= 1
+        self.touched.clear()
+        for st, count in tablesBefore:
+            st._forgetTables(st.tablesCreatedThisTransaction[count:])
+            del st.tablesCreatedThisTransaction[count:]
+
+
     # The following three methods are necessary...
     # - in PySQLite: because PySQLite has some buggy transaction handling which
     #   makes it impossible to issue explicit BEGIN statements - which we
@@ -1884,7 +2340,20 @@ class Store(Empowered):
         finally:
             self._rejectChanges -= 1
         self.transaction.clear()
-        for tableClass in self.tablesCreatedThisTransaction:
+        self._forgetTables(self.tablesCreatedThisTransaction)
+
+        for sub in self._attachedChildren.values():
+            sub._inMemoryRollback()
+
+
+    def _forgetTables(self, tables):
+        """
+        Discard everything remembered about some tables whose creation has been
+        rolled back.
+
+        @param tables: a C{list} of L{Item} subclasses.
+        """
+        for tableClass in tables:
             del self.typenameAndVersionToID[tableClass.typeName,
                                             tableClass.schemaVersion]
             # Clear all cache related to this table
@@ -1900,9 +2369,6 @@ class Store(Empowered):
                 if attr in self.attrToColumnNameCache:
                     del self.attrToColumnNameCache[attr]
 
-        for sub in self._attachedChildren.values():
-            sub._inMemoryRollback()
-
 
     def _cleanupTxnState(self):
         self.autocommit = True
@@ -2214,57 +2680,171 @@ class Store(Empowered):
                 if default is _noItem:
                     raise errors.ItemNotFound("No results for known-to-be-good object")
                 return default
-            attrs = attrs[0]
-            useMostRecent = False
-            moreRecentAvailable = False
-
-            # The schema may have changed since the last time I saw the
-            # database.  Let's look to see if this is suspiciously broken...
-
-            if _typeIsTotallyUnknown(typename, version):
-                # Another process may have created it - let's re-up the schema
-                # and see what we get.
-                self._startup()
-
-                # OK, all the modules have been loaded now, everything
-                # verified.
-                if _typeIsTotallyUnknown(typename, version):
-
-                    # If there is STILL no inkling of it anywhere, we are
-                    # almost certainly boned.  Let's tell the user in a
-                    # structured way, at least.
-                    raise errors.UnknownItemType(
-                        "cannot load unknown schema/version pair: %r %r - id: %r" %
-                        (typename, version, storeID))
-
-            if typename in _typeNameToMostRecentClass:
-                moreRecentAvailable = True
-                mostRecent = _typeNameToMostRecentClass[typename]
-
-                if mostRecent.schemaVersion < version:
-                    raise RuntimeError("%s:%d - was found in the database and most recent %s is %d" %
-                                       (typename, version, typename, mostRecent.schemaVersion))
-                if mostRecent.schemaVersion == version:
-                    useMostRecent = True
-            if useMostRecent:
-                T = mostRecent
-            else:
-                T = self.getOldVersionOf(typename, version)
-            x = T.existingInStore(self, storeID, attrs)
-            if moreRecentAvailable and (not useMostRecent) and autoUpgrade:
-                # upgradeVersion will do caching as necessary, we don't have to
-                # cache here.  (It must, so that app code can safely call
-                # upgradeVersion and get a consistent object out of it.)
-                x = self.transact(self._upgradeManager.upgradeItem, x)
-            elif not x.__legacy__:
-                # We loaded the most recent version of an object
-                self.objectCache.cache(storeID, x)
-            return x
+            T, needsUpgrade = self._itemTypeFor(storeID, typename, version)
+            x = T.existingInStore(self, storeID, attrs[0])
+            return self._finishLoadingItem(x, needsUpgrade, autoUpgrade)
         if default is _noItem:
             raise KeyError(storeID)
         return default
 
 
+    def getItemsByIDs(self, storeIDs, default=_noItem, autoUpgrade=True):
+        """
+        Retrieve several items by their storeIDs, and return them.
+
+        This is equivalent to calling L{getItemByID} once for each storeID,
+        but the items which are not already in memory are loaded with one
+        query to find their types and one query per type (rather than two
+        queries per item).
+
+        @param storeIDs: an iterable of L{int}s which refer to the store.
+
+        @param default: if passed, use this value in place of each item which
+        cannot be found, rather than raising an exception.
+
+        @raise TypeError: if any storeID is not an integer.
+
+        @raise KeyError: if no item corresponded to one of the given storeIDs.
+
+        @return: a C{list} of Items (or C{default}), one for each element of
+        C{storeIDs}, in the same order.
+        """
+        storeIDs = list(storeIDs)
+        found = {}
+        missing = []
+        for storeID in storeIDs:
+            if not isinstance(storeID, (int, long)):
+                raise TypeError("storeID *must* be an int or long, not %r" % (
+                        type(storeID).__name__,))
+            if storeID == STORE_SELF_ID or storeID in found:
+                continue
+            if self.objectCache.has(storeID):
+                found[storeID] = self.objectCache.get(storeID)
+            elif storeID not in missing:
+                missing.append(storeID)
+
+        if missing:
+            log.msg(interface=iaxiom.IStatEvent,
+                    stat_cache_misses=len(missing))
+        for i in xrange(0, len(missing), MAX_IDS_PER_QUERY):
+            self._loadItemsByIDs(
+                missing[i:i + MAX_IDS_PER_QUERY], found, autoUpgrade)
+
+        result = []
+        for storeID in storeIDs:
+            if storeID == STORE_SELF_ID:
+                result.append(self)
+            elif storeID in found:
+                result.append(found[storeID])
+            elif default is _noItem:
+                raise KeyError(storeID)
+            else:
+                result.append(default)
+        return result
+
+
+    def _loadItemsByIDs(self, storeIDs, found, autoUpgrade):
+        """
+        Load the items with the given storeIDs, none of which are in the
+        object cache, and add them to C{found}.
+
+        @param storeIDs: a C{list} of at most L{MAX_IDS_PER_QUERY} storeIDs.
+        @param found: a C{dict} mapping storeIDs to items, to be updated.
+        @param autoUpgrade: as for L{getItemByID}.
+        """
+        placeholders = ', '.join(['?'] * len(storeIDs))
+        byType = {}
+        for storeID, typename, module, version in self.querySchemaSQL(
+            _schema.TYPEOF_MANY_QUERY % (placeholders,), storeIDs):
+            byType.setdefault((typename, version), []).append(storeID)
+
+        for (typename, version), typeStoreIDs in byType.iteritems():
+            rows = self.querySQL(
+                'SELECT oid, * FROM %s WHERE oid IN (%s)' % (
+                    self._tableNameFor(typename, version),
+                    ', '.join(['?'] * len(typeStoreIDs))),
+                typeStoreIDs)
+            T, needsUpgrade = self._itemTypeFor(
+                typeStoreIDs[0], typename, version)
+            for row in rows:
+                x = T.existingInStore(self, row[0], row[1:])
+                found[row[0]] = self._finishLoadingItem(
+                    x, needsUpgrade, autoUpgrade)
+
+
+    def _itemTypeFor(self, storeID, typename, version):
+        """
+        Find the Item subclass to use for an item which was not found in the
+        object cache.
+
+        @param storeID: the storeID of the item.
+        @param typename: the I{typeName} of the type recorded for the item.
+        @param version: the schema version recorded for the item.
+
+        @return: a 2-tuple of the Item subclass for C{typename} and
+        C{version}, and a C{bool} indicating whether items of that class must
+        be upgraded to a more recent version.
+        """
+        useMostRecent = False
+        moreRecentAvailable = False
+
+        # The schema may have changed since the last time I saw the
+        # database.  Let's look to see if this is suspiciously broken...
+
+        if _typeIsTotallyUnknown(typename, version):
+            # Another process may have created it - let's re-up the schema
+            # and see what we get.
+            self._startup()
+
+            # OK, all the modules have been loaded now, everything
+            # verified.
+            if _typeIsTotallyUnknown(typename, version):
+
+                # If there is STILL no inkling of it anywhere, we are
+                # almost certainly boned.  Let's tell the user in a
+                # structured way, at least.
+                raise errors.UnknownItemType(
+                    "cannot load unknown schema/version pair: %r %r - id: %r" %
+                    (typename, version, storeID))
+
+        if typename in _typeNameToMostRecentClass:
+            moreRecentAvailable = True
+            mostRecent = _typeNameToMostRecentClass[typename]
+
+            if mostRecent.schemaVersion < version:
+                raise RuntimeError("%s:%d - was found in the database and most recent %s is %d" %
+                                   (typename, version, typename, mostRecent.schemaVersion))
+            if mostRecent.schemaVersion == version:
+                useMostRecent = True
+        if useMostRecent:
+            T = mostRecent
+        else:
+            T = self.getOldVersionOf(typename, version)
+        return T, moreRecentAvailable and not useMostRecent
+
+
+    def _finishLoadingItem(self, x, needsUpgrade, autoUpgrade):
+        """
+        Upgrade or cache an item which was just loaded from the database.
+
+        @param x: the item, as returned by C{existingInStore}.
+        @param needsUpgrade: whether the item's class is not the most recent
+        version of its type.
+        @param autoUpgrade: whether to upgrade the item if it needs it.
+
+        @return: the item, or its upgraded replacement.
+        """
+        if needsUpgrade and autoUpgrade:
+            # upgradeVersion will do caching as necessary, we don't have to
+            # cache here.  (It must, so that app code can safely call
+            # upgradeVersion and get a consistent object out of it.)
+            x = self.transact(self._upgradeManager.upgradeItem, x)
+        elif not x.__legacy__:
+            # We loaded the most recent version of an object
+            self.objectCache.cache(x.storeID, x)
+        return x
+
+
     def querySchemaSQL(self, sql, args=()):
         sql = sql.replace("*DATABASE*", self.databaseName)
         return self.querySQL(sql, args)
@@ -2280,6 +2860,30 @@ class Store(Empowered):
         return result
 
 
+    def streamSQL(self, sql, args=(), chunkSize=STREAM_CHUNK_SIZE):
+        """
+        For use with SELECT statements whose results may be too large to load
+        into memory all at once.
+
+        The statement is executed immediately, on a cursor dedicated to it so
+        that other statements may be executed while its results are being
+        consumed.
+
+        @param chunkSize: the maximum number of rows to retrieve from the
+        cursor at once.
+
+        @return: an iterator of result rows.
+        """
+        if self.debug:
+            print '**', sql, '--', ', '.join(map(str, args))
+        cursor = self.connection.cursor()
+        if self.debug:
+            timeinto(self.queryTimes, cursor.execute, sql, args)
+        else:
+            cursor.execute(sql, args)
+        return _fetchInChunks(cursor, chunkSize)
+
+
     def _queryandfetch(self, sql, args):
         if self.debug:
             print '**', sql, '--', ', '.join(map(str, args))
@@ -2335,6 +2939,23 @@ class Store(Empowered):
             self.executedThisTransaction.append((result, sql, args))
         return result
 
+
+    def executeManySQL(self, sql, argsList):
+        """
+        For use with an UPDATE or INSERT statement which should be executed
+        once for each of many sets of arguments.
+
+        @type argsList: C{list}
+        """
+        if self.debug:
+            print '**', sql, '--', len(argsList), 'times'
+            timeinto(self.execTimes, self.cursor.executemany, sql, argsList)
+        else:
+            self.cursor.executemany(sql, argsList)
+        if self.executedThisTransaction is not None:
+            for args in argsList:
+                self.executedThisTransaction.append((None, sql, args))
+
 # This isn't actually useful any more.  It turns out that the pysqlite
 # documentation is confusingly worded; it's perfectly possible to create tables
 # within transactions, but PySQLite's automatic transaction management (which
@@ -2357,6 +2978,24 @@ class Store(Empowered):
 #                         resultThisTime))
 
 
+def _fetchInChunks(cursor, chunkSize):
+    """
+    Yield the rows of the result of the statement last executed on C{cursor},
+    retrieving at most C{chunkSize} of them at a time, and close C{cursor}
+    when they are exhausted or the iteration is abandoned.
+    """
+    try:
+        while True:
+            rows = cursor.fetchmany(chunkSize)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+
 def timeinto(l, f, *a, **k):
     then = time.time()
     try:
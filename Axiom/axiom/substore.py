@@ -20,8 +20,49 @@ class SubStore(Item):
     storepath = path()
     substore = inmemory()
 
+    # True between this SubStore being stored and the transaction which
+    # stored it committing.
+    _newToBatchProcess = inmemory()
+
     implements(IPowerupIndirector)
 
+    def activate(self):
+        self._newToBatchProcess = False
+
+
+    def stored(self):
+        """
+        Tell the site's batch process about this SubStore once it has been
+        committed, so that it can start processing it.
+        """
+        if self.store.autocommit:
+            # Already committed.
+            self._notifyBatchProcess(True)
+        else:
+            self._newToBatchProcess = True
+
+
+    def committed(self):
+        # Outside of a transaction this is called before activate.
+        if getattr(self, '_newToBatchProcess', False):
+            self._newToBatchProcess = False
+            self._notifyBatchProcess(True)
+        Item.committed(self)
+
+
+    def _notifyBatchProcess(self, added):
+        from axiom import batch
+        batch._notifySubStoreChange(self.store, self.storepath, added)
+
+
+    def deleted(self):
+        """
+        Tell the site's batch process to stop processing this SubStore.
+        """
+        self._newToBatchProcess = False
+        self._notifyBatchProcess(False)
+
+
     def createNew(cls, store, pathSegments):
         """
         Create a new SubStore, allocating a new file space for it.
@@ -108,6 +108,18 @@ class ConnectionTestCaseMixin:
         e = self.assertRaises(SQLError, cur.execute, INVALID_STATEMENT)
 
 
+    def test_executemany(self):
+        """
+        C{executemany} executes a statement once for each set of arguments.
+        """
+        con = self.createRealConnection()
+        cur = con.cursor()
+        cur.execute("CREATE TABLE foo (bar INTEGER)")
+        cur.executemany("INSERT INTO foo VALUES (?)", [(1,), (2,), (3,)])
+        cur.execute("SELECT bar FROM foo ORDER BY bar")
+        self.assertEquals(list(cur), [(1,), (2,), (3,)])
+
+
     def test_cursor(self):
         """
         Test that the cursor method can actually create a cursor object.
@@ -1,6 +1,7 @@
 
 from twisted.trial import unittest
-from twisted.python import failure, filepath
+from twisted.python import failure, filepath, log
+from twisted.internet import task, defer
 from twisted.application import service
 
 from axiom import iaxiom, store, item, attributes, batch, substore
@@ -474,6 +475,490 @@ class BatchTestCase(unittest.TestCase):
 
 
 
+class BatchedWorkListener(item.Item):
+    """
+    A listener which processes several work units in each step.
+    """
+    batchSize = attributes.integer(default=3)
+
+    listener = attributes.inmemory(doc="""
+    A callable which will be invoked by processItem.
+    """)
+
+    def processItem(self, item):
+        self.listener(item)
+
+
+
+class StepFinishedListener(item.Item):
+    """
+    A listener which records the work units it processes and the ends of its
+    steps.
+    """
+    batchSize = attributes.integer(default=1)
+
+    events = attributes.inmemory(doc="""
+    The information of each work unit processed, and C{(None, inTransaction)}
+    for each call to L{stepFinished}.
+    """)
+
+    def activate(self):
+        self.events = []
+
+
+    def processItem(self, item):
+        self.events.append(item.information)
+
+
+    def stepFinished(self):
+        self.events.append((None, self.store.transaction is not None))
+
+
+
+class StepFinishedTests(unittest.TestCase):
+    """
+    Tests for reliable listeners with a C{stepFinished} method.
+    """
+    def setUp(self):
+        self.store = store.Store()
+        self.proc = batch.processor(TestWorkUnit)(store=self.store)
+        self.listener = StepFinishedListener(store=self.store)
+        self.proc.addReliableListener(self.listener)
+        for i in range(3):
+            TestWorkUnit(store=self.store, information=i)
+
+
+    def _stepAll(self):
+        while self.store.transact(self.proc.step):
+            pass
+        self.store.transact(self.proc.step)
+
+
+    def test_stepFinished(self):
+        """
+        C{stepFinished} is called after each step which processes a work unit,
+        in the transaction which records it as processed.
+        """
+        self._stepAll()
+        self.assertEquals(
+            self.listener.events,
+            [0, (None, True), 1, (None, True), 2, (None, True)])
+
+
+    def test_batchedStepFinished(self):
+        """
+        C{stepFinished} is called once after each batch of work units.
+        """
+        self.listener.batchSize = 2
+        self._stepAll()
+        self.assertEquals(
+            self.listener.events,
+            [0, 1, (None, True), 2, (None, True)])
+
+
+
+class BatchedListenerTests(unittest.TestCase):
+    """
+    Tests for reliable listeners with a C{batchSize}.
+    """
+    def setUp(self):
+        self.procType = batch.processor(TestWorkUnit)
+        self.store = store.Store()
+        self.proc = self.procType(store=self.store)
+        self.processedItems = []
+        self.listener = BatchedWorkListener(
+            store=self.store, listener=self._listener)
+        self.proc.addReliableListener(self.listener)
+        self.reliableListener = self.store.findUnique(batch._ReliableListener)
+
+
+    def _listener(self, item):
+        self.processedItems.append(item.information)
+
+
+    def test_batches(self):
+        """
+        Each step processes up to C{batchSize} work units: new work units
+        first, then old ones.
+        """
+        for i in range(2):
+            TestWorkUnit(store=self.store, information=i)
+        # Make the first two units old work.
+        self.reliableListener.forwardMark = self.reliableListener.backwardMark = (
+            self.store.findFirst(TestWorkUnit, TestWorkUnit.information == 1).storeID)
+        for i in range(2, 7):
+            TestWorkUnit(store=self.store, information=i)
+
+        self.failUnless(self.proc.step())
+        self.assertEquals(self.processedItems, [2, 3, 4])
+        self.failIf(self.proc.step())
+        self.assertEquals(self.processedItems, [2, 3, 4, 5, 6, 0])
+        self.failIf(self.proc.step())
+        self.assertEquals(self.processedItems, [2, 3, 4, 5, 6, 0])
+
+
+    def test_trackedWork(self):
+        """
+        Work units specially added with L{_ReliableListener.addItem} are
+        processed first, as part of a batch.
+        """
+        units = [TestWorkUnit(store=self.store, information=i)
+                 for i in range(3)]
+        self.failIf(self.proc.step())
+        self.reliableListener.addItem(units[1])
+        TestWorkUnit(store=self.store, information=3)
+        self.failIf(self.proc.step())
+        self.assertEquals(self.processedItems, [0, 1, 2, 1, 3])
+        self.assertEquals(self.store.query(batch._ReliableTracker).count(), 0)
+
+
+    def test_failure(self):
+        """
+        If a work unit other than the first in a batch fails, the batch stops
+        before it and the work units before it stay processed.  The next step
+        fails on it, and it is marked as failed as usual.
+        """
+        def listener(item):
+            if item.information == 1:
+                item.information = 100
+                raise RuntimeError("broken")
+            item.information = -item.information
+            self.processedItems.append(item.information)
+        self.listener.listener = listener
+        for i in range(3):
+            TestWorkUnit(store=self.store, information=i)
+
+        self.failUnless(self.proc.step())
+        self.assertEquals(self.processedItems, [0])
+        self.assertEquals(
+            list(self.store.query(
+                    TestWorkUnit,
+                    sort=TestWorkUnit.storeID.ascending).getColumn('information')),
+            [0, 1, 2])
+        self.assertRaises(batch._ProcessingFailure, self.proc.step)
+        self.proc.timedEventErrorHandler(None, failure.Failure(
+                batch._ForwardProcessingFailure(
+                    self.reliableListener,
+                    self.store.findUnique(TestWorkUnit,
+                                          TestWorkUnit.information == 1),
+                    failure.Failure(RuntimeError("broken")))))
+        self.assertEquals(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.failIf(self.proc.step())
+        self.assertEquals(self.processedItems, [0, -2])
+        [(failedListener, failedItem)] = list(self.proc.getFailedItems())
+        self.assertEquals(failedItem.information, 1)
+
+
+    def test_throughput(self):
+        """
+        L{_ReliableListener} counts the work units it processes and the time it
+        takes, and reports them in an L{iaxiom.IStatEvent} for each step.
+        """
+        events = []
+        def observe(event):
+            if 'stat_batch_units' in event:
+                events.append(event)
+        log.addObserver(observe)
+        self.addCleanup(log.removeObserver, observe)
+
+        self.assertIdentical(self.reliableListener.throughput(), None)
+        for i in range(4):
+            TestWorkUnit(store=self.store, information=i)
+        self.proc.step()
+        self.proc.step()
+        self.assertEquals(self.reliableListener.unitsProcessed, 4)
+        self.assertEquals(
+            [(event['interface'], event['stat_batch_units'],
+              event['reliableListener']) for event in events],
+            [(iaxiom.IStatEvent, 3, self.reliableListener.storeID),
+             (iaxiom.IStatEvent, 1, self.reliableListener.storeID)])
+        self.assertEquals(
+            self.reliableListener.processingTime,
+            sum([event['stat_batch_time'] for event in events]))
+
+
+
+class ProcessingServicePacingTests(unittest.TestCase):
+    """
+    Tests for the waits between steps of L{batch.BatchProcessingService}.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.service = batch.BatchProcessingService(store.Store())
+        self.service.clock = self.clock
+        self.service.running = True
+        self.results = []
+        self.service.step = lambda: iter(self.results)
+
+
+    def test_busyDelay(self):
+        """
+        While there is more work, the wait between steps halves down to the
+        time the last step took, and doubles, up to L{batch.MAX_BUSY_DELAY},
+        while the reactor lags.
+        """
+        busyDelay = self.service._busyDelay
+        self.assertEquals(busyDelay(0.4, 0.0, 0.0), 0.2)
+        self.assertEquals(busyDelay(0.4, 0.3, 0.0), 0.3)
+        self.assertEquals(busyDelay(0.2, 0.0, 0.1), 0.4)
+        self.assertEquals(busyDelay(0.0, 0.0, 0.2), 0.2)
+        self.assertEquals(busyDelay(0.8, 0.0, 0.2), batch.MAX_BUSY_DELAY)
+
+
+    def test_idleDelay(self):
+        """
+        When there is no more work, the service waits L{batch.IDLE_DELAY}
+        seconds before looking again.
+        """
+        self.results.extend([(None, True), (None, False), (None, True)])
+        work = self.service.processWhileRunning()
+        self.assertIdentical(work.next(), None)
+        busyWait = work.next()
+        self.clock.advance(0)
+        self.assertEquals(self._fired(busyWait), True)
+        self.assertIdentical(work.next(), None)
+        idleWait = work.next()
+        self.clock.advance(batch.IDLE_DELAY - 1)
+        self.assertEquals(self._fired(idleWait), False)
+        self.clock.advance(1)
+        self.assertEquals(self._fired(idleWait), True)
+
+
+    def test_stopWhileWaiting(self):
+        """
+        If the service is stopped, closing its store, while it waits between
+        steps, it takes no more steps once the wait is over.
+        """
+        del self.service.step
+        work = self.service.processWhileRunning()
+        self.assertIdentical(work.next(), None)
+        idleWait = work.next()
+        self.service.stopService()
+        self.clock.advance(batch.IDLE_DELAY)
+        self.assertEquals(self._fired(idleWait), True)
+        self.assertRaises(StopIteration, work.next)
+
+
+    def _fired(self, d):
+        fired = []
+        d.addCallback(fired.append)
+        return bool(fired)
+
+
+
+class SubStoreDiscoveryTests(unittest.TestCase):
+    """
+    Tests for how L{batch.BatchProcessingProtocol} finds the substores to
+    process.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dbdir = filepath.FilePath(self.mktemp())
+        self.siteStore = store.Store(self.dbdir)
+        self.service = service.MultiService()
+        self.protocol = batch.BatchProcessingProtocol(self.service)
+        self.protocol.clock = self.clock
+        # Never run the processing services, only start them.
+        never = task.Clock()
+        self.service.cooperator = task.Cooperator(
+            scheduler=lambda f: never.callLater(0, f))
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.protocol.command_SET_STORE(self.dbdir)
+        self.addCleanup(self.protocol.pollCall.stop)
+
+
+    def _createSubStores(self, n):
+        return [substore.SubStore.createNew(self.siteStore, ['sub%d' % (i,)])
+                for i in range(n)]
+
+
+    def _openPaths(self):
+        return sorted(self.protocol.subStores)
+
+
+    def test_pollNewSubStores(self):
+        """
+        Polling opens substores created since the last poll, and remembers the
+        newest one seen so that older ones are not queried for again.
+        """
+        self.assertEquals(self._openPaths(), [])
+        subStores = self._createSubStores(2)
+        self.clock.advance(10)
+        self.assertEquals(self._openPaths(),
+                          sorted([ss.storepath.path for ss in subStores]))
+        self.assertEquals(self.protocol._subStoreMark, subStores[-1].storeID)
+        for svc in self.protocol.subStores.values():
+            self.failUnless(svc.running)
+
+
+    def test_addAndRemove(self):
+        """
+        L{batch.AddSubStore} opens a substore immediately, and
+        L{batch.RemoveSubStore} stops processing it and closes it.
+        """
+        [ss] = self._createSubStores(1)
+        self.protocol.command_ADD_SUB_STORE(ss.storepath)
+        self.assertEquals(self._openPaths(), [ss.storepath.path])
+        svc = self.protocol.subStores[ss.storepath.path]
+
+        ss.deleteFromStore()
+        self.protocol.command_REMOVE_SUB_STORE(ss.storepath)
+        self.assertEquals(self._openPaths(), [])
+        self.failIf(svc.running)
+        self.assertIdentical(svc.store.connection, None)
+        self.clock.advance(10)
+        self.assertEquals(self._openPaths(), [])
+
+
+    def test_fullPoll(self):
+        """
+        Every C{fullPollInterval} polls, all substores are looked at, and any
+        which have been deleted without being announced are closed and no
+        longer opened.
+        """
+        # The first poll was made when the store was set.
+        self.protocol.fullPollInterval = 4
+        a, b = self._createSubStores(2)
+        self.clock.advance(10)
+        self.assertEquals(self._openPaths(),
+                          sorted([a.storepath.path, b.storepath.path]))
+        a.deleteFromStore()
+        self.clock.advance(10)
+        self.assertIn(a.storepath.path, self.protocol._knownSubStores)
+        self.clock.advance(10)
+        self.assertEquals(self._openPaths(), [b.storepath.path])
+        self.assertEquals(self.protocol._knownSubStores, [b.storepath.path])
+        self.assertEquals(self.protocol._knownSubStorePaths,
+                          set([b.storepath.path]))
+        self.assertEquals(self.protocol._subStoreMark, b.storeID)
+
+
+    def test_maxOpenSubStores(self):
+        """
+        No more than C{maxOpenSubStores} substores are open at once.  When
+        there are more, each poll opens C{subStoresPerPoll} of the others in
+        turn, closing the least recently used ones to make room.
+        """
+        self.protocol.maxOpenSubStores = 2
+        self.protocol.subStoresPerPoll = 1
+        a, b, c = [ss.storepath.path for ss in self._createSubStores(3)]
+        self.clock.advance(10)
+        self.assertEquals(self._openPaths(), [a])
+        self.clock.advance(10)
+        self.assertEquals(self._openPaths(), [a, b])
+        closing = self.protocol.subStores[a].store
+        self.clock.advance(10)
+        self.assertEquals(self._openPaths(), [b, c])
+        self.assertIdentical(closing.connection, None)
+        self.clock.advance(10)
+        self.assertEquals(self._openPaths(), [a, c])
+
+
+    def test_closeUnstartedSubStore(self):
+        """
+        Closing a substore whose processing service was never started, because
+        the batch process's service was not running, still closes the store.
+        """
+        self.service.stopService()
+        [ss] = self._createSubStores(1)
+        self.protocol.command_ADD_SUB_STORE(ss.storepath)
+        svc = self.protocol.subStores[ss.storepath.path]
+        self.failIf(svc.running)
+        self.protocol.command_REMOVE_SUB_STORE(ss.storepath)
+        self.assertIdentical(svc.store.connection, None)
+
+
+    def test_suspendedNotClosed(self):
+        """
+        A substore with a suspended processor is not closed to make room for
+        another, since closing it would lose track of the suspension.
+        """
+        self.protocol.maxOpenSubStores = 1
+        a, b = self._createSubStores(2)
+        self.protocol.command_ADD_SUB_STORE(a.storepath)
+        self.protocol.subStores[a.storepath.path].suspended.append(None)
+        self.protocol.command_ADD_SUB_STORE(b.storepath)
+        self.assertEquals(self._openPaths(),
+                          sorted([a.storepath.path, b.storepath.path]))
+
+
+    def test_commandOpensSubStore(self):
+        """
+        A command for a substore which is not open opens it.
+        """
+        [ss] = self._createSubStores(1)
+        storeID = BatchCallTestItem(store=ss.open()).storeID
+        ss.close()
+        self.protocol.command_CALL_ITEM_METHOD(
+            storepath=ss.storepath, storeid=storeID, method='callIt')
+        self.assertEquals(self._openPaths(), [ss.storepath.path])
+        self.failUnless(ss.open().getItemByID(storeID).called)
+
+
+
+class FakeJuice(object):
+    """
+    Record the commands sent to a batch process.
+    """
+    transport = None
+
+    def __init__(self):
+        self.commands = []
+
+
+    def sendBoxCommand(self, command, box, requiresAnswer=True):
+        self.commands.append((command, box['storepath']))
+        return defer.succeed({})
+
+
+
+class FakeProcessController(object):
+    def __init__(self, mode):
+        self.mode = mode
+        self.juice = FakeJuice()
+
+
+
+class SubStoreNotificationTests(unittest.TestCase):
+    """
+    Tests for the notifications of substore changes sent to the batch process.
+    """
+    def setUp(self):
+        self.dbdir = filepath.FilePath(self.mktemp())
+        self.store = store.Store(self.dbdir)
+        self.controller = service.IService(self.store).getServiceNamed(
+            "Batch Processing Controller")
+        self.controller.running = True
+
+
+    def test_notifyWhenReady(self):
+        """
+        Creating a substore and deleting it are reported to the batch process
+        once committed.
+        """
+        self.controller.batchController = FakeProcessController('ready')
+        ss = substore.SubStore.createNew(self.store, ['sub'])
+        path = ss.storepath.path
+        self.assertEquals(self.controller.batchController.juice.commands,
+                          [('Add-Sub-Store', path)])
+        self.store.transact(ss.deleteFromStore)
+        self.assertEquals(self.controller.batchController.juice.commands,
+                          [('Add-Sub-Store', path),
+                           ('Remove-Sub-Store', path)])
+
+
+    def test_notReady(self):
+        """
+        Nothing is sent to a batch process which is not running, so that
+        creating a substore does not start one.
+        """
+        self.controller.batchController = FakeProcessController('stopped')
+        substore.SubStore.createNew(self.store, ['sub'])
+        self.assertEquals(self.controller.batchController.juice.commands, [])
+
+
+
 class BatchCallTestItem(item.Item):
     called = attributes.boolean(default=False)
 
@@ -0,0 +1,215 @@
+
+"""
+Tests for L{axiom._fincache}.
+"""
+
+import gc
+
+from twisted.trial import unittest
+from twisted.python import log
+
+from axiom.iaxiom import IStatEvent
+from axiom._fincache import FinalizingCache
+from axiom.store import Store
+from axiom.item import Item
+from axiom.attributes import integer
+
+
+class Value(object):
+    """
+    Something which can be put into a L{FinalizingCache}.
+    """
+    def __finalizer__(self):
+        # The finalizer must not refer to the value itself, or it would never
+        # be collected.
+        return lambda: None
+
+
+
+class CachedThing(Item):
+    value = integer()
+
+
+
+class StrongReferenceTests(unittest.TestCase):
+    """
+    Tests for the bounded strong-reference tier of L{FinalizingCache}.
+    """
+    def _evictions(self):
+        events = []
+        def observe(event):
+            if (event.get('interface') is IStatEvent and
+                'stat_cache_evictions' in event):
+                events.append(event['key'])
+        log.addObserver(observe)
+        self.addCleanup(log.removeObserver, observe)
+        return events
+
+
+    def test_weakByDefault(self):
+        """
+        Without a strong capacity, values which are referred to by nothing
+        else are dropped from the cache.
+        """
+        cache = FinalizingCache()
+        cache.cache(1, Value())
+        gc.collect()
+        self.failIf(cache.has(1))
+
+
+    def test_keptAlive(self):
+        """
+        Values within the strong capacity stay in the cache even when nothing
+        else refers to them.
+        """
+        cache = FinalizingCache(2)
+        cache.cache(1, Value())
+        cache.cache(2, Value())
+        gc.collect()
+        self.failUnless(cache.has(1))
+        self.failUnless(cache.has(2))
+
+
+    def test_leastRecentlyUsedEvicted(self):
+        """
+        Caching more values than the strong capacity drops the strong
+        reference to the least recently used one, which L{FinalizingCache.get}
+        counts as a use, and logs an eviction.
+        """
+        evictions = self._evictions()
+        cache = FinalizingCache(2)
+        cache.cache(1, Value())
+        cache.cache(2, Value())
+        cache.get(1)
+        cache.cache(3, Value())
+        gc.collect()
+        self.assertEquals(evictions, [2])
+        self.failUnless(cache.has(1))
+        self.failIf(cache.has(2))
+        self.failUnless(cache.has(3))
+
+
+    def test_uncache(self):
+        """
+        L{FinalizingCache.uncache} drops the strong reference to the value as
+        well.
+        """
+        cache = FinalizingCache(2)
+        value = Value()
+        cache.cache(1, value)
+        cache.uncache(1, value)
+        self.assertEquals(len(cache.strong), 0)
+        cache.cache(1, value)
+        self.assertIdentical(cache.get(1), value)
+
+
+    def test_shrinkCapacity(self):
+        """
+        Lowering the strong capacity evicts the least recently used values
+        immediately, and a capacity of 0 drops all strong references.
+        """
+        evictions = self._evictions()
+        cache = FinalizingCache(3)
+        for key in range(3):
+            cache.cache(key, Value())
+        cache.setStrongCapacity(1)
+        gc.collect()
+        self.assertEquals(evictions, [0, 1])
+        self.assertEquals([cache.has(key) for key in range(3)],
+                          [False, False, True])
+        cache.setStrongCapacity(0)
+        gc.collect()
+        self.failIf(cache.has(2))
+
+
+    def test_negativeCapacity(self):
+        """
+        A negative strong capacity is rejected.
+        """
+        self.assertRaises(ValueError, FinalizingCache, -1)
+
+
+    def test_clearStrong(self):
+        """
+        L{FinalizingCache.clearStrong} drops all strong references.
+        """
+        cache = FinalizingCache(2)
+        cache.cache(1, Value())
+        cache.clearStrong()
+        gc.collect()
+        self.failIf(cache.has(1))
+
+
+    def test_storeCacheSize(self):
+        """
+        Items loaded from a L{Store} created with a C{strongCacheSize} remain
+        cached after the application drops them.
+        """
+        s = Store(strongCacheSize=10)
+        storeID = CachedThing(store=s, value=1).storeID
+        gc.collect()
+        self.failUnless(s.objectCache.has(storeID))
+        thing = s.getItemByID(storeID)
+        self.assertEquals(thing.value, 1)
+        thing.deleteFromStore()
+        del thing
+        gc.collect()
+        self.failIf(s.objectCache.has(storeID))
+
+
+    def test_revertedCreation(self):
+        """
+        An item created in a transaction which is rolled back is dropped from
+        the strong references of its store's cache, and can no longer be
+        loaded.
+        """
+        s = Store(strongCacheSize=10)
+        created = []
+        def txn():
+            created.append(CachedThing(store=s, value=1).storeID)
+            raise ZeroDivisionError()
+        self.assertRaises(ZeroDivisionError, s.transact, txn)
+        [storeID] = created
+        self.failIf(storeID in s.objectCache.strong._entries)
+        self.failIf(s.objectCache.has(storeID))
+        self.assertRaises(KeyError, s.getItemByID, storeID)
+
+
+    def test_revertedSavepointCreation(self):
+        """
+        An item created within a savepoint which is rolled back is dropped
+        from the strong references of its store's cache, while an item
+        created earlier in the transaction is kept.
+        """
+        s = Store(strongCacheSize=10)
+        created = []
+        def savepoint():
+            created.append(CachedThing(store=s, value=2).storeID)
+            raise ZeroDivisionError()
+        def txn():
+            kept = CachedThing(store=s, value=1).storeID
+            self.assertRaises(ZeroDivisionError, s._savepoint, savepoint)
+            return kept
+        kept = s.transact(txn)
+        [storeID] = created
+        self.failIf(storeID in s.objectCache.strong._entries)
+        self.assertRaises(KeyError, s.getItemByID, storeID)
+        gc.collect()
+        self.failUnless(kept in s.objectCache.strong._entries)
+        self.assertEquals(s.getItemByID(kept).value, 1)
+
+
+    def test_revertedChange(self):
+        """
+        An item changed in a transaction which is rolled back stays strongly
+        cached, with its changes reverted.
+        """
+        s = Store(strongCacheSize=10)
+        storeID = CachedThing(store=s, value=1).storeID
+        def txn():
+            s.getItemByID(storeID).value = 2
+            raise ZeroDivisionError()
+        self.assertRaises(ZeroDivisionError, s.transact, txn)
+        gc.collect()
+        self.failUnless(storeID in s.objectCache.strong._entries)
+        self.assertEquals(s.getItemByID(storeID).value, 1)
@@ -1,5 +1,5 @@
 
-import sys, os
+import sys, os, gc
 
 from twisted.trial import unittest
 from twisted.trial.unittest import TestCase
@@ -380,6 +380,125 @@ class ItemTestCase(unittest.TestCase):
 
 
 
+class GetItemsByIDsTests(TestCase):
+    """
+    Tests for L{Store.getItemsByIDs}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.plain = [itemtest.PlainItem(store=self.store, plain=unicode(i))
+                      for i in range(3)]
+        self.defaulted = [ItemWithDefault(store=self.store, value=i)
+                          for i in range(3)]
+        self.storeIDs = [
+            i.storeID for pair in zip(self.plain, self.defaulted)
+            for i in pair]
+
+
+    def _forgetItems(self):
+        """
+        Drop the test's references to the items it created, so that they
+        must be loaded from the database again.
+        """
+        del self.plain[:], self.defaulted[:]
+        gc.collect()
+        for storeID in self.storeIDs:
+            self.assertFalse(self.store.objectCache.has(storeID))
+
+
+    def test_cached(self):
+        """
+        Items which are already loaded are returned as they are, in the order
+        their storeIDs were given.
+        """
+        self.assertEquals(
+            self.store.getItemsByIDs(reversed(self.storeIDs)),
+            list(reversed([i for pair in zip(self.plain, self.defaulted)
+                           for i in pair])))
+
+
+    def test_uncached(self):
+        """
+        Items which are not loaded are loaded with one query to find their
+        types and one query per type.
+        """
+        self._forgetItems()
+        statements = []
+        querySQL = self.store.querySQL
+        def recordingQuerySQL(sql, args=()):
+            statements.append(sql)
+            return querySQL(sql, args)
+        self.store.querySQL = recordingQuerySQL
+        items = self.store.getItemsByIDs(self.storeIDs)
+        self.assertEquals(len(statements), 3)
+        self.assertEquals(
+            [(type(i), i.storeID) for i in items],
+            zip([itemtest.PlainItem, ItemWithDefault] * 3, self.storeIDs))
+        self.assertEquals([i.value for i in items[1::2]], [0, 1, 2])
+        for storeID, loaded in zip(self.storeIDs, items):
+            self.assertIdentical(self.store.getItemByID(storeID), loaded)
+
+
+    def test_duplicates(self):
+        """
+        A storeID given more than once results in the same item each time.
+        """
+        self._forgetItems()
+        storeID = self.storeIDs[0]
+        first, second = self.store.getItemsByIDs([storeID, storeID])
+        self.assertIdentical(first, second)
+
+
+    def test_storeSelf(self):
+        """
+        L{STORE_SELF_ID} results in the store itself.
+        """
+        self.assertEquals(self.store.getItemsByIDs([store.STORE_SELF_ID]),
+                          [self.store])
+
+
+    def test_missing(self):
+        """
+        A storeID which does not refer to an item results in L{KeyError}, or
+        in the default, if one is given.
+        """
+        missing = self.storeIDs[-1] + 100
+        self.assertRaises(KeyError, self.store.getItemsByIDs,
+                          [self.storeIDs[0], missing])
+        self.assertEquals(
+            self.store.getItemsByIDs([missing, self.storeIDs[0]], 1234),
+            [1234, self.plain[0]])
+
+
+    def test_deleted(self):
+        """
+        A storeID of a deleted item is treated as missing.
+        """
+        self.plain[0].deleteFromStore()
+        self.assertEquals(
+            self.store.getItemsByIDs(self.storeIDs[:2], default=None),
+            [None, self.defaulted[0]])
+
+
+    def test_nonInteger(self):
+        """
+        A storeID which is not an integer results in L{TypeError}.
+        """
+        self.assertRaises(TypeError, self.store.getItemsByIDs, ['1'])
+
+
+    def test_manyIDs(self):
+        """
+        More storeIDs than fit into a single statement can be loaded at once.
+        """
+        self.patch(store, 'MAX_IDS_PER_QUERY', 2)
+        self._forgetItems()
+        self.assertEquals(
+            [i.storeID for i in self.store.getItemsByIDs(self.storeIDs)],
+            self.storeIDs)
+
+
+
 class TestItem(Item):
     """
     Boring, behaviorless Item subclass used when we just need an item
@@ -9,7 +9,7 @@ from twisted.trial.unittest import TestCase
 
 from axiom.store import Store
 from axiom.item import Item
-from axiom.attributes import integer, compoundIndex
+from axiom.attributes import integer, bytes, compoundIndex
 
 from axiom.test.util import QueryCounter
 
@@ -24,6 +24,10 @@ class MultiColumnSortHelper(Item):
     compoundIndex(columnOne, columnTwo)
 
 
+class BytesSortHelper(Item):
+    value = bytes()
+
+
 class CrossTransactionIteration(TestCase):
 
     def test_separateTransactions(self):
@@ -146,8 +150,6 @@ class CrossTransactionIteration(TestCase):
     def test_moreThanOneColumnSort(self):
         """
         Verify that paginate works with queries that have complex sort expressions.
-
-        Note: it doesn't.
         """
         s = Store()
 
@@ -164,8 +166,165 @@ class CrossTransactionIteration(TestCase):
                         ).paginate(pagesize=1)),
                           [x, y1, y2, y3, y4, z])
 
-    test_moreThanOneColumnSort.todo = (
-        "There's no use-case for this yet, but it would be a consistent "
-        "extension of the API.")
+
+    def test_mixedDirectionSort(self):
+        """
+        Columns of a compound sort may be sorted in different directions.
+        """
+        s = Store()
+        items = [MultiColumnSortHelper(store=s, columnOne=one, columnTwo=two)
+                 for one in range(3) for two in range(3)]
+        expected = sorted(items, key=lambda i: (-i.columnOne, i.columnTwo))
+        for pagesize in range(1, 10):
+            self.assertEquals(
+                list(s.query(MultiColumnSortHelper,
+                             sort=[MultiColumnSortHelper.columnOne.descending,
+                                   MultiColumnSortHelper.columnTwo.ascending]
+                             ).paginate(pagesize=pagesize)),
+                expected)
+
+
+    def test_nullValues(self):
+        """
+        Results whose sort columns are C{None} are returned where SQLite
+        orders them: before all other values in ascending order, and after
+        them in descending order.
+        """
+        s = Store()
+        for one in (None, 1):
+            for two in (None, 1, None):
+                MultiColumnSortHelper(store=s, columnOne=one, columnTwo=two)
+        for pagesize in range(1, 7):
+            for sort in [[MultiColumnSortHelper.columnOne.ascending,
+                          MultiColumnSortHelper.columnTwo.ascending],
+                         [MultiColumnSortHelper.columnOne.descending,
+                          MultiColumnSortHelper.columnTwo.descending]]:
+                expected = list(s.query(
+                        MultiColumnSortHelper,
+                        sort=sort + [MultiColumnSortHelper.storeID.ascending]))
+                self.assertEquals(
+                    list(s.query(MultiColumnSortHelper, sort=sort).paginate(
+                            pagesize=pagesize)),
+                    expected)
+
+
+    def test_tiesAreLimited(self):
+        """
+        Every query run to find a page of results is limited to the page size,
+        even when many results are tied in the sort column.
+        """
+        s = Store()
+        for i in range(10):
+            SingleColumnSortHelper(store=s, mainColumn=1)
+        queries = []
+        query = s.query(SingleColumnSortHelper,
+                        sort=SingleColumnSortHelper.mainColumn.ascending)
+        original = s.query
+        def recordingQuery(*a, **kw):
+            result = original(*a, **kw)
+            queries.append(result)
+            return result
+        s.query = recordingQuery
+        self.assertEquals(len(list(query.paginate(pagesize=3))), 10)
+        self.assertEquals([q.limit for q in queries], [3, 3, 3, 3])
+
+
+    def test_badPagesize(self):
+        """
+        L{ItemQuery.paginate} raises L{ValueError} if the page size is not
+        positive.
+        """
+        s = Store()
+        self.assertRaises(ValueError,
+                          s.query(SingleColumnSortHelper).paginate, 0)
+
+
+    def test_otherTypeSort(self):
+        """
+        L{ItemQuery.paginate} raises L{ValueError} if the query is sorted by
+        an attribute of a type other than its result type.
+        """
+        s = Store()
+        query = s.query(
+            SingleColumnSortHelper,
+            SingleColumnSortHelper.other == MultiColumnSortHelper.columnOne,
+            sort=MultiColumnSortHelper.columnTwo.ascending)
+        self.assertRaises(ValueError, query.paginate)
+
+
+
+class ResumePagination(TestCase):
+    """
+    Tests for L{ItemQuery.paginationToken} and the C{resumeFrom} parameter to
+    L{ItemQuery.paginate}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.items = [
+            MultiColumnSortHelper(store=self.store, columnOne=i // 3,
+                                  columnTwo=i % 3)
+            for i in range(9)]
+        self.sort = [MultiColumnSortHelper.columnOne.descending,
+                     MultiColumnSortHelper.columnTwo.ascending]
+        self.expected = sorted(
+            self.items, key=lambda i: (-i.columnOne, i.columnTwo))
+
+
+    def test_resume(self):
+        """
+        Pagination resumed from the token for a result continues with the
+        result after it, even in a different query object.
+        """
+        query = self.store.query(MultiColumnSortHelper, sort=self.sort)
+        results = iter(query.paginate(pagesize=2))
+        first = [results.next() for i in range(4)]
+        token = query.paginationToken(first[-1])
+        self.assertTrue(isinstance(token, str))
+        resumed = self.store.query(
+            MultiColumnSortHelper, sort=self.sort).paginate(
+            pagesize=2, resumeFrom=token)
+        self.assertEquals(first + list(resumed), self.expected)
+
+
+    def test_resumeWithComparison(self):
+        """
+        A resumed pagination still only includes results which match the
+        query's comparison.
+        """
+        comparison = MultiColumnSortHelper.columnTwo != 1
+        query = self.store.query(
+            MultiColumnSortHelper, comparison, sort=self.sort)
+        token = query.paginationToken(self.expected[0])
+        self.assertEquals(
+            list(query.paginate(pagesize=1, resumeFrom=token)),
+            [i for i in self.expected[1:] if i.columnTwo != 1])
+
+
+    def test_resumeBytes(self):
+        """
+        Tokens work for sorts on L{bytes} attributes.
+        """
+        for value in ['b', 'a', 'c']:
+            BytesSortHelper(store=self.store, value=value)
+        query = self.store.query(BytesSortHelper,
+                                 sort=BytesSortHelper.value.ascending)
+        first = iter(query.paginate()).next()
+        self.assertEquals(
+            [i.value for i in query.paginate(
+                        resumeFrom=query.paginationToken(first))],
+            ['b', 'c'])
+
+
+    def test_mismatchedToken(self):
+        """
+        L{ItemQuery.paginate} raises L{ValueError} if given a token for a
+        query with a different sort, or something which is not a token at
+        all.
+        """
+        query = self.store.query(MultiColumnSortHelper, sort=self.sort)
+        token = query.paginationToken(self.items[0])
+        other = self.store.query(MultiColumnSortHelper)
+        self.assertRaises(ValueError, other.paginate, resumeFrom=token)
+        self.assertRaises(ValueError, query.paginate, resumeFrom='garbage')
 
 
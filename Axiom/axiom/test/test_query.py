@@ -1,14 +1,17 @@
 
 import operator, random
 
+from zope.interface import implements
+
 from twisted.trial.unittest import TestCase, SkipTest
+from twisted.python import log
 
 from axiom.iaxiom import IComparison, IColumn
 from axiom.store import Store, ItemQuery, MultipleItemQuery
 from axiom.item import Item, Placeholder
 from axiom.test.util import QueryCounter
 
-from axiom import errors
+from axiom import errors, _pysqlite2
 from axiom.attributes import (
     reference, text, bytes, integer, AND, OR, TableOrderComparisonWrapper)
 
@@ -842,6 +845,228 @@ class MultipleQuery(TestCase):
 
 
 
+class StreamingQuery(TestCase):
+    """
+    Tests for L{BaseQuery.stream}, which retrieves query results from the
+    database incrementally.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.items = [E(store=self.store, name=unicode(i), amount=i % 3)
+                      for i in range(7)]
+
+
+    def test_itemQuery(self):
+        """
+        L{ItemQuery.stream} yields the same items, in the same order, as
+        iterating the query.
+        """
+        query = self.store.query(E, sort=E.storeID.descending)
+        self.assertEquals(list(query.stream(chunkSize=2)), list(query))
+
+
+    def test_attributeQuery(self):
+        """
+        L{AttributeQuery.stream} yields the same values as iterating the
+        query.
+        """
+        query = self.store.query(E, sort=E.storeID.ascending).getColumn('name')
+        self.assertEquals(list(query.stream(chunkSize=3)),
+                          [e.name for e in self.items])
+
+
+    def test_distinct(self):
+        """
+        The C{stream} method of a distinct query yields the same values as
+        iterating it.
+        """
+        query = self.store.query(
+            E, sort=E.amount.ascending).getColumn('amount').distinct()
+        self.assertEquals(list(query.stream(chunkSize=1)), [0, 1, 2])
+
+
+    def test_multipleItemQuery(self):
+        """
+        L{MultipleItemQuery.stream} yields the same tuples as iterating the
+        query.
+        """
+        query = self.store.query(
+            (E, C), E.name == C.name, sort=E.storeID.ascending)
+        C(store=self.store, name=u'2')
+        C(store=self.store, name=u'5')
+        self.assertEquals(list(query.stream(chunkSize=1)), list(query))
+
+
+    def test_boundedFetches(self):
+        """
+        Rows are fetched from the database no more than C{chunkSize} at a
+        time, and only as the results are consumed.
+        """
+        sizes = []
+        fetchmany = _pysqlite2.Cursor.fetchmany
+        def recordingFetchmany(cursor, size):
+            rows = fetchmany(cursor, size)
+            sizes.append(len(rows))
+            return rows
+        self.patch(_pysqlite2.Cursor, 'fetchmany', recordingFetchmany)
+        results = iter(self.store.query(E).stream(chunkSize=3))
+        results.next()
+        self.assertEquals(sizes, [3])
+        list(results)
+        self.assertEquals(sizes, [3, 3, 1, 0])
+
+
+    def test_interleavedStatements(self):
+        """
+        Other statements, including the statements which begin and commit
+        transactions, may be executed while the results of a streamed query
+        are being consumed without disturbing it.
+        """
+        results = iter(self.store.query(
+                E, sort=E.storeID.ascending).stream(chunkSize=2))
+        seen = [results.next()]
+        for i in range(3):
+            def step():
+                seen.append(results.next())
+                self.store.findUnique(E, E.name == u'0')
+                C(store=self.store, name=seen[-1].name)
+            self.store.transact(step)
+        seen.extend(results)
+        self.assertEquals(seen, self.items)
+        self.assertEquals(self.store.query(C).count(), 3)
+
+
+    def test_checkpoint(self):
+        """
+        Changes made in the current transaction are written to the database
+        before a streamed query is executed.
+        """
+        def txn():
+            self.items[0].amount = 10
+            return list(self.store.query(E, E.amount == 10).stream())
+        self.assertEquals(self.store.transact(txn), [self.items[0]])
+
+
+
+class CompiledQueryTests(TestCase):
+    """
+    Tests for the reuse of generated SQL by queries with the same structure,
+    kept in L{Store.queryCache}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.items = [E(store=self.store, name=unicode(i), amount=i % 3)
+                      for i in range(7)]
+
+
+    def _sqlAndArgs(self, query):
+        return query._sqlAndArgs('SELECT', query._queryTarget)
+
+
+    def test_sameStructure(self):
+        """
+        Queries which differ only in the values they compare against share a
+        cache entry, generate the same SQL and still find different items.
+        """
+        first = self.store.query(E, AND(E.amount == 1, E.name != u'1'))
+        second = self.store.query(E, AND(E.amount == 2, E.name != u'5'))
+        firstSQL, firstArgs = self._sqlAndArgs(first)
+        secondSQL, secondArgs = self._sqlAndArgs(second)
+        self.assertEquals(len(self.store.queryCache), 1)
+        self.assertEquals(firstSQL, secondSQL)
+        self.assertEquals(firstArgs, [1, u'1'])
+        self.assertEquals(secondArgs, [2, u'5'])
+        self.assertEquals(list(first), [self.items[4]])
+        self.assertEquals(list(second), [self.items[2]])
+
+
+    def test_differentStructure(self):
+        """
+        Queries with different comparisons, sorts or limits do not share SQL.
+        """
+        queries = [
+            self.store.query(E, E.amount == 1),
+            self.store.query(E, E.amount > 1),
+            self.store.query(E, E.name == u'1'),
+            self.store.query(E, E.amount == None),
+            self.store.query(E, E.amount == 1, sort=E.name.ascending),
+            self.store.query(E, E.amount == 1, limit=2),
+            self.store.query(E, E.amount.oneOf([1])),
+            self.store.query(E, E.amount.oneOf([1, 2])),
+            self.store.query(E, E.name.like(u'1%')),
+            self.store.query(E)]
+        statements = [self._sqlAndArgs(query)[0] for query in queries]
+        for statement in statements:
+            self.assertEquals(statements.count(statement), 1, statement)
+        self.assertEquals(
+            [len(list(query)) for query in queries],
+            [2, 2, 1, 0, 2, 2, 2, 4, 1, 7])
+
+
+    def test_limitNotCached(self):
+        """
+        The limit and offset of a query are not part of its cache key, so
+        paging through results with them does not fill the cache.
+        """
+        for offset in range(5):
+            query = self.store.query(
+                E, E.amount != 1, sort=E.storeID.ascending,
+                limit=1, offset=offset)
+            self.assertEquals(list(query), [self.items[[0, 2, 3, 5, 6][offset]]])
+        self.assertEquals(len(self.store.queryCache), 1)
+
+
+    def test_unknownComparison(self):
+        """
+        Comparisons which cannot describe the structure of their SQL are not
+        cached, and neither are queries involving them.
+        """
+        class Unknown(object):
+            implements(IComparison)
+            def getInvolvedTables(self):
+                return [E]
+            def getQuery(self, store):
+                return '(1)'
+            def getArgs(self, store):
+                return []
+        self.assertEquals(
+            len(list(self.store.query(E, AND(E.amount == 1, Unknown())))), 2)
+        self.assertEquals(self.store.queryCache, {})
+
+
+    def test_placeholder(self):
+        """
+        Queries which use L{Placeholder}s are not cached, since the table
+        aliases they use may differ from one query to the next.
+        """
+        p = Placeholder(E)
+        self.assertEquals(
+            len(list(self.store.query(E, AND(p.amount == E.amount,
+                                             p.name == u'0')))),
+            3)
+        self.assertEquals(self.store.queryCache, {})
+
+
+    def test_callSites(self):
+        """
+        Queries log the location of the code which ran them unless
+        L{Store.queryCallSites} is false.
+        """
+        sites = []
+        def observe(event):
+            if 'querySite' in event:
+                sites.append(event['querySite'])
+        log.addObserver(observe)
+        self.addCleanup(log.removeObserver, observe)
+
+        list(self.store.query(E))
+        self.assertEquals(sites[-1][0], __file__.replace('.pyc', '.py'))
+        self.store.queryCallSites = False
+        list(self.store.query(E))
+        self.assertIdentical(sites[-1], None)
+
+
+
 class QueryingTestCase(TestCase):
     def setUp(self):
         s = self.store = Store()
@@ -2,6 +2,7 @@ import gc
 
 from twisted.trial.unittest import TestCase
 
+from axiom import store as axiomstore
 from axiom.store import Store
 from axiom.upgrade import registerUpgrader
 from axiom.item import Item, declareLegacyItem
@@ -193,6 +194,86 @@ class BadReferenceTestCase(TestCase):
 
 
 
+class ReferencePrefetchTestCase(TestCase):
+    """
+    Tests for the loading of the referents of all of the results of a query
+    when a reference attribute of one of them is dereferenced.
+    """
+    def setUp(self):
+        self.store = Store()
+        for i in range(5):
+            SimpleReferent(store=self.store,
+                           ref=Referee(store=self.store, topSecret=i))
+        SimpleReferent(store=self.store, ref=None)
+        gc.collect()
+        self.statements = []
+        querySQL = self.store.querySQL
+        def recordingQuerySQL(sql, args=()):
+            self.statements.append(sql)
+            return querySQL(sql, args)
+        self.store.querySQL = recordingQuerySQL
+
+
+    def test_prefetch(self):
+        """
+        Dereferencing the references of all the results of a query loads the
+        referents with a fixed number of queries.
+        """
+        referents = list(self.store.query(
+                SimpleReferent, sort=SimpleReferent.storeID.ascending))
+        del self.statements[:]
+        self.assertEquals(
+            [r.ref and r.ref.topSecret for r in referents],
+            [0, 1, 2, 3, 4, None])
+        self.assertEquals(len(self.statements), 2)
+
+
+    def test_window(self):
+        """
+        Only the referents of results near the dereferenced one are loaded
+        with it.
+        """
+        self.patch(axiomstore, 'REFERENCE_PREFETCH_WINDOW', 2)
+        referents = list(self.store.query(
+                SimpleReferent, sort=SimpleReferent.storeID.ascending))
+        del self.statements[:]
+        referents[0].ref
+        referents[1].ref
+        self.assertEquals(len(self.statements), 2)
+        referents[2].ref
+        self.assertEquals(len(self.statements), 4)
+
+
+    def test_deletedReferent(self):
+        """
+        A referent which has been deleted since the query was run is still
+        dereferenced as C{None}.
+        """
+        referents = list(self.store.query(
+                SimpleReferent, sort=SimpleReferent.storeID.ascending))
+        self.store.findUnique(Referee, Referee.topSecret == 3).deleteFromStore()
+        gc.collect()
+        self.assertEquals(
+            [r.ref and r.ref.topSecret for r in referents],
+            [0, 1, 2, None, 4, None])
+
+
+    def test_legacyReferent(self):
+        """
+        Referents which need to be upgraded are still upgraded when
+        dereferenced.
+        """
+        referent = SimpleReferent(store=self.store,
+                                  ref=nonUpgradedItem(store=self.store))
+        storeID = referent.storeID
+        del referent
+        gc.collect()
+        referent = self.store.findUnique(
+            SimpleReferent, SimpleReferent.storeID == storeID)
+        self.assertTrue(isinstance(referent.ref, UpgradedItem))
+
+
+
 class UpgradedItem(Item):
     """
     A simple item which is the current version of L{nonUpgradedItem}.
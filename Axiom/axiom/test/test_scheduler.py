@@ -8,7 +8,7 @@ from twisted.trial.unittest import TestCase
 from twisted.application.service import IService
 from twisted.internet.defer import Deferred
 from twisted.internet.task import Clock
-from twisted.python import filepath, versions
+from twisted.python import filepath, versions, log
 
 from epsilon.extime import Time
 
@@ -19,7 +19,7 @@ from axiom.item import Item
 from axiom.substore import SubStore
 
 from axiom.attributes import integer, text, inmemory, boolean, timestamp
-from axiom.iaxiom import IScheduler
+from axiom.iaxiom import IScheduler, IStatEvent
 from axiom.dependency import installOn
 
 class TestEvent(Item):
@@ -294,6 +294,99 @@ class TopStoreSchedTest(SchedTest, TestCase):
 
 
 
+class BatchedSchedTest(TopStoreSchedTest):
+    """
+    Tests for L{SchedulerMixin} when it runs many due events in each
+    transaction.
+    """
+    def setUp(self):
+        TopStoreSchedTest.setUp(self)
+        self.scheduler = IScheduler(self.store)
+        self.scheduler.eventsPerTransaction = 5
+        self.stats = []
+        def observe(event):
+            if 'stat_scheduler_events' in event:
+                self.stats.append(event)
+        log.addObserver(observe)
+        self.addCleanup(log.removeObserver, observe)
+
+
+    def test_groupCommit(self):
+        """
+        Due events are run C{eventsPerTransaction} to a transaction, and the
+        number run is reported in an L{IStatEvent}.
+        """
+        self.scheduler.transactionsPerTick = 2
+        events = [TestEvent(store=self.store, testCase=self,
+                            name=unicode(i), runAgain=None)
+                  for i in range(12)]
+        for event in events:
+            self.scheduler.schedule(event, self.now())
+        commits = []
+        def observe(event):
+            if 'stat_commits' in event:
+                commits.append(event)
+        log.addObserver(observe)
+        self.addCleanup(log.removeObserver, observe)
+
+        self.clock.advance(1)
+        self.assertEquals([event.runCount for event in events], [1] * 12)
+        self.assertEquals(len(commits), 3)
+        self.assertEquals(
+            [(stat['interface'], stat['stat_scheduler_events'],
+              stat['stat_scheduler_errors']) for stat in self.stats],
+            [(IStatEvent, 10, 0), (IStatEvent, 2, 0)])
+        self.failUnless(
+            self.stats[0]['scheduler_events_per_second'] >= 0)
+
+
+    def test_failureIsolated(self):
+        """
+        An event which fails in a batch is logged in a
+        L{TimedEventFailureLog} and its changes are reverted, without
+        reverting the events before or after it.
+        """
+        def hook(runner):
+            runner.ignored = 1
+        first = HookRunner(store=self.store, hook=hook, ignored=0)
+        spec = SpecialErrorHandler(store=self.store)
+        broken = NotActuallyRunnable(store=self.store)
+        last = TestEvent(store=self.store, testCase=self,
+                         name=u'last', runAgain=None)
+        for runnable in [first, spec, broken, last]:
+            self.scheduler.schedule(runnable, self.now())
+
+        self.clock.advance(1)
+        self.assertEquals(first.ignored, 1)
+        self.failIf(spec.broken)
+        self.failUnless(spec.procd)
+        self.assertEquals(last.runCount, 1)
+        self.assertEquals(len(self.flushLoggedErrors(SpecialError)), 1)
+        self.assertEquals(len(self.flushLoggedErrors(AttributeError)), 1)
+        [failure] = list(self.store.query(TimedEventFailureLog))
+        self.assertIdentical(failure.runnable, broken)
+        self.assertEquals(self.store.query(TimedEvent).count(), 0)
+        self.assertEquals(self.stats[0]['stat_scheduler_errors'], 2)
+
+
+    def test_unscheduledByEarlierEvent(self):
+        """
+        An event unscheduled by an event which ran before it in the same
+        batch does not run.
+        """
+        victim = TestEvent(store=self.store, testCase=self,
+                           name=u'victim', runAgain=None)
+        killer = HookRunner(
+            store=self.store,
+            hook=lambda runner: self.scheduler.unscheduleAll(victim))
+        self.scheduler.schedule(killer, self.now())
+        self.scheduler.schedule(victim, self.now() + timedelta(seconds=1))
+        self.clock.advance(1)
+        self.assertEquals(victim.runCount, 0)
+        self.assertEquals(self.store.query(TimedEvent).count(), 0)
+
+
+
 class SubSchedulerTests(SchedTest, TestCase):
     """
     Tests for the substore implementation of IScheduler.
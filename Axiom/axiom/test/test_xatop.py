@@ -636,6 +636,159 @@ class ItemTests(unittest.TestCase):
 
 
 
+class SavepointTests(unittest.TestCase):
+    """
+    Tests for L{store.Store._savepoint}, which reverts the changes made by a
+    function without reverting the rest of the transaction.
+    """
+    def setUp(self):
+        self.store = store.Store()
+        self.existing = TestItem(store=self.store, foo=1, bar=u'existing')
+
+
+    def _fail(self, f):
+        """
+        Call C{f} in a savepoint and assert that it raises L{RevertException}.
+        """
+        self.assertRaises(RevertException, self.store._savepoint, f)
+
+
+    def test_result(self):
+        """
+        L{store.Store._savepoint} returns the result of the function, and keeps
+        its changes.
+        """
+        def txn():
+            def change():
+                self.existing.foo = 2
+                return TestItem(store=self.store, foo=3)
+            return self.store._savepoint(change)
+        created = self.store.transact(txn)
+        self.assertEquals(self.existing.foo, 2)
+        self.assertIdentical(self.store.getItemByID(created.storeID), created)
+
+
+    def test_revertChanges(self):
+        """
+        Items created or changed by a function which fails are reverted, while
+        changes made earlier in the transaction are committed.
+        """
+        created = []
+        def txn():
+            before = TestItem(store=self.store, foo=4, bar=u'before')
+            def broken():
+                created.append(TestItem(store=self.store, foo=5).storeID)
+                self.existing.foo = 6
+                before.bar = u'changed'
+                raise RevertException()
+            self._fail(broken)
+            self.assertEquals(self.existing.foo, 1)
+            self.assertEquals(before.bar, u'before')
+            before.foo = 7
+            return before
+        before = self.store.transact(txn)
+
+        self.assertRaises(KeyError, self.store.getItemByID, created[0])
+        self.assertEquals(self.existing.foo, 1)
+        self.assertEquals(
+            list(self.store.query(TestItem,
+                                  sort=TestItem.storeID.ascending).getColumn('foo')),
+            [1, 7])
+        self.assertIdentical(self.store.getItemByID(before.storeID), before)
+
+
+    def test_revertDeletion(self):
+        """
+        Items deleted by a function which fails are not deleted, while items
+        deleted earlier in the transaction are.
+        """
+        def txn():
+            doomed = TestItem(store=self.store, foo=8)
+            doomed.deleteFromStore()
+            def broken():
+                self.existing.deleteFromStore()
+                raise RevertException()
+            self._fail(broken)
+            return doomed.storeID
+        doomedID = self.store.transact(txn)
+        self.assertRaises(KeyError, self.store.getItemByID, doomedID)
+        self.assertEquals(list(self.store.query(TestItem)), [self.existing])
+        self.assertIdentical(self.existing.store, self.store)
+
+
+    def test_tableCreationReverted(self):
+        """
+        A table created by a function which fails is forgotten, so that it is
+        created again when it is next used.
+        """
+        def txn():
+            def broken():
+                AttributefulItem(store=self.store)
+                raise RevertException()
+            self._fail(broken)
+        self.store.transact(txn)
+        self.assertEquals(self.store.query(AttributefulItem).count(), 0)
+        AttributefulItem(store=self.store)
+        self.assertEquals(self.store.query(AttributefulItem).count(), 1)
+
+
+    def test_nestedSavepoints(self):
+        """
+        Items created in a savepoint which succeeds are reverted if a
+        savepoint it is nested in fails, and items created in an outer
+        savepoint are kept if a savepoint nested in it fails.
+        """
+        def create(foo):
+            TestItem(store=self.store, foo=foo)
+        def fail():
+            raise RevertException()
+        def outer():
+            self.store._savepoint(create, 10)
+            raise RevertException()
+        def outerKept():
+            create(11)
+            self._fail(lambda: (create(12), fail()))
+        def txn():
+            self._fail(outer)
+            self.store._savepoint(outerKept)
+        self.store.transact(txn)
+        self.assertEquals(
+            list(self.store.query(TestItem,
+                                  sort=TestItem.storeID.ascending).getColumn('foo')),
+            [1, 11])
+        self.assertEquals(self.store._savepointJoined, None)
+
+
+    def test_savepointJoinedFromSubStore(self):
+        """
+        Items in a substore attached to the store a savepoint is established
+        in are reverted with it.
+        """
+        from axiom.substore import SubStore
+        siteStore = store.Store(self.mktemp())
+        subStore = SubStore.createNew(siteStore, ['sub']).open()
+        created = []
+        def broken():
+            created.append(TestItem(store=subStore, foo=13).storeID)
+            raise RevertException()
+        def txn():
+            self.assertRaises(RevertException, subStore._savepoint, broken)
+        subStore.transact(txn)
+        self.assertRaises(KeyError, subStore.getItemByID, created[0])
+
+
+    def test_wholeTransactionReverted(self):
+        """
+        Reverting the transaction also reverts the changes made in savepoints.
+        """
+        def txn():
+            self.store._savepoint(setattr, self.existing, 'foo', 9)
+            raise RevertException()
+        self.assertRaises(RevertException, self.store.transact, txn)
+        self.assertEquals(self.existing.foo, 1)
+
+
+
 class AttributefulItem(item.Item):
     schemaVersion = 1
     typeName = 'test_attributeful_item'
@@ -0,0 +1,74 @@
+"""
+Fulltext index a message a fixed number of times with SQLite via the Mantissa
+fulltext indexing API, then remove every other message, and report the number
+of documents processed per second.
+
+Pass C{unbuffered} as an argument to insert each document in its own
+transaction, as L{SQLiteIndexer} did before it indexed in bulk.
+"""
+
+import sys, time
+
+from zope.interface import implements
+
+from epsilon.scripts import benchmark
+
+from axiom import store
+
+from xmantissa import ixmantissa, fulltext
+
+N = 10000
+
+
+class Message(object):
+    implements(ixmantissa.IFulltextIndexable)
+
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+
+    def uniqueIdentifier(self):
+        return str(self.identifier)
+
+
+    def textParts(self):
+        return [
+            u"Hello, how are you.  Please to be "
+            u"seeing this message as an indexer test." * 10]
+
+
+    def keywordParts(self):
+        return {}
+
+
+    def documentType(self):
+        return u'message'
+
+
+    def sortKey(self):
+        return u''
+
+
+
+def main(argv):
+    s = store.Store("sqlite.axiom")
+    indexer = fulltext.SQLiteIndexer(store=s)
+    if 'unbuffered' in argv[1:]:
+        writer = fulltext._SQLiteIndex(indexer._getStore())
+    else:
+        writer = indexer.openWriteIndex()
+
+    benchmark.start()
+    before = time.time()
+    for i in xrange(N):
+        writer.add(Message(i))
+    writer.removeMany([str(i) for i in xrange(0, N, 2)])
+    writer.close()
+    elapsed = time.time() - before
+    benchmark.stop()
+    sys.stderr.write("%d documents/second\n" % ((N + N / 2) / elapsed,))
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
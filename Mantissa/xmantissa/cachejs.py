@@ -1,21 +1,39 @@
 # -*- test-case-name: xmantissa.test.test_cachejs -*-
 """
 This module implements a strategy for allowing the browser to cache
-JavaScript modules served by Athena.  It's not entirely standalone, as it
-requires some cooperation from L{xmantissa.website}, specifically
+JavaScript and CSS modules served by Athena.  It's not entirely standalone, as
+it requires some cooperation from L{xmantissa.website}, specifically
 L{xmantissa.website.MantissaLivePage}.
+
+Modules are served from memory, gzip-compressed ahead of time for clients
+which accept that, under URLs which include a hash of their contents so that
+they can be cached by the browser forever.  The filesystem is checked for
+changes to them periodically rather than when they are requested.
 """
 
-import sha
+import sha, zlib
 
 from zope.interface import implements
 
+from twisted.python import log
 from twisted.python.filepath import FilePath
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web import http
 
-from nevow.inevow import IResource
+from nevow.inevow import IRequest, IResource
 from nevow import athena
 from nevow import static
 from nevow.rend import NotFound, FourOhFour
+from nevow.compression import parseAcceptEncoding
+
+
+def _gzip(data):
+    """
+    Compress C{data} as a gzip stream, as hard as possible.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 
 class CachedJSModule(object):
@@ -30,6 +48,15 @@ class CachedJSModule(object):
 
     @ivar lastModified: The mtime of L{filePath}, as a POSIX timestamp.
     @type lastModified: C{int}.
+
+    @ivar fileContents: The contents of L{filePath}.
+    @type fileContents: C{str}.
+
+    @ivar compressedContents: L{fileContents}, gzip-compressed.
+    @type compressedContents: C{str}.
+
+    @ivar hashValue: The hex-encoded SHA1 hash of L{fileContents}.
+    @type hashValue: C{str}.
     """
 
     def __init__(self, moduleName, filePath):
@@ -61,11 +88,114 @@ class CachedJSModule(object):
         """
         Check this cache entry and update it if any filesystem information has
         changed.
+
+        @return: True if the contents of the module changed, False if not.
         """
         if self.wasModified():
             self.lastModified = self.filePath.getmtime()
-            self.fileContents = self.filePath.getContent()
-            self.hashValue = sha.new(self.fileContents).hexdigest()
+            contents = self.filePath.getContent()
+            hashValue = sha.new(contents).hexdigest()
+            if hashValue != getattr(self, 'hashValue', None):
+                self.fileContents = contents
+                self.compressedContents = _gzip(contents)
+                self.hashValue = hashValue
+                return True
+        return False
+
+
+
+class CachedModuleResource(static.Data):
+    """
+    A resource which renders the contents of a L{CachedJSModule} or
+    L{CachedJSBundle}, compressed if the client accepts that, with headers
+    allowing it to be cached for C{expires} seconds.  A conditional request
+    for the same contents gets a I{Not Modified} response.
+
+    @ivar module: The module or bundle to render.
+    @type module: L{CachedJSModule} or L{CachedJSBundle}
+    """
+    def __init__(self, module, type, expires):
+        static.Data.__init__(self, module.fileContents, type, expires)
+        self.module = module
+
+
+    def renderHTTP(self, ctx):
+        request = IRequest(ctx)
+        data = self.data
+        etag = '"%s"' % (self.module.hashValue,)
+        acceptEncoding = request.getHeader('accept-encoding')
+        if (acceptEncoding is not None and
+            parseAcceptEncoding(acceptEncoding).get('gzip', 0.0) > 0.0):
+            data = self.module.compressedContents
+            etag = '"%s-gzip"' % (self.module.hashValue,)
+            request.setHeader('content-encoding', 'gzip')
+
+        request.setHeader('content-type', self.type)
+        request.setHeader('vary', 'accept-encoding')
+        request.setHeader('etag', etag)
+        request.setHeader('cache-control', 'public, max-age=%d' % (
+                self.expires,))
+        request.setHeader('expires',
+                          http.datetimeToString(self.time() + self.expires))
+
+        ifNoneMatch = request.getHeader('if-none-match')
+        if ifNoneMatch is not None and (
+            ifNoneMatch.strip() == '*' or
+            etag in [tag.strip() for tag in ifNoneMatch.split(',')]):
+            request.setResponseCode(http.NOT_MODIFIED)
+            return ''
+
+        request.setHeader('content-length', str(len(data)))
+        if request.method == 'HEAD':
+            return ''
+        return data
+
+
+
+class CachedJSBundle(athena.JSBundle):
+    """
+    A L{athena.JSBundle} which can be rendered by L{CachedModuleResource}.
+
+    @ivar fileContents: The script.
+    @type fileContents: C{str}
+
+    @ivar compressedContents: L{fileContents}, gzip-compressed.
+    @type compressedContents: C{str}
+    """
+    def __init__(self, moduleNames, contents):
+        athena.JSBundle.__init__(self, moduleNames, contents)
+        self.fileContents = contents
+        self.compressedContents = _gzip(contents)
+
+
+
+class HashedJSBundleCache(athena.JSBundleCache):
+    """
+    A L{athena.JSBundleCache} which bundles the modules cached by a
+    L{HashedJSModuleProvider}, and serves bundles the same way.
+
+    @ivar moduleProvider: The provider of the modules to bundle.
+    @type moduleProvider: L{HashedJSModuleProvider}
+    """
+    bundleFactory = CachedJSBundle
+
+    def __init__(self, moduleProvider):
+        athena.JSBundleCache.__init__(self)
+        self.moduleProvider = moduleProvider
+
+
+    def getSource(self, moduleName):
+        """
+        Return the cached source of the named module.
+        """
+        return self.moduleProvider.getModule(moduleName).fileContents
+
+
+    def resourceFactory(self, bundle):
+        """
+        Render C{bundle} with a L{CachedModuleResource}.
+        """
+        return CachedModuleResource(bundle, 'text/javascript', self.expires)
 
 
 
@@ -79,15 +209,60 @@ class HashedJSModuleProvider(object):
 
     @ivar depsMemo: A memo of module dependencies.
     @type depsMemo: C{dict} of C{module name: dependent modules}
+
+    @ivar bundles: The bundles of modules loaded by pages.
+    @type bundles: L{HashedJSBundleCache}
+
+    @ivar contentType: The MIME type of the modules.
+    @type contentType: C{str}
+
+    @ivar recheckInterval: The number of seconds between checks of the
+        filesystem for changes to modules in L{moduleCache}.
+    @type recheckInterval: C{int}
+
+    @ivar clock: The L{IReactorTime} provider used to schedule those checks.
     """
     implements(IResource)
 
+    contentType = 'text/javascript'
+    recheckInterval = 60
+    clock = reactor
+
     def __init__(self):
         """
         Create a HashedJSModuleProvider.
         """
         self.moduleCache = {}
         self.depsMemo = {}
+        self.bundles = HashedJSBundleCache(self)
+        self._recheckers = 0
+        self._recheckCall = None
+
+
+    def getAthenaModule(self, moduleName):
+        """
+        Find the Athena module with the given name.
+
+        @rtype: L{athena.JSModule}
+        """
+        return athena.jsDeps.getModuleForName(moduleName)
+
+
+    def getModulePath(self, moduleName):
+        """
+        Find the file which implements a module.
+
+        @rtype: L{FilePath}
+        """
+        return FilePath(self.getAthenaModule(moduleName)._cache.path)
+
+
+    def allModules(self):
+        """
+        Return a C{dict} mapping the names of all the modules this resource
+        can serve to the names of the files which implement them.
+        """
+        return athena.allJavascriptPackages()
 
 
     def getModule(self, moduleName):
@@ -98,8 +273,7 @@ class HashedJSModuleProvider(object):
         @rtype: L{CachedJSModule}
         """
         if moduleName not in self.moduleCache:
-            modulePath = FilePath(
-                athena.jsDeps.getModuleForName(moduleName)._cache.path)
+            modulePath = self.getModulePath(moduleName)
             cachedModule = self.moduleCache[moduleName] = CachedJSModule(
                 moduleName, modulePath)
         else:
@@ -107,6 +281,78 @@ class HashedJSModuleProvider(object):
         return cachedModule
 
 
+    def precache(self):
+        """
+        Load, hash and compress every module which can be served, so that no
+        request has to wait for that to happen.
+        """
+        for moduleName, fileName in self.allModules().iteritems():
+            if moduleName not in self.moduleCache:
+                self.moduleCache[moduleName] = CachedJSModule(
+                    moduleName, FilePath(fileName))
+
+
+    def precomputeDependencies(self):
+        """
+        Fill L{depsMemo} with the dependencies of every module which can be
+        served, so that no page has to work them out.  Modules which import
+        modules Athena does not know about are skipped; pages using them will
+        fail to work out their dependencies in the usual way.
+        """
+        for moduleName in self.allModules():
+            try:
+                module = self.getAthenaModule(moduleName)
+            except RuntimeError:
+                # Not a module Athena knows about, so nothing can depend on
+                # it.
+                continue
+            try:
+                module.allDependencies(self.depsMemo)
+            except KeyError, e:
+                log.msg("Not precomputing dependencies of %r: %r is not a "
+                        "known module" % (moduleName, e.args[0]))
+
+
+    def recheck(self):
+        """
+        Update every cached module which has changed on disk, forgetting the
+        dependencies of all modules and all bundles if any of them did.
+        """
+        changed = False
+        for cachedModule in self.moduleCache.values():
+            if cachedModule.maybeUpdate():
+                changed = True
+        if changed:
+            self.depsMemo.clear()
+            self.bundles.clear()
+
+
+    def startRechecking(self):
+        """
+        Precache all modules and start calling L{recheck} every
+        C{recheckInterval} seconds, unless this has already been done and not
+        undone by as many calls to L{stopRechecking}.
+        """
+        self._recheckers += 1
+        if self._recheckers == 1:
+            self.precache()
+            self.precomputeDependencies()
+            self._recheckCall = LoopingCall(self.recheck)
+            self._recheckCall.clock = self.clock
+            self._recheckCall.start(self.recheckInterval, now=False)
+
+
+    def stopRechecking(self):
+        """
+        Undo one call to L{startRechecking}, no longer calling L{recheck} if
+        it was the last one.
+        """
+        self._recheckers -= 1
+        if self._recheckers == 0:
+            self._recheckCall.stop()
+            self._recheckCall = None
+
+
     # IResource
     def locateChild(self, ctx, segments):
         """
@@ -117,9 +363,9 @@ class HashedJSModuleProvider(object):
             return NotFound
         hashCode, moduleName = segments
         cachedModule = self.getModule(moduleName)
-        return static.Data(
-            cachedModule.fileContents,
-            'text/javascript', expires=(60 * 60 * 24 * 365 * 5)), []
+        return CachedModuleResource(
+            cachedModule, self.contentType,
+            expires=(60 * 60 * 24 * 365 * 5)), []
 
 
     def renderHTTP(self, ctx):
@@ -131,7 +377,33 @@ class HashedJSModuleProvider(object):
 
 
 
+class HashedCSSModuleProvider(HashedJSModuleProvider):
+    """
+    Like L{HashedJSModuleProvider}, but for CSS modules.
+    """
+    contentType = 'text/css'
+
+    def getAthenaModule(self, moduleName):
+        """
+        Find the Athena CSS module with the given name.
+
+        @rtype: L{athena.CSSModule}
+        """
+        return athena._theCSSRegistry.getModuleForName(moduleName)
+
+
+    def allModules(self):
+        """
+        Return a C{dict} mapping the names of all CSS modules to the names of
+        the files which implement them.
+        """
+        return athena.allCSSPackages()
+
+
+
 theHashModuleProvider = HashedJSModuleProvider()
+theHashCSSModuleProvider = HashedCSSModuleProvider()
 
-__all__ = ['HashedJSModuleProvider',
-           'theHashModuleProvider']
+__all__ = ['HashedJSModuleProvider', 'HashedCSSModuleProvider',
+           'HashedJSBundleCache',
+           'theHashModuleProvider', 'theHashCSSModuleProvider']
@@ -4,7 +4,7 @@
 General functionality re-usable by various concrete fulltext indexing systems.
 """
 
-import atexit, os, weakref, warnings
+import atexit, os, weakref, warnings, time
 
 from zope.interface import implements
 
@@ -27,6 +27,17 @@ LUCENE_INDEX_DIR = u'lucene.index'
 
 VERBOSE = True
 
+# The number of pages of results SQLiteIndexer keeps for repeated searches.
+SEARCH_CACHE_SIZE = 20
+
+# The most documents SQLiteIndexer indexes in one batch step, and inserts in
+# one transaction.
+BULK_INSERT_SIZE = 500
+
+# The number of documents SQLiteIndexer adds between optimizations of the
+# index.
+OPTIMIZE_INTERVAL = 50000
+
 class IndexCorrupt(Exception):
     """
     An attempt was made to open an index which has had unrecoverable data
@@ -193,11 +204,19 @@ class RemoteIndexer(object):
         if VERBOSE:
             log.msg("%s/%d removing %r" % (self.store, self.storeID, documentIdentifiers))
         reader = self.openReadIndex()
-        map(reader.remove, documentIdentifiers)
+        self._removeDocuments(reader, documentIdentifiers)
         reader.close()
         remove.deleteFromStore()
 
 
+    def _removeDocuments(self, reader, documentIdentifiers):
+        """
+        Remove the documents with the given identifiers from an index opened
+        with L{openReadIndex}.
+        """
+        map(reader.remove, documentIdentifiers)
+
+
     # IReliableListener
     def suspend(self):
         self._flush() # Make sure any pending deletes are processed.
@@ -762,6 +781,10 @@ class _SQLiteResultWrapper(object):
 class _SQLiteIndex(object):
     """
     FTS3 index interface.
+
+    Added documents are buffered and inserted together in one transaction once
+    C{bufferSize} of them have been added, when L{flush} is called, and before
+    the index is searched, removed from, or closed.
     """
 
     addSQL = """
@@ -777,11 +800,26 @@ class _SQLiteIndex(object):
     FROM fts
     WHERE content MATCH ?
     ORDER BY docid %s
+    LIMIT ? OFFSET ?
+    """
+
+    versionSQL = """
+    PRAGMA data_version
     """
 
-    def __init__(self, store):
+    optimizeSQL = """
+    INSERT INTO fts (fts) VALUES ('optimize')
+    """
+
+    def __init__(self, store, bufferSize=1):
         self.store = store
-        self.close = self.store.close
+        self.bufferSize = bufferSize
+        self._pending = []
+
+
+    def close(self):
+        self.flush()
+        self.store.close()
 
 
     def add(self, document):
@@ -791,28 +829,84 @@ class _SQLiteIndex(object):
         docid = int(document.uniqueIdentifier())
         text = u' '.join(document.textParts())
 
-        self.store.executeSQL(self.addSQL, (docid, text))
+        self._pending.append((docid, text))
+        if len(self._pending) >= self.bufferSize:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Insert the buffered documents into the database.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        before = time.time()
+        try:
+            self.store.transact(self.store.executeManySQL, self.addSQL, pending)
+        except:
+            self._pending[:0] = pending
+            raise
+        log.msg(interface=iaxiom.IStatEvent, name='fulltext',
+                stat_fulltext_documents=len(pending),
+                stat_fulltext_time=time.time() - before)
 
 
     def remove(self, docid):
         """
         Remove a document from the database.
         """
-        docid = int(docid)
-        self.store.executeSQL(self.removeSQL, (docid,))
+        self.removeMany([docid])
 
 
-    def search(self, term, keywords=None, sortAscending=True):
+    def removeMany(self, docids):
+        """
+        Remove several documents from the database in one transaction.
+        """
+        self.flush()
+        self.store.transact(self.store.executeManySQL, self.removeSQL,
+                            [(int(docid),) for docid in docids])
+
+
+    def optimize(self):
+        """
+        Merge the index's segments, making searches faster.
+        """
+        self.flush()
+        self.store.executeSQL(self.optimizeSQL)
+
+
+    def search(self, term, keywords=None, sortAscending=True,
+               count=None, offset=0):
         """
         Search the database.
+
+        @param count: the maximum number of results to return, or C{None} for
+            all of them.
+        @param offset: the number of results to skip.
         """
+        self.flush()
         if sortAscending:
             direction = 'ASC'
         else:
             direction = 'DESC'
+        if count is None:
+            count = -1
 
         return [_SQLiteResultWrapper(r[0]) for r in
-                self.store.querySQL(self.searchSQL % (direction,), (term,))]
+                self.store.querySQL(self.searchSQL % (direction,),
+                                    (term, count, offset))]
+
+
+    def version(self):
+        """
+        Return a value which changes whenever another connection commits a
+        change to the database, or C{None} if SQLite cannot tell.
+        """
+        rows = self.store.querySQL(self.versionSQL)
+        if rows:
+            return rows[0][0]
+        return None
 
 
 
@@ -820,6 +914,15 @@ class SQLiteIndexer(RemoteIndexer, item.Item):
     """
     Indexer implementation using SQLite FTS3.
 
+    Searches use a long-lived connection to the index, which SQLite lets
+    read while the batch process writes to it, so they do not suspend
+    indexing unless there are removals to apply first.  Recently found pages
+    of results are kept until the index changes.
+
+    Documents are indexed in bulk, up to L{BULK_INSERT_SIZE} per batch step
+    and transaction, and the index is optimized every L{OPTIMIZE_INTERVAL}
+    documents.
+
     XXX: Keywords are currently not supported; see #2877
     """
     indexCount = attributes.integer(default=0)
@@ -827,6 +930,15 @@ class SQLiteIndexer(RemoteIndexer, item.Item):
 
     _index = attributes.inmemory()
 
+    batchSize = BULK_INSERT_SIZE
+
+    # The _SQLiteIndex searches are run against, or None if it is not open.
+    _reader = attributes.inmemory()
+
+    # Maps search terms, keywords, sort orders, counts and offsets to the
+    # index version their results were found at and those results.
+    _searchCache = attributes.inmemory()
+
     schemaSQL = """
     CREATE VIRTUAL TABLE fts
     USING fts3(content)
@@ -855,8 +967,121 @@ class SQLiteIndexer(RemoteIndexer, item.Item):
 
 
     def openReadIndex(self):
-        return self.openWriteIndex()
+        return _SQLiteIndex(self._getStore())
 
 
     def openWriteIndex(self):
-        return _SQLiteIndex(self._getStore())
+        return _SQLiteIndex(self._getStore(), BULK_INSERT_SIZE)
+
+
+    def add(self, item):
+        RemoteIndexer.add(self, item)
+        if self._index is not None and self.indexCount % OPTIMIZE_INTERVAL == 0:
+            self._index.optimize()
+
+
+    def stepFinished(self):
+        """
+        Insert the documents buffered by the write index during this batch
+        step, before the batch process records them as indexed.
+        """
+        if self._index is not None:
+            self._index.flush()
+
+
+    def _flush(self):
+        """
+        Insert the documents buffered by the write index before applying
+        pending removals, so that those documents can be removed too.
+        """
+        if self._index is not None:
+            self._index.flush()
+        RemoteIndexer._flush(self)
+
+
+    def _removeDocuments(self, reader, documentIdentifiers):
+        reader.removeMany(documentIdentifiers)
+
+
+    def activate(self):
+        RemoteIndexer.activate(self)
+        self._reader = None
+        self._searchCache = {}
+
+
+    def __finalizer__(self):
+        finalizeIndex = RemoteIndexer.__finalizer__(self)
+        d = self.__dict__
+        def finalize():
+            finalizeIndex()
+            reader = d.get('_reader', None)
+            if reader is not None:
+                reader.close()
+        return finalize
+
+
+    def reset(self):
+        self._closeReader()
+        RemoteIndexer.reset(self)
+
+
+    def _closeReader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._searchCache.clear()
+
+
+    def search(self, aString, keywords=None, count=None, offset=0,
+               sortAscending=True, retry=3):
+        """
+        Search the index without suspending the batch process, unless there
+        are pending removals which it must apply first.
+        """
+        pending = self.store.query(
+            _RemoveDocument, _RemoveDocument.indexer == self).count()
+        if pending:
+            return RemoteIndexer.search(
+                self, aString, keywords, count, offset, sortAscending, retry)
+        return defer.maybeDeferred(
+            self._searchReader, aString, keywords, count, offset,
+            sortAscending)
+
+
+    def _searchReader(self, aString, keywords, count, offset, sortAscending):
+        """
+        Search the long-lived reader for the requested page of results, using
+        cached results if the index has not changed since they were found.
+
+        The count and offset are applied in the database, and each page is
+        cached on its own.  A page can also be sliced out of the cached
+        results of a search for all of them.
+        """
+        if self._reader is None:
+            self._reader = self.openReadIndex()
+        version = self._reader.version()
+        keywordKey = None
+        if keywords:
+            keywordKey = tuple(sorted(keywords.items()))
+        search = (aString, keywordKey, sortAscending)
+
+        cached = self._searchCache.get(search + (count, offset))
+        if cached is not None and version is not None and cached[0] == version:
+            return list(cached[1])
+        cached = self._searchCache.get(search + (None, 0))
+        if cached is not None and version is not None and cached[0] == version:
+            if count is None:
+                return cached[1][offset:]
+            return cached[1][offset:offset + count]
+
+        results = self._reader.search(
+            aString, keywords, sortAscending, count, offset)
+        if VERBOSE:
+            log.msg("%s/%d found %d results for %s" % (
+                    self.store, self.storeID, len(results),
+                    aString.encode('utf-8')))
+        if version is not None:
+            if len(self._searchCache) >= SEARCH_CACHE_SIZE:
+                self._searchCache.clear()
+            self._searchCache[search + (count, offset)] = (version, results)
+        return list(results)
@@ -14,12 +14,13 @@ from zope.interface import implements
 
 from twisted.python.components import registerAdapter
 from twisted.python.reflect import qual
+from twisted.internet import reactor, defer
 
 from epsilon.extime import Time
 
 from nevow.athena import LiveElement, expose
 
-from axiom.attributes import timestamp, SQLAttribute, AND
+from axiom.attributes import timestamp, SQLAttribute, AND, OR
 
 from xmantissa.ixmantissa import IWebTranslator, IColumn
 from xmantissa.error import Unsortable
@@ -758,12 +759,37 @@ class ScrollableView(object):
 class ItemQueryScrollingFragment(IndexingModel, ScrollableView, LiveElement):
     """
     An L{ItemQueryScrollingFragment} is an Athena L{LiveElement} that can
-    display an Axiom query using an inefficient, but precise, method for
-    counting rows and getting data at given offsets when requested.
+    display an Axiom query, counting rows and getting data at given offsets
+    when requested.
+
+    To keep large queries cheap, subclasses may set C{cacheLifetime} to cache
+    the row count and to remember the sort values of the first and last rows
+    of each range fetched as anchors, so that a later range can be found by
+    comparing against the nearest anchor rather than by skipping every row
+    before it.  This only works when the sort column is an attribute of
+    C{itemType}; otherwise rows are found by offset, as they always used to
+    be.  Changes made through L{performAction} discard the cache, and
+    L{requestCurrentSize} always counts the rows again; other changes are
+    only noticed once the cache is C{cacheLifetime} seconds old, unless they
+    are reported with L{itemAdded}, L{itemRemoved} or L{invalidate}, so
+    subclasses should only enable caching if they report them.
 
     New code which wants to display a scrollable list of data should probably
     use L{ScrollingElement} instead.
+
+    @ivar cacheLifetime: The number of seconds for which the row count and
+        anchors are trusted, or C{None} to trust them until invalidated.  By
+        default it is C{0}, and they are not trusted beyond the request which
+        found them.
+
+    @ivar clock: The L{IReactorTime} provider used to age the cache.
     """
+    cacheLifetime = 0
+    clock = reactor
+
+    _cachedCount = None
+    _cacheTime = None
+
     def __init__(self, store, itemType, baseConstraint, columns,
                  defaultSortColumn=None, defaultSortAscending=True,
                  webTranslator=None,
@@ -778,6 +804,9 @@ class ItemQueryScrollingFragment(IndexingModel, ScrollableView, LiveElement):
             defaultSortColumn,
             defaultSortAscending)
         LiveElement.__init__(self, *a, **kw)
+        # Mapping of (sort attribute, isAscending) to a mapping of row
+        # indexes to the sort keys of the rows at those indexes.
+        self._anchors = {}
 
 
     def _cannotDetermineSort(self, defaultSortColumn):
@@ -799,20 +828,242 @@ class ItemQueryScrollingFragment(IndexingModel, ScrollableView, LiveElement):
         return [self.getTableMetadata()]
 
 
+    def invalidate(self):
+        """
+        Forget the cached row count and anchors, so that the next request
+        reflects any changes to the underlying items.
+        """
+        self._cachedCount = None
+        self._cacheTime = None
+        self._anchors = {}
+
+
+    def _checkCache(self):
+        """
+        Discard the cache if it is older than C{cacheLifetime}, and start
+        aging it again if it is empty.
+        """
+        now = self.clock.seconds()
+        if (self._cacheTime is not None and self.cacheLifetime is not None
+            and now - self._cacheTime >= self.cacheLifetime):
+            self.invalidate()
+        if self._cacheTime is None:
+            self._cacheTime = now
+
+
+    def _keysetAttribute(self):
+        """
+        Return the attribute to sort by if rows can be found by comparing
+        against anchors, or C{None} if they can only be found by offset.
+        """
+        if self.currentSortColumn is None:
+            return None
+        sortAttribute = self.currentSortColumn.sortAttribute()
+        if (isinstance(sortAttribute, SQLAttribute)
+            and sortAttribute.type is self.itemType):
+            return sortAttribute
+        return None
+
+
+    def _sortKey(self, sortAttribute, item):
+        return (sortAttribute.__get__(item, type(item)), item.storeID)
+
+
+    def _precedes(self, left, right):
+        """
+        Determine whether the row with sort key C{left} comes before the row
+        with sort key C{right} in the current sort order.  NULLs sort first
+        in ascending order, as they do in SQLite.
+        """
+        left = (left[0] is not None,) + left
+        right = (right[0] is not None,) + right
+        if self.isAscending:
+            return left < right
+        return left > right
+
+
+    def _segmentsAfter(self, sortAttribute, (value, storeID)):
+        """
+        Return comparisons matching, in order, the runs of rows after the row
+        with the given sort key in the current sort order.
+
+        NULLs are kept in a run of their own, rather than ORed in, so that
+        each comparison can be satisfied from an index on the sort column in
+        sort order.
+        """
+        if self.isAscending:
+            if value is None:
+                return [AND(sortAttribute == None,
+                            self.itemType.storeID > storeID),
+                        sortAttribute != None]
+            return [AND(sortAttribute >= value,
+                        OR(sortAttribute > value,
+                           self.itemType.storeID > storeID))]
+        if value is None:
+            return [AND(sortAttribute == None,
+                        self.itemType.storeID < storeID)]
+        return [AND(sortAttribute <= value,
+                    OR(sortAttribute < value,
+                       self.itemType.storeID < storeID)),
+                sortAttribute == None]
+
+
+    def _rowsAfter(self, sortAttribute, key, skip, limit):
+        """
+        Return up to C{limit} items, skipping C{skip}, from those after the
+        row with sort key C{key}.
+        """
+        items = []
+        for constraint in self._segmentsAfter(sortAttribute, key):
+            found = self._rowQuery(sortAttribute, constraint, self.isAscending,
+                                   skip, limit - len(items))
+            if found:
+                skip = 0
+            elif skip:
+                # The whole run was skipped; it is no longer than skip, so
+                # counting it is cheap.
+                if self.baseConstraint is not None:
+                    constraint = AND(self.baseConstraint, constraint)
+                skip -= self.store.query(self.itemType, constraint).count()
+            items.extend(found)
+            if len(items) >= limit:
+                break
+        return items
+
+
+    def _rowQuery(self, sortAttribute, constraint, isAscending, offset, limit):
+        if self.baseConstraint is not None:
+            if constraint is None:
+                constraint = self.baseConstraint
+            else:
+                constraint = AND(self.baseConstraint, constraint)
+        if isAscending:
+            sort = (sortAttribute.ascending, self.itemType.storeID.ascending)
+        else:
+            sort = (sortAttribute.descending, self.itemType.storeID.descending)
+        return list(self.store.query(self.itemType, constraint, sort=sort,
+                                     offset=offset or None, limit=limit))
+
+
+    def itemAdded(self, item):
+        """
+        Update the cache for an item which has been added to this
+        scrolltable's query.
+        """
+        self._itemChanged(item, 1)
+
+
+    def itemRemoved(self, item):
+        """
+        Update the cache for an item which is about to be removed from this
+        scrolltable's query.  This must be called while C{item} can still be
+        loaded.
+        """
+        self._itemChanged(item, -1)
+
+
+    def _itemChanged(self, item, delta):
+        if self._cachedCount is not None:
+            self._cachedCount += delta
+        sortAttribute = self._keysetAttribute()
+        if sortAttribute is None:
+            return
+        key = self._sortKey(sortAttribute, item)
+        anchors = self._anchors.get((sortAttribute, self.isAscending))
+        if not anchors:
+            return
+        shifted = {}
+        for (index, anchor) in anchors.iteritems():
+            if anchor == key:
+                continue
+            if self._precedes(key, anchor):
+                index += delta
+            shifted[index] = anchor
+        self._anchors[sortAttribute, self.isAscending] = shifted
+
+
+    def performAction(self, name, rowID):
+        """
+        Perform the named action, then discard the cache, since the action
+        may have changed the rows.
+        """
+        result = IndexingModel.performAction(self, name, rowID)
+        self.invalidate()
+        if isinstance(result, defer.Deferred):
+            def invalidate(passthrough):
+                self.invalidate()
+                return passthrough
+            result.addBoth(invalidate)
+        return result
+    expose(performAction)
+
+
+    def requestCurrentSize(self):
+        """
+        Count the rows again, since this is how the client refreshes its idea
+        of the size, keeping only the cached anchors.
+        """
+        self._cachedCount = None
+        return IndexingModel.requestCurrentSize(self)
+    expose(requestCurrentSize)
+
+
     def performCount(self):
-        return self.store.query(self.itemType, self.baseConstraint).count()
+        self._checkCache()
+        if self._cachedCount is None:
+            self._cachedCount = self.store.query(
+                self.itemType, self.baseConstraint).count()
+        return self._cachedCount
 
 
     def performQuery(self, rangeBegin, rangeEnd):
-        if self.isAscending:
-            sort = self.currentSortColumn.sortAttribute().ascending
+        sortAttribute = self._keysetAttribute()
+        if sortAttribute is None:
+            if self.isAscending:
+                sort = self.currentSortColumn.sortAttribute().ascending
+            else:
+                sort = self.currentSortColumn.sortAttribute().descending
+            return list(self.store.query(self.itemType,
+                                         self.baseConstraint,
+                                         offset=rangeBegin,
+                                         limit=rangeEnd - rangeBegin,
+                                         sort=sort))
+
+        self._checkCache()
+        anchors = self._anchors.setdefault(
+            (sortAttribute, self.isAscending), {})
+        limit = rangeEnd - rangeBegin
+        if limit <= 0:
+            return []
+
+        # Start from the nearest row before the range whose key is known, or
+        # from the beginning.
+        anchorIndex = -1
+        for index in anchors:
+            if anchorIndex < index < rangeBegin:
+                anchorIndex = index
+        skip = rangeBegin - anchorIndex - 1
+
+        count = self._cachedCount
+        if count is not None and max(count - rangeEnd, 0) < skip:
+            # Closer to the end: count backwards from there instead.
+            offset = max(count - rangeEnd, 0)
+            items = self._rowQuery(
+                sortAttribute, None, not self.isAscending, offset,
+                max(min(rangeEnd, count) - rangeBegin, 0))
+            items.reverse()
+        elif anchorIndex == -1:
+            items = self._rowQuery(
+                sortAttribute, None, self.isAscending, skip, limit)
         else:
-            sort = self.currentSortColumn.sortAttribute().descending
-        return list(self.store.query(self.itemType,
-                                     self.baseConstraint,
-                                     offset=rangeBegin,
-                                     limit=rangeEnd - rangeBegin,
-                                     sort=sort))
+            items = self._rowsAfter(
+                sortAttribute, anchors[anchorIndex], skip, limit)
+
+        if items:
+            anchors[rangeBegin] = self._sortKey(sortAttribute, items[0])
+            anchors[rangeBegin + len(items) - 1] = self._sortKey(
+                sortAttribute, items[-1])
+        return items
 ScrollingFragment = ItemQueryScrollingFragment
 
 
@@ -878,8 +1129,7 @@ class StoreIDSequenceScrollingFragment(SequenceScrollingFragment):
     backed by a sequence of Item storeID values rather than Items themselves.
     """
     def performQuery(self, rangeBegin, rangeEnd):
-        return map(
-            self.store.getItemByID,
+        return self.store.getItemsByIDs(
             super(
                 StoreIDSequenceScrollingFragment,
                 self).performQuery(rangeBegin, rangeEnd))
@@ -896,10 +1146,10 @@ class SearchResultScrollingFragment(SequenceScrollingFragment):
     def performQuery(self, rangeBegin, rangeEnd):
         results = SequenceScrollingFragment.performQuery(
             self, rangeBegin, rangeEnd)
-        return [
-            self.store.getItemByID(int(hit.uniqueIdentifier))
+        return self.store.getItemsByIDs([
+            int(hit.uniqueIdentifier)
             for hit
-            in results]
+            in results])
 
 
 
@@ -1,13 +1,20 @@
 import sha
+from StringIO import StringIO
+from gzip import GzipFile
 
 from twisted.trial.unittest import TestCase
 from twisted.python.filepath import FilePath
+from twisted.internet.task import Clock
+from twisted.web import http
 
 from nevow.inevow import IRequest
 from nevow.context import WovenContext
 from nevow.testutil import FakeRequest
 
-from xmantissa.cachejs import HashedJSModuleProvider, CachedJSModule
+from nevow import athena
+
+from xmantissa.cachejs import (
+    HashedJSModuleProvider, HashedCSSModuleProvider, CachedJSModule)
 
 
 class JSCachingTestCase(TestCase):
@@ -43,16 +50,29 @@ class JSCachingTestCase(TestCase):
         CachedJSModule.wasModified = self._wasModified
 
 
-    def _render(self, resource):
+    def _render(self, resource, headers={}):
         """
         Test helper which tries to render the given resource.
         """
         ctx = WovenContext()
-        req = FakeRequest(headers={'host': self.hostname})
+        headers = dict(headers)
+        headers['host'] = self.hostname
+        req = FakeRequest(headers=headers)
         ctx.remember(req, IRequest)
         return req, resource.renderHTTP(ctx)
 
 
+    def _locateDummy(self):
+        """
+        Cache the dummy module and return the resource which serves it.
+        """
+        self.moduleProvider.moduleCache[self.MODULE_NAME] = CachedJSModule(
+            self.MODULE_NAME, FilePath(self.moduleFile))
+        resource, segs = self.moduleProvider.locateChild(
+            None, [sha.new(self.MODULE_CONTENT).hexdigest(), self.MODULE_NAME])
+        return resource
+
+
     def test_hashExpiry(self):
         """
         L{HashedJSModuleProvider.resourceFactory} should return a L{static.Data}
@@ -92,3 +112,180 @@ class JSCachingTestCase(TestCase):
         module1 = self.moduleProvider.getModule("Mantissa.Test.Dummy")
         module2 = self.moduleProvider.getModule("Mantissa.Test.Dummy")
         self.assertEqual(self.callsToWasModified, 1)
+
+
+    def test_compressed(self):
+        """
+        A client which accepts gzip is sent the module compressed, with an
+        ETag distinct from the uncompressed one.
+        """
+        resource = self._locateDummy()
+        req, result = self._render(resource, {'accept-encoding': 'gzip'})
+        self.assertEqual(req.headers['content-encoding'], 'gzip')
+        self.assertEqual(req.headers['content-length'], str(len(result)))
+        self.assertEqual(req.headers['vary'], 'accept-encoding')
+        self.assertEqual(
+            GzipFile(fileobj=StringIO(result)).read(), self.MODULE_CONTENT)
+        hashValue = sha.new(self.MODULE_CONTENT).hexdigest()
+        self.assertEqual(req.headers['etag'], '"%s-gzip"' % (hashValue,))
+
+        req, result = self._render(resource)
+        self.assertNotIn('content-encoding', req.headers)
+        self.assertEqual(result, self.MODULE_CONTENT)
+        self.assertEqual(req.headers['etag'], '"%s"' % (hashValue,))
+
+
+    def test_notModified(self):
+        """
+        A request conditional on the ETag of the current contents gets an
+        empty I{Not Modified} response.
+        """
+        resource = self._locateDummy()
+        etag = '"%s"' % (sha.new(self.MODULE_CONTENT).hexdigest(),)
+        req, result = self._render(resource, {'if-none-match': etag})
+        self.assertEqual(req.code, http.NOT_MODIFIED)
+        self.assertEqual(result, '')
+
+        req, result = self._render(
+            resource, {'if-none-match': '"stale", ' + etag})
+        self.assertEqual(req.code, http.NOT_MODIFIED)
+
+        req, result = self._render(resource, {'if-none-match': '"stale"'})
+        self.assertEqual(req.code, http.OK)
+        self.assertEqual(result, self.MODULE_CONTENT)
+
+
+    def test_precache(self):
+        """
+        L{HashedJSModuleProvider.precache} loads every module returned by
+        L{HashedJSModuleProvider.allModules}.
+        """
+        self.moduleProvider.allModules = lambda: {
+            self.MODULE_NAME: self.moduleFile}
+        self.moduleProvider.precache()
+        module = self.moduleProvider.moduleCache[self.MODULE_NAME]
+        self.assertEqual(module.fileContents, self.MODULE_CONTENT)
+        self.assertIdentical(
+            self.moduleProvider.getModule(self.MODULE_NAME), module)
+
+
+    def test_recheck(self):
+        """
+        While rechecking is started, modules are checked for changes every
+        C{recheckInterval} seconds and not otherwise, and the dependency memo
+        is cleared when one has changed.
+        """
+        clock = Clock()
+        self.moduleProvider.clock = clock
+        self.moduleProvider.allModules = lambda: {
+            self.MODULE_NAME: self.moduleFile}
+        self.moduleProvider.startRechecking()
+        module = self.moduleProvider.getModule(self.MODULE_NAME)
+        self.assertEqual(self.callsToWasModified, 1)
+
+        self.moduleProvider.locateChild(None, [module.hashValue, self.MODULE_NAME])
+        self.assertEqual(self.callsToWasModified, 1)
+
+        self.moduleProvider.depsMemo['x'] = 'y'
+        clock.advance(self.moduleProvider.recheckInterval)
+        self.assertEqual(self.callsToWasModified, 2)
+        self.assertEqual(self.moduleProvider.depsMemo, {'x': 'y'})
+
+        FilePath(self.moduleFile).setContent('/* Changed. */\n')
+        clock.advance(self.moduleProvider.recheckInterval)
+        self.assertEqual(module.fileContents, '/* Changed. */\n')
+        self.assertEqual(
+            module.hashValue, sha.new('/* Changed. */\n').hexdigest())
+        self.assertEqual(self.moduleProvider.depsMemo, {})
+
+        self.moduleProvider.stopRechecking()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_nestedRechecking(self):
+        """
+        Rechecking stops only once L{HashedJSModuleProvider.stopRechecking}
+        has been called as many times as
+        L{HashedJSModuleProvider.startRechecking}.
+        """
+        clock = Clock()
+        self.moduleProvider.clock = clock
+        self.moduleProvider.allModules = lambda: {}
+        self.moduleProvider.startRechecking()
+        self.moduleProvider.startRechecking()
+        self.moduleProvider.stopRechecking()
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        self.moduleProvider.stopRechecking()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_cssModules(self):
+        """
+        L{HashedCSSModuleProvider} serves CSS modules as C{text/css}.
+        """
+        provider = HashedCSSModuleProvider()
+        self.assertEqual(provider.allModules(), athena.allCSSPackages())
+        provider.moduleCache[self.MODULE_NAME] = CachedJSModule(
+            self.MODULE_NAME, FilePath(self.moduleFile))
+        resource, segs = provider.locateChild(
+            None, [sha.new(self.MODULE_CONTENT).hexdigest(), self.MODULE_NAME])
+        req, result = self._render(resource)
+        self.assertEqual(req.headers['content-type'], 'text/css')
+        self.assertEqual(result, self.MODULE_CONTENT)
+
+
+    def test_precomputeDependencies(self):
+        """
+        L{HashedJSModuleProvider.precomputeDependencies} fills the dependency
+        memo for every module Athena knows about, ignoring any it does not.
+        """
+        self.moduleProvider.allModules = lambda: {
+            u'Mantissa.Test.Dummy': None, self.MODULE_NAME: self.moduleFile}
+        self.moduleProvider.precomputeDependencies()
+        module = athena.jsDeps.getModuleForName(u'Mantissa.Test.Dummy')
+        self.assertEqual(
+            self.moduleProvider.depsMemo[u'Mantissa.Test.Dummy'],
+            module.dependencies())
+        self.assertNotIn(self.MODULE_NAME, self.moduleProvider.depsMemo)
+
+
+    def test_precomputeUnresolvableDependencies(self):
+        """
+        L{HashedJSModuleProvider.precomputeDependencies} skips modules which
+        import modules Athena does not know about, without logging an error.
+        """
+        self.moduleProvider.allModules = lambda: {
+            u'Nevow.Test.TestHowtoListing00': None,
+            u'Mantissa.Test.Dummy': None}
+        self.moduleProvider.precomputeDependencies()
+        self.assertNotIn(
+            u'Nevow.Test.TestHowtoListing00', self.moduleProvider.depsMemo)
+        self.assertIn(u'Mantissa.Test.Dummy', self.moduleProvider.depsMemo)
+
+
+    def test_bundles(self):
+        """
+        L{HashedJSModuleProvider.bundles} bundles the cached contents of
+        modules, serves them compressed like single modules, and forgets them
+        when a module changes.
+        """
+        self.moduleProvider.clock = Clock()
+        self.moduleProvider.allModules = lambda: {
+            self.MODULE_NAME: self.moduleFile}
+        self.moduleProvider.startRechecking()
+        self.addCleanup(self.moduleProvider.stopRechecking)
+
+        bundles = self.moduleProvider.bundles
+        bundle = bundles.getBundle([self.MODULE_NAME])
+        self.assertIn(self.MODULE_CONTENT, bundle.contents)
+        resource, segments = bundles.locateChild(None, [bundle.hashValue])
+        req, result = self._render(resource, {'accept-encoding': 'gzip'})
+        self.assertEqual(
+            GzipFile(fileobj=StringIO(result)).read(), bundle.contents)
+        self.assertEqual(req.headers['etag'], '"%s-gzip"' % (bundle.hashValue,))
+
+        self.assertIdentical(bundles.getBundle([self.MODULE_NAME]), bundle)
+        FilePath(self.moduleFile).setContent('/* Changed. */\n')
+        self.moduleProvider.clock.advance(self.moduleProvider.recheckInterval)
+        self.assertIn(
+            '/* Changed. */\n', bundles.getBundle([self.MODULE_NAME]).contents)
@@ -4,7 +4,8 @@ from zope.interface import implements
 
 from twisted.trial import unittest
 from twisted.application.service import IService
-from twisted.internet.defer import gatherResults
+from twisted.python import log
+from twisted.internet.defer import gatherResults, succeed
 
 from axiom import iaxiom, store, batch, item, attributes
 from axiom.userbase import LoginSystem
@@ -929,3 +930,265 @@ class SQLiteIndexerAPISearchTestCase(SQLiteTestsMixin, IndexerAPISearchTestsMixi
     """
     def test_DifficultTokens(self):
         raise unittest.SkipTest("SQLite tokenizer can't handle all of these")
+
+
+
+class SQLiteSearchReaderTestCase(SQLiteTestsMixin, IndexerTestsMixin,
+                                 unittest.TestCase):
+    """
+    Tests for searching an L{SQLiteIndexer} with a long-lived reader.
+    """
+    def setUp(self):
+        IndexerTestsMixin.setUp(self)
+        self.addCleanup(self.indexer._closeReader)
+        self._index([u'apple'] * 5)
+
+
+    def _index(self, texts, start=0):
+        writer = self.openWriteIndex()
+        for i, text in enumerate(texts):
+            writer.add(IndexableThing(
+                    _documentType=u'thing',
+                    _uniqueIdentifier=str(start + i),
+                    _textParts=[text],
+                    _keywordParts={}))
+        writer.close()
+
+
+    def _search(self, *a, **kw):
+        results = []
+        self.indexer.search(*a, **kw).addCallback(results.append)
+        return identifiersFrom(results[0])
+
+
+    def test_limitOffset(self):
+        """
+        L{_SQLiteIndex.search} applies the count and offset in the database.
+        """
+        reader = self.openReadIndex()
+        self.addCleanup(reader.close)
+        self.assertEquals(
+            identifiersFrom(reader.search(u'apple', count=2, offset=1)),
+            [1, 2])
+        self.assertEquals(
+            identifiersFrom(reader.search(u'apple', sortAscending=False,
+                                          offset=3)),
+            [1, 0])
+
+
+    def test_noSuspend(self):
+        """
+        Searching does not suspend the batch process, and keeps using the same
+        reader.
+        """
+        self.assertEquals(self._search(u'apple', count=3, offset=1),
+                          [1, 2, 3])
+        reader = self.indexer._reader
+        self.assertNotIdentical(reader, None)
+        self.assertEquals(self._search(u'apple', sortAscending=False),
+                          [4, 3, 2, 1, 0])
+        self.assertIdentical(self.indexer._reader, reader)
+
+
+    def test_cachedResults(self):
+        """
+        Repeating a search returns the earlier results without searching the
+        index again.  Other pages are searched for with their count and offset,
+        unless all of the results have been found already.
+        """
+        if self._version() is None:
+            raise unittest.SkipTest("SQLite does not report data_version")
+        self._search(u'apple', count=2)
+        searches = []
+        search = self.indexer._reader.search
+        def countingSearch(*a):
+            searches.append(a)
+            return search(*a)
+        self.indexer._reader.search = countingSearch
+        self.assertEquals(self._search(u'apple', count=2), [0, 1])
+        self.assertEquals(searches, [])
+        self.assertEquals(self._search(u'apple', count=2, offset=2), [2, 3])
+        self.assertEquals(searches, [(u'apple', None, True, 2, 2)])
+        self.assertEquals(self._search(u'apple'), range(5))
+        self.assertEquals(self._search(u'apple', count=2, offset=3), [3, 4])
+        self.assertEquals(self._search(u'apple', offset=1), [1, 2, 3, 4])
+        self.assertEquals(len(searches), 2)
+
+
+    def test_cacheInvalidatedByWrites(self):
+        """
+        Cached results are not used once the index has been written to.
+        """
+        if self._version() is None:
+            raise unittest.SkipTest("SQLite does not report data_version")
+        self.assertEquals(self._search(u'apple'), range(5))
+        self._index([u'apple'], 5)
+        self.assertEquals(self._search(u'apple'), range(6))
+
+
+    def _version(self):
+        reader = self.openReadIndex()
+        try:
+            return reader.version()
+        finally:
+            reader.close()
+
+
+    def test_pendingRemovals(self):
+        """
+        If there are removals which have not been applied to the index,
+        searching suspends the batch process so that they are applied.
+        """
+        calls = []
+        def search(self, *a):
+            calls.append(a)
+            return succeed([])
+        self.patch(fulltext.RemoteIndexer, 'search', search)
+        self.indexer.remove(IndexableThing(
+                _documentType=u'thing',
+                _uniqueIdentifier='1',
+                _textParts=[u'apple'],
+                _keywordParts={}))
+        self.assertEquals(self._search(u'apple'), [])
+        self.assertEquals(len(calls), 1)
+
+
+
+class SQLiteBulkIndexingTestCase(SQLiteTestsMixin, IndexerTestsMixin,
+                                 unittest.TestCase):
+    """
+    Tests for adding and removing documents from an L{SQLiteIndexer} in bulk.
+    """
+    def setUp(self):
+        IndexerTestsMixin.setUp(self)
+        self.reader = self.openReadIndex()
+        self.addCleanup(self.reader.close)
+
+
+    def _thing(self, identifier):
+        return IndexableThing(
+            _documentType=u'thing',
+            _uniqueIdentifier=str(identifier),
+            _textParts=[u'apple'],
+            _keywordParts={})
+
+
+    def _indexed(self):
+        return identifiersFrom(self.reader.search(u'apple'))
+
+
+    def test_bufferSize(self):
+        """
+        Added documents are inserted together once there are C{bufferSize} of
+        them, and the number inserted is logged.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        writer = fulltext._SQLiteIndex(self.indexer._getStore(), 3)
+        self.addCleanup(writer.close)
+        writer.add(self._thing(1))
+        writer.add(self._thing(2))
+        self.assertEquals(self._indexed(), [])
+        writer.add(self._thing(3))
+        self.assertEquals(self._indexed(), [1, 2, 3])
+        self.assertEquals(
+            [event['stat_fulltext_documents'] for event in events
+             if 'stat_fulltext_documents' in event],
+            [3])
+
+
+    def test_close(self):
+        """
+        Closing an index inserts the buffered documents.
+        """
+        writer = fulltext._SQLiteIndex(self.indexer._getStore(), 3)
+        writer.add(self._thing(1))
+        writer.close()
+        self.assertEquals(self._indexed(), [1])
+
+
+    def test_batchStep(self):
+        """
+        L{SQLiteIndexer} indexes up to its C{batchSize} documents in each
+        batch step, and inserts them before the step's transaction commits.
+        """
+        self.patch(fulltext.SQLiteIndexer, 'batchSize', 2)
+        source = batch.processor(IndexableThing)(store=self.store)
+        self.indexer.addSource(source)
+        # Keep the things, so that their in-memory attributes are too.
+        self.things = [IndexableThing(store=self.store,
+                                      _documentType=u'thing',
+                                      _uniqueIdentifier=str(i),
+                                      _textParts=[u'apple'],
+                                      _keywordParts={})
+                       for i in range(3)]
+        self.failUnless(self.store.transact(source.step, style=iaxiom.REMOTE))
+        self.assertEquals(self._indexed(), [0, 1])
+        self.failIf(self.store.transact(source.step, style=iaxiom.REMOTE))
+        self.assertEquals(self._indexed(), [0, 1, 2])
+
+
+    def test_removeMany(self):
+        """
+        L{_SQLiteIndex.removeMany} inserts the buffered documents and then
+        removes all of the given documents.
+        """
+        writer = fulltext._SQLiteIndex(self.indexer._getStore(), 10)
+        self.addCleanup(writer.close)
+        for i in range(4):
+            writer.add(self._thing(i))
+        writer.removeMany(['0', '2'])
+        self.assertEquals(self._indexed(), [1, 3])
+
+
+    def test_flushRemovals(self):
+        """
+        Pending removals are applied to the index together.
+        """
+        calls = []
+        removeMany = fulltext._SQLiteIndex.removeMany
+        def recordingRemoveMany(index, docids):
+            calls.append(list(docids))
+            return removeMany(index, docids)
+        self.patch(fulltext._SQLiteIndex, 'removeMany', recordingRemoveMany)
+        things = [self._thing(i) for i in range(3)]
+        for thing in things:
+            self.indexer.add(thing)
+        self.indexer.remove(things[0])
+        self.indexer.remove(things[2])
+        self.indexer._flush()
+        self.assertEquals(calls, [['0', '2']])
+        self.assertEquals(self._indexed(), [1])
+
+
+    def test_removeBuffered(self):
+        """
+        Documents which are still buffered by the write index when they are
+        removed stay removed once the index is closed.
+        """
+        things = [self._thing(i) for i in range(3)]
+        for thing in things:
+            self.indexer.processItem(thing)
+        self.indexer.remove(things[1])
+        self.indexer.suspend()
+        self.assertEquals(self._indexed(), [0, 2])
+
+
+    def test_indexerOptimizes(self):
+        """
+        L{SQLiteIndexer} optimizes its index every L{OPTIMIZE_INTERVAL}
+        documents.
+        """
+        optimized = []
+        optimize = fulltext._SQLiteIndex.optimize
+        def recordingOptimize(index):
+            optimized.append(self.indexer.indexCount)
+            return optimize(index)
+        self.patch(fulltext._SQLiteIndex, 'optimize', recordingOptimize)
+        self.patch(fulltext, 'OPTIMIZE_INTERVAL', 2)
+        for i in range(5):
+            self.indexer.add(self._thing(i))
+        self.assertEquals(optimized, [2, 4])
+        self.indexer._closeIndex()
+        self.assertEquals(self._indexed(), range(5))
@@ -13,6 +13,7 @@ from zope.interface import implements
 
 from twisted.trial import unittest
 from twisted.trial.util import suppress as SUPPRESS
+from twisted.internet.task import Clock
 
 from axiom.store import Store
 from axiom.item import Item
@@ -243,6 +244,190 @@ class ScrollingFragmentTestCase(ScrollTestMixin,
 
 
 
+class ScrollingFragmentCacheTests(unittest.TestCase):
+    """
+    Tests for the row count cache and the anchored range queries of
+    L{ScrollingFragment}.
+    """
+    def setUp(self):
+        self.store = Store()
+        values = [3, None, 1, 3, 2, None, 3, 0, 1, 2, 3, 0]
+        self.items = [DataThunk(store=self.store, a=value, b=i)
+                      for (i, value) in enumerate(values)]
+        self.fragment = ScrollingFragment(
+            self.store, DataThunk, None, [DataThunk.a, DataThunk.b],
+            DataThunk.a)
+        self.fragment.linkToItem = lambda ign: None
+        self.fragment.cacheLifetime = 60
+        self.clock = self.fragment.clock = Clock()
+
+
+    def expected(self):
+        """
+        Return all the items in the order the fragment should present them:
+        sorted by C{a}, then by store ID, with C{None} first.
+        """
+        result = sorted(
+            self.store.query(DataThunk),
+            key=lambda item: (item.a is not None, item.a, item.storeID))
+        if not self.fragment.isAscending:
+            result.reverse()
+        return result
+
+
+    def assertRanges(self, ranges):
+        for (begin, end) in ranges:
+            self.assertEquals(
+                self.fragment.performQuery(begin, end),
+                self.expected()[begin:end])
+
+
+    def test_ascendingRanges(self):
+        """
+        Ranges fetched in any order, including ones starting at a previously
+        fetched row, contain the same rows as slices of the full sort.
+        """
+        self.assertRanges([(0, 3), (3, 6), (8, 12), (6, 8), (2, 5), (5, 9),
+                           (11, 15)])
+
+
+    def test_descendingRanges(self):
+        """
+        Like L{test_ascendingRanges}, but for a descending sort.
+        """
+        self.fragment.isAscending = False
+        self.assertRanges([(0, 3), (3, 6), (8, 12), (6, 8), (2, 5), (5, 9),
+                           (11, 15)])
+
+
+    def test_rangesFromEnd(self):
+        """
+        With the row count known, ranges near the end are counted from there.
+        """
+        self.assertEquals(self.fragment.performCount(), len(self.items))
+        self.assertRanges([(10, 12), (9, 11), (11, 14)])
+        self.fragment.isAscending = False
+        self.assertRanges([(10, 12), (0, 1)])
+
+
+    def test_resort(self):
+        """
+        Rows fetched after resorting are in the new order.
+        """
+        self.assertRanges([(0, 4), (4, 8)])
+        self.fragment.resort('b')
+        self.assertEquals(
+            [item.b for item in self.fragment.performQuery(4, 8)],
+            [4, 5, 6, 7])
+        self.fragment.resort('a')
+        self.assertRanges([(4, 8)])
+
+
+    def test_countCached(self):
+        """
+        The row count is computed once and then reused until it is
+        C{cacheLifetime} seconds old.
+        """
+        counter = QueryCounter(self.store)
+        self.failIfEqual(counter.measure(self.fragment.performCount), 0)
+        self.assertEquals(counter.measure(self.fragment.performCount), 0)
+        DataThunk(store=self.store, a=5)
+        self.assertEquals(self.fragment.performCount(), len(self.items))
+        self.clock.advance(self.fragment.cacheLifetime)
+        self.assertEquals(self.fragment.performCount(), len(self.items) + 1)
+
+
+    def test_requestCurrentSize(self):
+        """
+        L{ScrollingFragment.requestCurrentSize} counts the rows again, even
+        while the cached count is still trusted.
+        """
+        self.fragment.performCount()
+        DataThunk(store=self.store, a=5)
+        self.assertEquals(
+            self.fragment.requestCurrentSize(), len(self.items) + 1)
+
+
+    def test_notCachedByDefault(self):
+        """
+        By default, the row count and anchors are not reused by later
+        requests, so rows added without telling the fragment are seen at
+        once.
+        """
+        fragment = ScrollingFragment(
+            self.store, DataThunk, None, [DataThunk.a, DataThunk.b],
+            DataThunk.a)
+        fragment.clock = self.clock
+        self.assertEquals(fragment.performCount(), len(self.items))
+        fragment.performQuery(0, 4)
+        added = DataThunk(store=self.store, a=None)
+        self.assertEquals(fragment.performCount(), len(self.items) + 1)
+        self.assertIn(added, fragment.performQuery(0, 4))
+        self.assertEquals(fragment.performQuery(0, 4), self.expected()[:4])
+
+
+    def test_invalidate(self):
+        """
+        L{ScrollingFragment.invalidate} discards the cached row count.
+        """
+        self.fragment.performCount()
+        DataThunk(store=self.store, a=5)
+        self.fragment.invalidate()
+        self.assertEquals(self.fragment.performCount(), len(self.items) + 1)
+
+
+    def test_performActionInvalidates(self):
+        """
+        Performing an action discards the cache.
+        """
+        self.fragment.itemFromLink = lambda link: self.items[int(link)]
+        self.fragment.action_delete = lambda item: item.deleteFromStore()
+        self.assertRanges([(0, 4)])
+        self.fragment.performCount()
+        self.fragment.performAction('delete', '2')
+        self.assertEquals(self.fragment.performCount(), len(self.items) - 1)
+        self.assertRanges([(4, 8), (0, 4)])
+
+
+    def test_itemAddedAndRemoved(self):
+        """
+        L{ScrollingFragment.itemAdded} and L{ScrollingFragment.itemRemoved}
+        keep the cached row count and anchors up to date.
+        """
+        self.fragment.performCount()
+        self.assertRanges([(0, 4), (4, 8)])
+        self.fragment.itemAdded(DataThunk(store=self.store, a=1))
+        self.fragment.itemAdded(DataThunk(store=self.store, a=None))
+        self.assertEquals(self.fragment.performCount(), len(self.items) + 2)
+        self.assertRanges([(8, 10), (4, 8)])
+        for item in self.items[:3]:
+            self.fragment.itemRemoved(item)
+            item.deleteFromStore()
+        self.assertEquals(self.fragment.performCount(), len(self.items) - 1)
+        self.assertRanges([(8, 10), (4, 8), (0, 3)])
+
+
+    def test_anchoredCost(self):
+        """
+        Fetching the range after one already fetched costs the same however
+        many rows precede it.
+        """
+        for i in range(30):
+            DataThunkWithIndex(store=self.store, a=i)
+        fragment = ScrollingFragment(
+            self.store, DataThunkWithIndex, None, [DataThunkWithIndex.a],
+            DataThunkWithIndex.a)
+        fragment.cacheLifetime = None
+        counter = QueryCounter(self.store)
+        fragment.performQuery(0, 2)
+        first = counter.measure(fragment.performQuery, 2, 4)
+        for i in range(4, 20, 2):
+            fragment.performQuery(i, i + 2)
+        second = counter.measure(fragment.performQuery, 20, 22)
+        self.assertEquals(first, second)
+
+
+
 class SequenceScrollingFragmentTestCase(ScrollTestMixin, unittest.TestCase):
     """
     Run the general scrolling tests against L{SequenceScrollingFragment}.
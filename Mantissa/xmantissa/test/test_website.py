@@ -26,7 +26,8 @@ from nevow.testutil import FakeRequest
 from nevow.url import URL
 from nevow.inevow import IResource, IRequest
 from nevow.rend import WovenContext, NotFound
-from nevow.athena import LivePage, LiveElement, AthenaModule, jsDeps
+from nevow.athena import (
+    LivePage, LiveElement, AthenaModule, jsDeps, allCSSPackages)
 from nevow.guard import LOGIN_AVATAR
 from nevow.loaders import stan
 
@@ -46,7 +47,7 @@ from xmantissa._webutil import VirtualHostWrapper
 from xmantissa.publicweb import LoginPage
 from xmantissa.offering import installOffering
 from xmantissa.plugins.baseoff import baseOffering
-from xmantissa.cachejs import theHashModuleProvider
+from xmantissa.cachejs import theHashModuleProvider, theHashCSSModuleProvider
 from xmantissa.website import WebSite
 from xmantissa.webapp import PrivateApplication
 from xmantissa.websharing import SharingIndex
@@ -601,6 +602,28 @@ class UnguardedWrapperTests(TestCase):
         self.assertIdentical(resource, theHashModuleProvider)
 
 
+    def test_cssmodules(self):
+        """
+        L{UnguardedWrapper} has a I{__cssmodule__} child which serves Athena
+        CSS modules.
+        """
+        request = FakeRequest(uri='/__cssmodule__/foo', currentSegments=[])
+        wrapper = UnguardedWrapper(None, None)
+        resource = wrapper.child___cssmodule__(request)
+        self.assertIdentical(resource, theHashCSSModuleProvider)
+
+
+    def test_jsbundles(self):
+        """
+        L{UnguardedWrapper} has a I{__jsbundle__} child which serves the
+        bundles of the global JavaScript module provider.
+        """
+        request = FakeRequest(uri='/__jsbundle__/foo', currentSegments=[])
+        wrapper = UnguardedWrapper(None, None)
+        resource = wrapper.child___jsbundle__(request)
+        self.assertIdentical(resource, theHashModuleProvider.bundles)
+
+
     def test_static(self):
         """
         L{UnguardedWrapper} has a I{static} child which returns a
@@ -1153,6 +1176,8 @@ class AthenaResourcesTestCase(TestCase):
         page.beforeRender(request)
         self.assertEqual(receivedRequests, [request])
         self.assertEqual(page._moduleRoot, root.child('__jsmodule__'))
+        self.assertEqual(page._cssModuleRoot, root.child('__cssmodule__'))
+        self.assertEqual(page._bundleRoot, root.child('__jsbundle__'))
 
 
     def test_getJSModuleURL(self):
@@ -1174,6 +1199,41 @@ class AthenaResourcesTestCase(TestCase):
                          url.child(expect).child(module))
 
 
+    def test_getJSBundleURL(self):
+        """
+        L{MantissaLivePage.getJSBundleURL} should return a child of its
+        C{_bundleRoot} attribute named by the hash of the bundle, which comes
+        from the global JavaScript module provider.
+        """
+        url = URL(scheme='https', netloc='example.com', pathsegs=['foo'])
+        page = MantissaLivePage(None)
+        self.assertTrue(page.bundleModules)
+        self.assertIdentical(page.jsBundles, theHashModuleProvider.bundles)
+        bundle = page.jsBundles.getBundle([u'Mantissa'])
+        self.assertRaises(NotImplementedError, page.getJSBundleURL, bundle)
+        page._bundleRoot = url
+        self.assertEqual(page.getJSBundleURL(bundle),
+                         url.child(bundle.hashValue))
+
+
+    def test_getCSSModuleURL(self):
+        """
+        L{MantissaLivePage.getCSSModuleURL} should return a child of its
+        C{_cssModuleRoot} attribute of the form::
+
+            _cssModuleRoot/<SHA1 digest of module contents>/Package.ModuleName
+        """
+        module = u'Nevow'
+        url = URL(scheme='https', netloc='example.com', pathsegs=['foo'])
+        page = MantissaLivePage(None)
+        self.assertRaises(NotImplementedError, page.getCSSModuleURL, module)
+        page._cssModuleRoot = url
+        moduleContents = FilePath(allCSSPackages()[module]).getContent()
+        expect = sha.new(moduleContents).hexdigest()
+        self.assertEqual(page.getCSSModuleURL(module),
+                         url.child(expect).child(module))
+
+
     def test_jsCaching(self):
         """
         Rendering a L{MantissaLivePage} causes each of its dependent modules to
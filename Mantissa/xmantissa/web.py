@@ -29,7 +29,7 @@ from axiom.userbase import LoginSystem
 
 from xmantissa.ixmantissa import ISiteURLGenerator, IProtocolFactoryFactory, IOfferingTechnician, ISessionlessSiteRootPlugin
 from xmantissa.port import TCPPort, SSLPort
-from xmantissa.cachejs import theHashModuleProvider
+from xmantissa.cachejs import theHashModuleProvider, theHashCSSModuleProvider
 from xmantissa.websession import PersistentSessionWrapper
 
 
@@ -50,6 +50,26 @@ class AxiomSite(NevowSite):
         self.requestFactory = lambda *a, **kw: AxiomRequest(self.store, *a, **kw)
 
 
+    def startFactory(self):
+        """
+        Precache the static Athena modules, and keep them up to date for as
+        long as this site is serving requests.
+        """
+        NevowSite.startFactory(self)
+        theHashModuleProvider.startRechecking()
+        theHashCSSModuleProvider.startRechecking()
+
+
+    def stopFactory(self):
+        """
+        Stop keeping the static Athena modules up to date on behalf of this
+        site.
+        """
+        theHashCSSModuleProvider.stopRechecking()
+        theHashModuleProvider.stopRechecking()
+        NevowSite.stopFactory(self)
+
+
 
 class SiteConfiguration(Item):
     """
@@ -214,6 +234,22 @@ class UnguardedWrapper(record('siteStore guardedRoot')):
         return theHashModuleProvider
 
 
+    def child___cssmodule__(self, ignored):
+        """
+        __cssmodule__ child which serves Athena CSS modules the same way
+        L{child___jsmodule__} serves JavaScript modules.
+        """
+        return theHashCSSModuleProvider
+
+
+    def child___jsbundle__(self, ignored):
+        """
+        __jsbundle__ child which serves the bundles of JavaScript modules
+        loaded by L{xmantissa.website.MantissaLivePage}.
+        """
+        return theHashModuleProvider.bundles
+
+
     def child_Mantissa(self, ctx):
         """
         Serve files from C{xmantissa/static/} at the URL C{/Mantissa}.
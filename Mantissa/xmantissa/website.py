@@ -43,7 +43,7 @@ from xmantissa.ixmantissa import (
     ISiteURLGenerator)
 from xmantissa.port import TCPPort, SSLPort
 from xmantissa.web import SiteConfiguration
-from xmantissa.cachejs import theHashModuleProvider
+from xmantissa.cachejs import theHashModuleProvider, theHashCSSModuleProvider
 from xmantissa._webutil import SiteRootMixin
 
 
@@ -62,16 +62,34 @@ class MantissaLivePage(athena.LivePage):
         L{xmantissa.cachejs.CachedJSModule} objects.
     @type hashCache: L{xmantissa.cachejs.HashedJSModuleProvider}
 
+    @ivar cssHashCache: a cache which maps CSS module names to
+        L{xmantissa.cachejs.CachedJSModule} objects.
+    @type cssHashCache: L{xmantissa.cachejs.HashedCSSModuleProvider}
+
     @type _moduleRoot: L{URL}
     @ivar _moduleRoot: The base location for script tags which load Athena
         modules required by this page and widgets on this page.  This is set
         based on the I{Host} header in the request, so it is C{None} until
         the instance is actually rendered.
+
+    @type _cssModuleRoot: L{URL}
+    @ivar _cssModuleRoot: Like L{_moduleRoot}, but for the stylesheets of
+        Athena CSS modules.
+
+    @type _bundleRoot: L{URL}
+    @ivar _bundleRoot: Like L{_moduleRoot}, but for the bundles of modules
+        which are loaded instead of individual modules.
     """
 
     hashCache = theHashModuleProvider
+    cssHashCache = theHashCSSModuleProvider
+
+    bundleModules = True
+    jsBundles = theHashModuleProvider.bundles
 
     _moduleRoot = None
+    _cssModuleRoot = None
+    _bundleRoot = None
 
     def __init__(self, webSite, *a, **k):
         """
@@ -83,6 +101,7 @@ class MantissaLivePage(athena.LivePage):
         athena.LivePage.__init__(self, transportRoot=url.root.child('live'),
                                  *a, **k)
         self._jsDepsMemo = self.hashCache.depsMemo
+        self._cssDepsMemo = self.cssHashCache.depsMemo
 
 
     def beforeRender(self, ctx):
@@ -94,6 +113,8 @@ class MantissaLivePage(athena.LivePage):
         request = IRequest(ctx)
         root = self.webSite.rootURL(request)
         self._moduleRoot = root.child('__jsmodule__')
+        self._cssModuleRoot = root.child('__cssmodule__')
+        self._bundleRoot = root.child('__jsbundle__')
 
 
     def getJSModuleURL(self, moduleName):
@@ -118,6 +139,33 @@ class MantissaLivePage(athena.LivePage):
         return self._moduleRoot.child(moduleHash).child(moduleName)
 
 
+    def getCSSModuleURL(self, moduleName):
+        """
+        Retrieve an L{URL} object which references the given CSS module name.
+        See L{getJSModuleURL}.
+
+        @raise NotImplementedError: if rendering has not begun yet.
+        """
+        if self._cssModuleRoot is None:
+            raise NotImplementedError(
+                "CSS module URLs cannot be requested before rendering.")
+        moduleHash = self.cssHashCache.getModule(moduleName).hashValue
+        return self._cssModuleRoot.child(moduleHash).child(moduleName)
+
+
+    def getJSBundleURL(self, bundle):
+        """
+        Retrieve an L{URL} object which references the given bundle of
+        modules, in the same way as L{getJSModuleURL}.
+
+        @raise NotImplementedError: if rendering has not begun yet.
+        """
+        if self._bundleRoot is None:
+            raise NotImplementedError(
+                "JS bundle URLs cannot be requested before rendering.")
+        return self._bundleRoot.child(bundle.hashValue)
+
+
 
 JUST_SLASH = ('',)
 
@@ -0,0 +1,90 @@
+
+from time import time
+from cStringIO import StringIO
+
+from twisted.python.usage import Options
+from twisted.internet.task import Clock
+
+from nevow.page import Element, renderer
+from nevow.loaders import stan
+from nevow.tags import directive, div, span, a
+from nevow._flat import deferflatten
+from nevow.compression import CompressingRequestWrapper
+from nevow.testutil import FakeRequest
+
+if __name__ == '__main__':
+    from bufferedflatten import main
+    raise SystemExit(main())
+
+
+
+class BufferedFlatten(Options):
+    optParameters = [
+        ('iterations', 'i', '100', 'Number of iterations for which to run the benchmark.'),
+        ('scale', 's', '1000', 'Number of rows in the page flattened.'),
+        ('buffer-size', 'b', None, 'Size of the output buffer, or unbuffered if omitted.')]
+
+    optFlags = [
+        ('gzip', 'z', 'Compress the output as CompressingRequestWrapper does.')]
+
+
+    def postOptions(self):
+        self['iterations'] = int(self['iterations'])
+        self['scale'] = int(self['scale'])
+        if self['buffer-size'] is not None:
+            self['buffer-size'] = int(self['buffer-size'])
+
+
+
+class Row(Element):
+    docFactory = stan(div(render=directive("row")))
+
+    def __init__(self, index):
+        self.index = index
+
+
+    def row(self, request, tag):
+        return tag(class_="row")[
+            span["Row ", str(self.index)],
+            a(href="/item/%d" % (self.index,))["<Details & more>"]]
+    renderer(row)
+
+
+
+def benchmark(iterations, scale, bufferSize, gzip):
+    """
+    Flatten a page of C{scale} rows C{iterations} times, writing the output in
+    chunks of at least C{bufferSize} bytes, to a
+    L{CompressingRequestWrapper} if C{gzip} is set.
+
+    Prints the mean time per flatten and the number of writes per flatten.
+    """
+    root = div[[Row(i) for i in xrange(scale)]]
+    writes = [0]
+    elapsed = 0.0
+    for i in xrange(iterations):
+        output = StringIO()
+        if gzip:
+            output = CompressingRequestWrapper(FakeRequest())
+            output.clock = Clock()
+        def write(data):
+            writes[0] += 1
+            output.write(data)
+        before = time()
+        deferflatten(None, root, False, True, write, bufferSize)
+        if gzip:
+            output.finishRequest(True)
+        elapsed += time() - before
+    print elapsed / iterations, 'per call,', writes[0] / iterations, 'writes'
+
+
+
+def main(args=None):
+    """
+    Benchmark flattening a large page with nevow._flat.deferflatten, maybe with
+    an output buffer.
+    """
+    options = BufferedFlatten()
+    options.parseOptions(args)
+    benchmark(options['iterations'], options['scale'],
+              options['buffer-size'], options['gzip'])
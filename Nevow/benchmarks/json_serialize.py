@@ -0,0 +1,50 @@
+
+from time import time
+
+from twisted.python.usage import Options
+
+from nevow.json import serialize
+
+if __name__ == '__main__':
+    from json_serialize import main
+    raise SystemExit(main())
+
+
+
+class Serialize(Options):
+    optParameters = [
+        ('iterations', 'i', '1000', 'Number of iterations for which to run the benchmark.'),
+        ('scale', 's', '100', 'Factor determining the overall input size.')]
+
+
+    def postOptions(self):
+        self['iterations'] = int(self['iterations'])
+        self['scale'] = int(self['scale'])
+
+
+BASE = {
+    u'name': u'Hello, world.  "Quotes".',
+    u'values': [1, 2.5, None, True, False],
+    u'nested': {u'text': u'\xe1\xe9\xed\xf3\xfa\xfd', u'count': 10L}}
+def benchmark(iterations, scale):
+    """
+    Serialize a list of C{scale} small dictionaries C{iterations} times.
+
+    Prints the mean time per serialize call.
+    """
+    obj = [BASE] * scale
+    before = time()
+    for i in xrange(iterations):
+        serialize(obj)
+    after = time()
+    print (after - before) / iterations, 'per call'
+
+
+
+def main(args=None):
+    """
+    Benchmark nevow.json serialization, maybe with some parameters.
+    """
+    options = Serialize()
+    options.parseOptions(args)
+    benchmark(options['iterations'], options['scale'])
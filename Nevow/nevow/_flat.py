@@ -19,6 +19,7 @@ from sys import exc_info
 from types import GeneratorType
 from traceback import extract_tb, format_list
 
+from twisted.python.failure import Failure
 from twisted.internet.defer import Deferred
 
 from nevow.inevow import IRenderable, IRenderer, IRendererFactory, IData
@@ -268,29 +269,29 @@ def _flatten(request, root, slotData, renderFactory, inAttribute, inXML):
                                             False, True):
                         yield element
                 else:
-                    yield '<'
                     if isinstance(root.tagName, unicode):
                         tagName = root.tagName.encode('ascii')
                     else:
                         tagName = str(root.tagName)
-                    yield tagName
+                    # Markup up to the next dynamic part, yielded together.
+                    markup = '<' + tagName
                     for k, v in root.attributes.iteritems():
                         if isinstance(k, unicode):
                             k = k.encode('ascii')
-                        yield " " + k + "=\""
+                        yield markup + " " + k + "=\""
                         for element in _flatten(request, v, slotData,
                                                 renderFactory, True, True):
                             yield element
-                        yield "\""
+                        markup = "\""
                     if root.children or tagName not in allowSingleton:
-                        yield '>'
+                        yield markup + '>'
                         for element in _flatten(request, root.children,
                                                 slotData, renderFactory,
                                                 False, True):
                             yield element
                         yield '</' + tagName + '>'
                     else:
-                        yield ' />'
+                        yield markup + ' />'
             else:
                 if isinstance(root.render, directive):
                     rendererName = root.render.name
@@ -306,8 +307,13 @@ def _flatten(request, root, slotData, renderFactory, inAttribute, inXML):
         yield escapedData(str(root), inAttribute, inXML)
     elif isinstance(root, (tuple, list, GeneratorType)):
         for element in root:
-            yield _flatten(request, element, slotData, renderFactory,
-                           inAttribute, inXML)
+            if type(element) is raw and not inAttribute:
+                # Precompiled documents are mostly runs of markup which have
+                # already been quoted, so pass those straight through.
+                yield str(element)
+            else:
+                yield _flatten(request, element, slotData, renderFactory,
+                               inAttribute, inXML)
     elif isinstance(root, Entity):
         yield '&#'
         yield root.num
@@ -435,44 +441,121 @@ def flatten(request, root, inAttribute, inXML):
 
 
 
-def _flattensome(state, write, schedule, result):
+class _OutputBuffer(object):
+    """
+    Collect strings and pass them on to another writer function joined
+    together.
+
+    @ivar _buffer: A C{list} of the C{str}s written since the last flush.
+
+    @ivar _length: The total length of the C{str}s in C{_buffer}.
+    """
+    def __init__(self, write, size):
+        """
+        @param write: A callable which will be invoked with the collected
+            C{str}s joined together.
+
+        @param size: The number of bytes to collect before invoking C{write}.
+        """
+        self._write = write
+        self._size = size
+        self._buffer = []
+        self._length = 0
+
+
+    def write(self, data):
+        """
+        Collect C{data}, passing it and everything collected before it on if
+        that makes at least C{size} bytes.
+        """
+        self._buffer.append(data)
+        self._length += len(data)
+        if self._length >= self._size:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Pass on everything collected so far.
+        """
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._length = 0
+            self._write(data)
+
+
+
+_WAITING = object()
+
+def _flattensome(state, write, schedule, result, flush=None):
     """
     Take strings from an iterator and pass them to a writer function.
 
     @param state: An iterator of C{str} and L{Deferred}.  C{str} instances will
         be passed to C{write}.  L{Deferred} instances will be waited on before
-        resuming iteration of C{state}.
+        resuming iteration of C{state}, unless they already have a result, in
+        which case iteration continues immediately.
 
     @param write: A callable which will be invoked with each C{str}
         produced by iterating C{state}.
 
     @param schedule: A callable which will arrange for a function to be called
-        with some positional arguments I{later}.  This is used to avoid
-        unbounded call stack depth due to already-fired L{Deferred}s produced
-        by C{state}.
+        with some positional arguments I{later}.  This is used to resume
+        iteration of C{state} once a L{Deferred} which had no result when it
+        was produced gets one.
 
     @param result: A L{Deferred} which will be called back when C{state} has
         been completely flattened into C{write} or which will be errbacked if
         an unexpected exception occurs.
 
+    @param flush: C{None}, or a callable which will be invoked with no
+        arguments when C{state} is finished and before waiting on a
+        L{Deferred}, if C{write} may hold on to what it is passed.
+
     @return: C{None}
     """
     while True:
         try:
             element = state.next()
         except StopIteration:
+            if flush is not None:
+                flush()
             result.callback(None)
         except:
-            result.errback()
+            failure = Failure()
+            if flush is not None:
+                flush()
+            result.errback(failure)
         else:
             if type(element) is str:
                 write(element)
                 continue
             else:
+                # None until the Deferred fires or this stops waiting for it,
+                # then True if it fired synchronously with a result, False if
+                # it failed synchronously, or the waiting marker.
+                status = [None]
                 def cby(original):
-                    schedule(_flattensome, state, write, schedule, result)
+                    if status[0] is None:
+                        status[0] = True
+                    else:
+                        schedule(_flattensome, state, write, schedule, result,
+                                 flush)
                     return original
-                element.addCallbacks(cby, result.errback)
+                def eby(failure):
+                    if status[0] is None:
+                        status[0] = False
+                    result.errback(failure)
+                element.addCallbacks(cby, eby)
+                if status[0]:
+                    # It already had a result, so keep going in this frame
+                    # rather than waiting for a reactor iteration.
+                    continue
+                if status[0] is None:
+                    status[0] = _WAITING
+                    if flush is not None:
+                        flush()
         break
 
 
@@ -489,7 +572,7 @@ def _schedule(f, *a):
 
 
 
-def deferflatten(request, root, inAttribute, inXML, write):
+def deferflatten(request, root, inAttribute, inXML, write, bufferSize=None):
     """
     Incrementally write out a string representation of C{root} using C{write}.
 
@@ -519,11 +602,25 @@ def deferflatten(request, root, inAttribute, inXML, write):
     @param write: A callable which will be invoked with each C{str}
         produced by flattening C{root}.
 
+    @type bufferSize: C{int} or C{None}
+    @param bufferSize: If not C{None}, the C{str}s produced are joined
+        together and passed to C{write} once at least this many bytes have
+        been produced, and before waiting for any L{Deferred} and when
+        flattening is finished, so that C{write} is invoked far less often.
+        Nothing in Nevow asks for this: L{nevow.rend.Page} and the
+        L{nevow.page.Element}s in it are written by the old flattener, which
+        already joins everything produced between L{Deferred}s into one
+        string.
+
     @return: A L{Deferred} which will be called back when C{root} has
         been completely flattened into C{write} or which will be errbacked if
         an unexpected exception occurs.
     """
     result = Deferred()
     state = flatten(request, root, inAttribute, inXML)
-    _flattensome(state, write, _schedule, result)
+    if bufferSize is None:
+        _flattensome(state, write, _schedule, result)
+    else:
+        buffer = _OutputBuffer(write, bufferSize)
+        _flattensome(state, buffer.write, _schedule, result, buffer.flush)
     return result
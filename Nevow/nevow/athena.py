@@ -1,6 +1,10 @@
 # -*- test-case-name: nevow.test.test_athena -*-
 
 import itertools, os, re, warnings
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
 
 from zope.interface import implements
 
@@ -124,6 +128,136 @@ class MappingResource(object):
 
 
 
+class JSBundle(object):
+    """
+    Several JavaScript modules concatenated, in order, into one script along
+    with their module declarations.
+
+    @ivar moduleNames: The names of the modules in the bundle.
+    @type moduleNames: C{tuple} of C{unicode}
+
+    @ivar contents: The script.
+    @type contents: C{str}
+
+    @ivar hashValue: The hex-encoded SHA1 hash of L{contents}.
+    @type hashValue: C{str}
+    """
+    def __init__(self, moduleNames, contents):
+        self.moduleNames = moduleNames
+        self.contents = contents
+        self.hashValue = sha1(contents).hexdigest()
+
+
+
+class JSBundleCache(object):
+    """
+    L{inevow.IResource} which creates L{JSBundle}s and serves them by their
+    hashes.  Pages which need the same modules share the same bundle.
+
+    Module source is read once per bundle; call L{clear} if modules change.
+
+    @ivar bundleFactory: The type of bundles to create, called with the
+        module names and the script.
+
+    @ivar maxSupersededBundles: The number of bundles forgotten by L{clear}
+        which are still served, for pages loaded before it was called.  The
+        least recently served are dropped first.
+
+    @ivar expires: The number of seconds for which clients may cache a
+        bundle.  Since a bundle's URL changes whenever its contents do, this
+        is effectively forever.
+    """
+    implements(inevow.IResource)
+
+    bundleFactory = JSBundle
+    expires = 60 * 60 * 24 * 365 * 5
+    maxSupersededBundles = 20
+
+    def __init__(self):
+        self._bundlesByNames = {}
+        self._bundlesByHash = {}
+        # Hashes of the bundles in _bundlesByHash which have been forgotten by
+        # clear, least recently served first.
+        self._superseded = []
+
+
+    def getSource(self, moduleName):
+        """
+        Return the source of the named JavaScript module.
+
+        @rtype: C{str}
+        """
+        module = jsDeps.getModuleForName(moduleName)
+        return file(module.mapping[module.name], 'rb').read()
+
+
+    def getBundle(self, moduleNames):
+        """
+        Return the bundle of the named modules, creating it if no page has
+        asked for it since the last L{clear}.
+
+        @param moduleNames: The names of the modules to bundle, each after
+            all of those it depends on.
+
+        @rtype: L{JSBundle}
+        """
+        moduleNames = tuple(moduleNames)
+        bundle = self._bundlesByNames.get(moduleNames)
+        if bundle is None:
+            parts = []
+            for moduleName in moduleNames:
+                parts.append(jsModuleDeclaration(moduleName))
+                parts.append('\n')
+                parts.append(self.getSource(moduleName))
+                parts.append('\n')
+            bundle = self.bundleFactory(moduleNames, ''.join(parts))
+            self._bundlesByNames[moduleNames] = bundle
+            self._bundlesByHash[bundle.hashValue] = bundle
+            if bundle.hashValue in self._superseded:
+                self._superseded.remove(bundle.hashValue)
+        return bundle
+
+
+    def clear(self):
+        """
+        Forget all bundles, so that they are recreated from the current module
+        source the next time they are needed.  Clients may still retrieve up to
+        C{maxSupersededBundles} forgotten bundles by hash, since the pages they
+        loaded refer to them.
+        """
+        for bundle in self._bundlesByNames.itervalues():
+            self._superseded.append(bundle.hashValue)
+        self._bundlesByNames.clear()
+        while len(self._superseded) > self.maxSupersededBundles:
+            del self._bundlesByHash[self._superseded.pop(0)]
+
+
+    def resourceFactory(self, bundle):
+        """
+        Retrieve an L{inevow.IResource} which will render C{bundle}.
+        """
+        return static.Data(bundle.contents, 'text/javascript', self.expires)
+
+
+    def renderHTTP(self, ctx):
+        return rend.FourOhFour()
+
+
+    def locateChild(self, ctx, segments):
+        try:
+            bundle = self._bundlesByHash[segments[0]]
+        except KeyError:
+            return rend.NotFound
+        else:
+            if bundle.hashValue in self._superseded:
+                self._superseded.remove(bundle.hashValue)
+                self._superseded.append(bundle.hashValue)
+            return self.resourceFactory(bundle), []
+
+_theJSBundleCache = JSBundleCache()
+
+
+
 def _dependencyOrdered(coll, memo):
     """
     @type coll: iterable of modules
@@ -651,11 +785,54 @@ class ReliableMessageDelivery(object):
     @type connectionMade: callable or C{None}
     @ivar connectionMade: A callback invoked with no arguments when it first
         becomes possible to to send a message to the client.
+
+    @type coalesceDelay: C{float}
+    @ivar coalesceDelay: The amount of time (in seconds) to hold on to a new
+        message while an output is available, so that any other messages
+        added in the meantime go out in the same response.  If C{0}, messages
+        are sent as soon as there is an output for them.
+
+    @type coalesceCount: C{int} or C{None}
+    @ivar coalesceCount: The number of new messages which will be sent
+        without waiting for the rest of C{coalesceDelay}, or C{None} to always
+        wait.
+
+    @type maxQueuedMessages: C{int} or C{None}
+    @ivar maxQueuedMessages: The number of unacknowledged messages to allow.
+        Adding a message beyond this closes the connection and drops the
+        queue, since a client so far behind is not going to catch up.  If
+        C{None}, there is no limit.
+
+    @type seconds: callable or C{None}
+    @ivar seconds: If passed, this is used in place of C{reactor.seconds}.
+
+    @type maxQueueLength: C{int}
+    @ivar maxQueueLength: The greatest number of unacknowledged messages
+        there have been at once.
+
+    @type lastLatency: C{float} or C{None}
+    @ivar lastLatency: The time (in seconds) between the oldest message in
+        the most recently sent response being added and it being sent, or
+        C{None} if no messages have been sent.
+
+    @type maxLatency: C{float}
+    @ivar maxLatency: The greatest value L{lastLatency} has had.
     """
     _paused = 0
     _stopped = False
     _connected = False
 
+    _coalesceCall = None
+
+    # The number of messages added since messages were last sent, and the
+    # time the first of them was added.
+    _unsent = 0
+    _unsentSince = None
+
+    maxQueueLength = 0
+    lastLatency = None
+    maxLatency = 0
+
     outgoingAck = -1            # sequence number which has been acknowledged
                                 # by this end of the connection.
 
@@ -667,7 +844,10 @@ class ReliableMessageDelivery(object):
                  connectTimeout=60, transportlessTimeout=30, idleTimeout=300,
                  connectionLost=None,
                  scheduler=None,
-                 connectionMade=None):
+                 connectionMade=None,
+                 coalesceDelay=0, coalesceCount=None,
+                 maxQueuedMessages=None,
+                 seconds=None):
         self.livePage = livePage
         self.messages = []
         self.outputs = []
@@ -677,6 +857,12 @@ class ReliableMessageDelivery(object):
         if scheduler is None:
             scheduler = reactor.callLater
         self.scheduler = scheduler
+        if seconds is None:
+            seconds = reactor.seconds
+        self.seconds = seconds
+        self.coalesceDelay = coalesceDelay
+        self.coalesceCount = coalesceCount
+        self.maxQueuedMessages = maxQueuedMessages
         self._transportlessTimeoutCall = self.scheduler(self.connectTimeout, self._connectTimedOut)
         self.connectionMade = connectionMade
         self.connectionLost = connectionLost
@@ -700,10 +886,25 @@ class ReliableMessageDelivery(object):
 
 
     def _sendMessagesToOutput(self, output):
-        log.msg(athena_send_messages=True, count=len(self.messages))
+        if self._coalesceCall is not None:
+            self._coalesceCall.cancel()
+            self._coalesceCall = None
+        if self._unsent:
+            self.lastLatency = self.seconds() - self._unsentSince
+            self.maxLatency = max(self.maxLatency, self.lastLatency)
+            self._unsent = 0
+            self._unsentSince = None
+        log.msg(athena_send_messages=True, count=len(self.messages),
+                latency=self.lastLatency)
         output([self.outgoingAck, self.messages])
 
 
+    def _coalesceTimedOut(self):
+        self._coalesceCall = None
+        if not self._paused:
+            self._trySendMessages()
+
+
     def pause(self):
         self._paused += 1
 
@@ -736,14 +937,48 @@ class ReliableMessageDelivery(object):
         if self._stopped:
             return
 
+        if (self.maxQueuedMessages is not None and
+            len(self.messages) >= self.maxQueuedMessages):
+            self._queueOverflowed()
+            return
+        self._enqueue(msg)
+
+
+    def _enqueue(self, msg):
+        """
+        Add C{msg} to the outgoing queue, and send it if it should not wait
+        for others.
+        """
         self.outgoingSeq += 1
         self.messages.append((self.outgoingSeq, msg))
+        self.maxQueueLength = max(self.maxQueueLength, len(self.messages))
+        if not self._unsent:
+            self._unsentSince = self.seconds()
+        self._unsent += 1
+
         if not self._paused and self.outputs:
-            output, timeout = self.outputs.pop(0)
-            timeout.cancel()
-            if not self.outputs:
-                self._transportlessTimeoutCall = self.scheduler(self.transportlessTimeout, self._transportlessTimedOut)
-            self._sendMessagesToOutput(output)
+            if not self.coalesceDelay or (
+                self.coalesceCount is not None and
+                self._unsent >= self.coalesceCount):
+                self._trySendMessages()
+            elif self._coalesceCall is None:
+                self._coalesceCall = self.scheduler(
+                    self.coalesceDelay, self._coalesceTimedOut)
+
+
+    def _queueOverflowed(self):
+        """
+        Give up on a client which has not acknowledged L{maxQueuedMessages}
+        messages: drop them, tell the client to go away and notify
+        C{connectionLost}.
+        """
+        log.msg("Athena transport %r has too many undelivered messages (%d), "
+                "disconnecting" % (self.livePage.clientID, len(self.messages)))
+        self.messages = []
+        self.close()
+        if self.connectionLost is not None:
+            self.connectionLost(failure.Failure(
+                    ConnectionLost("Too many undelivered messages")))
 
 
     def addOutput(self, output):
@@ -765,13 +1000,18 @@ class ReliableMessageDelivery(object):
 
     def close(self):
         assert not self._stopped, "Cannot multiply stop ReliableMessageDelivery"
-        self.addMessage((CLOSE, []))
+        # Not addMessage, since the client must be told to go away even if it
+        # is too far behind to be sent anything else.
+        self._enqueue((CLOSE, []))
         self._stopped = True
         while self.outputs:
             output, timeout = self.outputs.pop(0)
             timeout.cancel()
             self._sendMessagesToOutput(output)
         self.outputs = None
+        if self._coalesceCall is not None:
+            self._coalesceCall.cancel()
+            self._coalesceCall = None
         if self._transportlessTimeoutCall is not None:
             self._transportlessTimeoutCall.cancel()
             self._transportlessTimeoutCall = None
@@ -994,6 +1234,15 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
     @ivar _jsDepsMemo: A cache for JS module dependencies; by default, this
                        will only be shared within a single page instance.
 
+    @type bundleModules: C{bool}
+    @ivar bundleModules: If set, the modules a page or widget requires are
+        loaded from a single L{JSBundle} served by L{jsBundles}, rather than
+        one at a time.
+
+    @type jsBundles: L{JSBundleCache}
+    @ivar jsBundles: The bundles loaded by pages which set
+        L{bundleModules}.
+
     @type _didConnect: C{bool}
     @ivar _didConnect: Initially C{False}, set to C{True} if connectionMade has
         been invoked.
@@ -1020,6 +1269,10 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
 
     useActiveChannels = True
 
+    bundleModules = False
+    jsBundles = _theJSBundleCache
+    jsBundleRoot = None
+
     # This is the number of seconds that is acceptable for a LivePage to be
     # considered 'connected' without any transports still active.  In other
     # words, if the browser cannot make requests for more than this timeout
@@ -1036,6 +1289,20 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
     # bugs.
     TRANSPORT_IDLE_TIMEOUT = 300
 
+    # This is the amount of time that a message sent to the client will be
+    # held, while there is a request to send it in, in case more messages
+    # follow it, and the number of messages which will be sent without
+    # waiting any longer.  Bursts of calls to callRemote then go to the
+    # client in one response.  A delay of 0 sends each message immediately.
+    TRANSPORT_COALESCE_DELAY = 0
+    TRANSPORT_COALESCE_COUNT = None
+
+    # This is the number of messages which may be waiting for the client to
+    # acknowledge them.  If the client falls further behind than this, it is
+    # disconnected and the messages are discarded.  If None, there is no
+    # limit.
+    MAX_UNDELIVERED_MESSAGES = None
+
     page = property(lambda self: self)
 
     # Modules needed to bootstrap
@@ -1142,6 +1409,8 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
             self.jsModuleRoot = location.child(self.clientID).child('jsmodule')
         if self.cssModuleRoot is None:
             self.cssModuleRoot = location.child(self.clientID).child('cssmodule')
+        if self.jsBundleRoot is None:
+            self.jsBundleRoot = location.child(self.clientID).child('jsbundle')
 
         self._requestIDCounter = itertools.count().next
 
@@ -1151,7 +1420,10 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
             self.TRANSPORTLESS_DISCONNECT_TIMEOUT,
             self.TRANSPORT_IDLE_TIMEOUT,
             self._disconnected,
-            connectionMade=self._connectionMade)
+            connectionMade=self._connectionMade,
+            coalesceDelay=self.TRANSPORT_COALESCE_DELAY,
+            coalesceCount=self.TRANSPORT_COALESCE_COUNT,
+            maxQueuedMessages=self.MAX_UNDELIVERED_MESSAGES)
         self._remoteCalls = {}
         self._localObjects = {}
         self._localObjectIDCounter = itertools.count().next
@@ -1362,24 +1634,56 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
         return self.cssModuleRoot.child(moduleName)
 
 
+    def getJSBundleURL(self, bundle):
+        """
+        Return a URL rooted at L{jsBundleRoot} from which C{bundle} can be
+        fetched.
+
+        @type bundle: L{JSBundle}
+
+        @rtype: L{URL}
+        """
+        return self.jsBundleRoot.child(bundle.hashValue)
+
+
     def getImportStan(self, moduleName):
         moduleDef = jsModuleDeclaration(moduleName);
         return [tags.script(type='text/javascript')[tags.raw(moduleDef)],
                 tags.script(type='text/javascript', src=self.getJSModuleURL(moduleName))]
 
 
+    def getImportBundleStan(self, moduleNames):
+        """
+        Get some stan which will load the given modules, in order, from a
+        single L{JSBundle}.
+
+        @type moduleNames: C{list} of C{unicode}
+        """
+        if not moduleNames:
+            return []
+        bundle = self.jsBundles.getBundle(moduleNames)
+        return tags.script(type='text/javascript', src=self.getJSBundleURL(bundle))
+
+
     def render_liveglue(self, ctx, data):
         bootstrapString = '\n'.join(
             [self._bootstrapCall(method, args) for
              method, args in self._bootstraps(ctx)])
+
+        # Hit jsDeps.getModuleForName to force it to load some plugins :/
+        # This really needs to be redesigned.
+        moduleNames = [
+            jsDeps.getModuleForName(name).name
+            for (name, url)
+            in self._getRequiredModules(self._jsDepsMemo)]
+        if self.bundleModules:
+            imports = self.getImportBundleStan(moduleNames)
+        else:
+            imports = [self.getImportStan(name) for name in moduleNames]
+
         return ctx.tag[
             self.getStylesheetStan(self._getRequiredCSSModules(self._cssDepsMemo)),
-
-            # Hit jsDeps.getModuleForName to force it to load some plugins :/
-            # This really needs to be redesigned.
-            [self.getImportStan(jsDeps.getModuleForName(name).name)
-             for (name, url)
-             in self._getRequiredModules(self._jsDepsMemo)],
+            imports,
             tags.script(type='text/javascript',
                         id=BOOTSTRAP_NODE_ID,
                         payload=bootstrapString)[
@@ -1420,6 +1724,14 @@ class LivePage(rend.Page, _HasJSClass, _HasCSSModule):
         return MappingResource(self.jsModules.mapping)
 
 
+    def child_jsbundle(self, ctx):
+        """
+        Return L{jsBundles}, which serves the bundles this page refers to
+        when L{bundleModules} is set.
+        """
+        return self.jsBundles
+
+
     def child_cssmodule(self, ctx):
         """
         Return a L{MappingResource} wrapped around L{cssModules}.
@@ -1748,11 +2060,17 @@ class _LiveMixin(_HasJSClass, _HasCSSModule):
             context.get('requiredCSSModules').extend(requiredCSSModules)
             return tag
 
+        if getattr(self.page, 'bundleModules', False):
+            imports = self.page.getImportBundleStan(
+                [name for (name, url) in requiredModules])
+        else:
+            imports = [self.getImportStan(name) for (name, url) in requiredModules]
+
         return (
             self.getStylesheetStan(requiredCSSModules),
 
             # Import stuff
-            [self.getImportStan(name) for (name, url) in requiredModules],
+            imports,
 
             # Dump some data for our client-side __init__ into a text area
             # where it can easily be found.
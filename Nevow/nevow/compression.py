@@ -2,10 +2,12 @@
 """
 Implementation of on-the-fly content compression for HTTP resources.
 """
-from gzip import GzipFile
+import time, zlib
 
 from zope.interface import implements
 
+from twisted.python import log
+from twisted.internet import reactor
 from twisted.internet.defer import maybeDeferred, Deferred
 from twisted.internet.interfaces import IConsumer
 
@@ -93,23 +95,59 @@ class CompressingRequestWrapper(_makeBase()):
     """
     A request wrapper with support for transport encoding compression.
 
+    Output is held back until there is at least C{minimumSize} bytes of it, or
+    until the rendering code stops writing in order to wait for something,
+    and is then either compressed as a single gzip stream or, for
+    C{incompressibleTypes}, passed through unchanged.  Responses which finish
+    with less than C{minimumSize} bytes are not compressed at all.  Whenever
+    control returns to the reactor after some output was compressed, the
+    compressor is flushed with C{Z_SYNC_FLUSH} so that the client can render
+    what has been produced so far.
+
     @ivar underlying: the request being wrapped.
     @type underlying: L{IRequest}
     @ivar encoding: the IANA-assigned name of the encoding.
     @type encoding: C{str}
     @ivar compressLevel: the level of gzip compression to apply.
     @type compressLevel: C{int}
+    @ivar minimumSize: the number of bytes below which a finished response is
+        sent uncompressed.
+    @type minimumSize: C{int}
+    @ivar incompressibleTypes: prefixes of the content types which are already
+        compressed and so are sent as they are.
+    @type incompressibleTypes: C{tuple} of C{str}
+    @ivar clock: the L{IReactorTime} provider used to flush the compressor
+        once control returns to the reactor.
+    @ivar uncompressedBytes: the number of bytes compressed so far.
+    @type uncompressedBytes: C{int}
+    @ivar compressedBytes: the number of bytes those were compressed into.
+    @type compressedBytes: C{int}
+    @ivar compressionTime: the CPU time spent compressing so far, in seconds.
+    @type compressionTime: C{float}
     """
     implements(IRequest)
 
     encoding = 'gzip'
     compressLevel = 6
+    minimumSize = 1024
+    incompressibleTypes = (
+        'image/gif', 'image/jpeg', 'image/png', 'audio/', 'video/',
+        'application/zip', 'application/gzip', 'application/x-gzip',
+        'application/x-bzip2', 'application/x-compress')
+    clock = reactor
 
 
     def __init__(self, underlying):
         self.underlying = underlying
         self.setHeader('content-encoding', self.encoding)
-        self._gzipFile = None
+        self._compressor = None
+        self._passThrough = False
+        self._pending = []
+        self._pendingLength = 0
+        self._flushCall = None
+        self.uncompressedBytes = 0
+        self.compressedBytes = 0
+        self.compressionTime = 0.0
 
         # See setHeader docstring for more commentary.
         self.underlying.headers.pop('content-length', None)
@@ -132,22 +170,122 @@ class CompressingRequestWrapper(_makeBase()):
             return self.underlying.setHeader(name, value)
 
 
+    def _start(self):
+        """
+        Decide whether to compress, based on the content type, and pass on
+        whatever has been held back so far.
+        """
+        data = ''.join(self._pending)
+        self._pending = []
+        self._pendingLength = 0
+        contentType = self.underlying.headers.get('content-type') or ''
+        if contentType.lower().startswith(self.incompressibleTypes):
+            self._stopCompressing(data)
+        else:
+            self._compressor = zlib.compressobj(
+                self.compressLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress(data)
+
+
+    def _stopCompressing(self, data):
+        """
+        Send C{data} and everything after it uncompressed.
+        """
+        self._passThrough = True
+        self.underlying.headers.pop('content-encoding', None)
+        if data:
+            self.underlying.write(data)
+
+
+    def _compress(self, data, mode=None):
+        """
+        Compress C{data}, flushing the compressor with C{mode} if it is not
+        C{None}, and write out whatever the compressor produces.
+        """
+        before = time.clock()
+        output = self._compressor.compress(data)
+        if mode is not None:
+            output += self._compressor.flush(mode)
+        self.compressionTime += time.clock() - before
+        self.uncompressedBytes += len(data)
+        self.compressedBytes += len(output)
+        if output:
+            self.underlying.write(output)
+
+
+    def _scheduleFlush(self):
+        """
+        Arrange for L{flush} to be called once control returns to the reactor.
+        """
+        if self._flushCall is None:
+            self._flushCall = self.clock.callLater(0, self._scheduledFlush)
+
+
+    def _scheduledFlush(self):
+        self._flushCall = None
+        self.flush()
+
+
+    def _cancelFlush(self):
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = None
+
+
     def write(self, data):
         """
-        Pass data through to the gzip layer.
+        Pass data through to the compressor.
         """
-        if self._gzipFile is None:
-            self._gzipFile = GzipFile(fileobj=self.underlying, mode='wb', compresslevel=self.compressLevel)
-        self._gzipFile.write(data)
+        if self._passThrough:
+            self.underlying.write(data)
+        elif self._compressor is None:
+            self._pending.append(data)
+            self._pendingLength += len(data)
+            if self._pendingLength >= self.minimumSize:
+                self._start()
+            if not self._passThrough:
+                self._scheduleFlush()
+        else:
+            self._compress(data)
+            self._scheduleFlush()
+
+
+    def flush(self):
+        """
+        Send everything written so far to the client, compressing it first if
+        that has not been ruled out.
+        """
+        self._cancelFlush()
+        if self._passThrough:
+            return
+        if self._compressor is None:
+            if not self._pending:
+                return
+            self._start()
+            if self._passThrough:
+                return
+        self._compress('', zlib.Z_SYNC_FLUSH)
 
 
     def finishRequest(self, success):
         """
         Finish off gzip stream.
         """
-        if self._gzipFile is None:
-            self.write('')
-        self._gzipFile.close()
+        self._cancelFlush()
+        if self._compressor is None and not self._passThrough:
+            if self._pendingLength < self.minimumSize:
+                data = ''.join(self._pending)
+                self._pending = []
+                self._stopCompressing(data)
+            else:
+                self._start()
+        if self._compressor is not None:
+            self._compress('', zlib.Z_FINISH)
+            self._compressor = None
+            log.msg(http_compression=None, uri=self.underlying.uri,
+                    uncompressedBytes=self.uncompressedBytes,
+                    compressedBytes=self.compressedBytes,
+                    compressionTime=self.compressionTime)
         self.underlying.finishRequest(success)
 
 
@@ -12,6 +12,7 @@ __metaclass__ = type
 
 import random
 import time
+from collections import deque
 try:
     from hashlib import md5
 except ImportError:
@@ -55,7 +56,6 @@ class GuardSession(components.Componentized):
         self.guard = guard
         self.uid = uid
         self.expireCallbacks = []
-        self.checkExpiredID = None
         self.setLifetime(60)
         self.portals = {}
         self.touch()
@@ -130,9 +130,9 @@ class GuardSession(components.Componentized):
         """Set the approximate lifetime of this session, in seconds.
 
         This is highly imprecise, but it allows you to set some general
-        parameters about when this session will expire.  A callback will be
-        scheduled each 'lifetime' seconds, and if I have not been 'touch()'ed
-        in half a lifetime, I will be immediately expired.
+        parameters about when this session will expire.  My guard will check
+        me each 'lifetime' seconds, and if I have not been 'touch()'ed in half
+        a lifetime, I will be immediately expired.
         """
         self.lifetime = lifetime
 
@@ -157,27 +157,29 @@ class GuardSession(components.Componentized):
             except:
                 log.err()
         self.expireCallbacks = []
-        if self.checkExpiredID:
-            self.checkExpiredID.cancel()
-            self.checkExpiredID = None
+        self.guard.cancelExpiryCheck(self)
 
     def touch(self):
-        self.lastModified = time.time()
+        # This happens on every request, so it must stay cheap: the guard
+        # notices the new time the next time it checks this session.
+        self.lastModified = self.guard.getClock().seconds()
 
     def checkExpired(self):
-        # Import reactor here to avoid installing default at startup
-        from twisted.internet import reactor
-        self.checkExpiredID = None
+        """
+        Expire this session if it has not been touched in half a lifetime,
+        otherwise ask the guard to check it again in a lifetime.
+        """
         # If I haven't been touched in 15 minutes:
-        if time.time() - self.lastModified > self.lifetime / 2:
+        if self.guard.getClock().seconds() - self.lastModified > self.lifetime / 2:
             if self.guard.sessions.has_key(self.uid):
                 self.expire()
             else:
+                self.guard.cancelExpiryCheck(self)
                 log.msg("no session to expire: %s" % str(self.uid))
         else:
             log.msg("session given the will to live for %s more seconds" % self.lifetime)
-            self.checkExpiredID = reactor.callLater(self.lifetime,
-                                                    self.checkExpired)
+            self.guard.scheduleExpiryCheck(self, self.lifetime)
+
     def __getstate__(self):
         d = self.__dict__.copy()
         if d.has_key('checkExpiredID'):
@@ -209,6 +211,163 @@ LOGOUT_AVATAR = '__logout__'
 
 def nomind(*args): return None
 
+
+
+class _SessionExpiry:
+    """
+    A hashed timing wheel which checks sessions for expiry.
+
+    Rather than each session keeping its own delayed call, sessions are
+    grouped into slots of C{resolution} seconds by the time they are next due
+    to be checked, and a single delayed call, which only runs while there are
+    sessions to check, advances through the slots once per C{resolution}.
+    Touching a session does not move it; a session which is found to have
+    been touched when its slot comes up reschedules itself.
+
+    @ivar clock: The L{IReactorTime} provider used to schedule checks.
+    @ivar resolution: The width of each slot, in seconds.
+    @ivar maxSessions: The number of sessions to allow before expiring the
+        oldest ones to make room for new ones, or C{None} for no limit.
+    @ivar expiredSessions: The number of sessions which have been expired
+        because they were not touched.
+    @ivar evictedSessions: The number of sessions which have been expired to
+        keep the number of sessions below C{maxSessions}.
+    """
+    def __init__(self, clock, resolution, maxSessions=None):
+        self.clock = clock
+        self.resolution = resolution
+        self.maxSessions = maxSessions
+        self.expiredSessions = 0
+        self.evictedSessions = 0
+        # Mapping of tick number to dictionary whose keys are the sessions
+        # due to be checked at that tick.
+        self._slots = {}
+        # Mapping of each live session to the tick it is due to be checked
+        # at, or None while it is being checked.
+        self._ticks = {}
+        # Live sessions in the order they were first scheduled.  Sessions
+        # which have since gone away are skipped and occasionally pruned.
+        self._created = deque()
+        self._lastTick = None
+        self._call = None
+
+
+    def __len__(self):
+        """
+        Return the number of live sessions.
+        """
+        return len(self._ticks)
+
+
+    def _tickFor(self, when):
+        return int(when // self.resolution)
+
+
+    def schedule(self, session, delay):
+        """
+        Arrange for C{session.checkExpired} to be called after about C{delay}
+        seconds.  If C{session} is new, make room for it if necessary.
+        """
+        now = self.clock.seconds()
+        tick = self._tickFor(now + delay) + 1
+        if session in self._ticks:
+            self._unslot(session)
+        else:
+            self._created.append(session)
+        self._ticks[session] = tick
+        self._slots.setdefault(tick, {})[session] = None
+        if self._call is None:
+            self._lastTick = self._tickFor(now)
+            self._scheduleAdvance(now)
+        if self.maxSessions is not None:
+            self._evict(session)
+
+
+    def cancel(self, session):
+        """
+        Forget about C{session}, if it is scheduled.
+        """
+        if session in self._ticks:
+            self._unslot(session)
+            del self._ticks[session]
+            if not self._ticks and self._call is not None:
+                self._call.cancel()
+                self._call = None
+            if len(self._created) > 2 * len(self._ticks) + 32:
+                self._created = deque(
+                    [s for s in self._created if s in self._ticks])
+
+
+    def _unslot(self, session):
+        tick = self._ticks[session]
+        if tick is not None:
+            slot = self._slots[tick]
+            del slot[session]
+            if not slot:
+                del self._slots[tick]
+
+
+    def _evict(self, newSession):
+        """
+        Expire the oldest sessions other than C{newSession} until there are
+        no more than C{maxSessions}.
+        """
+        while len(self._ticks) > self.maxSessions and self._created:
+            oldest = self._created.popleft()
+            if oldest is newSession:
+                self._created.append(oldest)
+                if len(self._created) == 1:
+                    break
+            elif oldest in self._ticks:
+                log.msg("evicting session %s" % str(oldest.uid))
+                oldest.expire()
+                self.evictedSessions += 1
+
+
+    def _scheduleAdvance(self, now):
+        nextTick = self._lastTick + 1
+        self._call = self.clock.callLater(
+            max(0, nextTick * self.resolution - now), self._advance)
+
+
+    def _advance(self):
+        """
+        Check every session in the slots which have come due since the last
+        advance.
+        """
+        self._call = None
+        now = self.clock.seconds()
+        current = self._tickFor(now)
+        if current - self._lastTick > len(self._slots):
+            # The clock jumped; visiting the occupied slots is cheaper than
+            # visiting every slot in between.
+            due = sorted([t for t in self._slots if t <= current])
+        else:
+            due = xrange(self._lastTick + 1, current + 1)
+        self._lastTick = current
+        for tick in due:
+            slot = self._slots.pop(tick, None)
+            if slot is None:
+                continue
+            for session in slot:
+                self._ticks[session] = None
+            for session in slot:
+                # An earlier session's expiry may have taken this one with
+                # it.
+                if session in self._ticks and self._ticks[session] is None:
+                    try:
+                        session.checkExpired()
+                    except:
+                        log.err()
+                    if session not in self._ticks:
+                        self.expiredSessions += 1
+                    elif self._ticks[session] is None:
+                        # It neither expired nor rescheduled itself; don't
+                        # lose track of it.
+                        self.schedule(session, session.lifetime)
+        if self._ticks and self._call is None:
+            self._scheduleAdvance(now)
+
 class Forbidden(object):
     implements(inevow.IResource)
 
@@ -240,12 +399,28 @@ class SessionWrapper:
         saved to disk, and thus last only as long as the session does.  If
         the browser is closed before the session timeout, both the session
         and the cookie go away.
+
+    @ivar maxSessions: The number of live sessions to allow.  When a new
+        session would exceed it, the oldest sessions are expired to make
+        room.  If C{None} (the default), there is no limit.
+
+    @ivar expiryResolution: How often, in seconds, sessions are checked for
+        expiry.  Each session is checked within this many seconds of when it
+        is due.
+
+    @ivar clock: The L{IReactorTime} provider used to time sessions, or
+        C{None} (the default) to use the global reactor.
     """
     implements(inevow.IResource)
 
     sessionLifetime = 3600
     sessionFactory = GuardSession
 
+    maxSessions = None
+    expiryResolution = 5
+    clock = None
+    _expiry = None
+
     # The interface to cred for when logging into the portal
     credInterface = inevow.IResource
 
@@ -269,6 +444,78 @@ class SessionWrapper:
         # Backwards compatibility; remove asap
         self.resource = self
 
+
+    def getClock(self):
+        """
+        Return the L{IReactorTime} provider used to time sessions.
+        """
+        if self.clock is None:
+            # Import reactor here to avoid installing default at startup
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        # Sessions reschedule themselves with a new one when they are
+        # unpickled.
+        d.pop('_expiry', None)
+        return d
+
+
+    def _getExpiry(self):
+        if self._expiry is None:
+            self._expiry = _SessionExpiry(
+                self.getClock(), self.expiryResolution, self.maxSessions)
+        return self._expiry
+
+
+    def scheduleExpiryCheck(self, session, delay):
+        """
+        Arrange for C{session.checkExpired} to be called in about C{delay}
+        seconds, expiring the oldest sessions if C{session} is new and there
+        are more than L{maxSessions}.
+        """
+        self._getExpiry().schedule(session, delay)
+
+
+    def cancelExpiryCheck(self, session):
+        """
+        Stop checking C{session} for expiry.
+        """
+        if self._expiry is not None:
+            self._expiry.cancel(session)
+
+
+    def liveSessionCount(self):
+        """
+        Return the number of sessions currently being checked for expiry.
+        """
+        if self._expiry is None:
+            return 0
+        return len(self._expiry)
+
+
+    def expiredSessionCount(self):
+        """
+        Return the number of sessions which have expired because they were
+        not used for too long.
+        """
+        if self._expiry is None:
+            return 0
+        return self._expiry.expiredSessions
+
+
+    def evictedSessionCount(self):
+        """
+        Return the number of sessions which have been expired to keep the
+        number of sessions at or below L{maxSessions}.
+        """
+        if self._expiry is None:
+            return 0
+        return self._expiry.evictedSessions
+
     def renderHTTP(self, ctx):
         request = inevow.IRequest(ctx)
         d = defer.maybeDeferred(self._delegate, ctx, [])
@@ -7,6 +7,12 @@ JavaScript Object Notation.
 
 This is not (nor does it intend to be) a faithful JSON implementation, but it
 is kind of close.
+
+When the standard library's C-accelerated C{json} module is available, it is
+used to parse and serialize plain data.  Anything it cannot handle exactly the
+way this module would (comments, C{\\x} escapes, Athena widgets, transportable
+objects, byte strings, and so on) is passed to the pure-Python implementation
+below, so both paths accept and produce the same things.
 """
 
 import re, types
@@ -14,6 +20,15 @@ import re, types
 from nevow.inevow import IAthenaTransportable
 from nevow import rend, page, _flat, tags
 
+try:
+    # Empty globals make this an absolute import, rather than an import of
+    # this module.
+    _stdjson = __import__('json', {}, {}, ['decoder', 'encoder'])
+    c_make_encoder = _stdjson.encoder.c_make_encoder
+    c_scanstring = _stdjson.decoder.c_scanstring
+except (ImportError, AttributeError):
+    _stdjson = c_make_encoder = c_scanstring = None
+
 class ParseError(ValueError):
     pass
 
@@ -148,9 +163,12 @@ def parseValue(tokens):
 _stringExpr = re.compile(
     ur'(?:\\x(?P<unicode>[a-fA-F0-9]{2})) # Match hex-escaped unicode' u'\n'
     ur'|' u'\n'
+    ur'(?:\\u(?P<high>[dD][89abAB][a-fA-F0-9]{2})' u'\n'
+    ur'\\u(?P<low>[dD][c-fC-F][a-fA-F0-9]{2})) # Match a surrogate pair' u'\n'
+    ur'|' u'\n'
     ur'(?:\\u(?P<unicode2>[a-fA-F0-9]{4})) # Match hex-escaped high unicode' u'\n'
     ur'|' u'\n'
-    ur'(?P<control>\\[fbntr\\"]) # Match escaped control characters' u'\n',
+    ur'(?P<control>\\[fbntr\\"/]) # Match escaped control characters' u'\n',
     re.VERBOSE)
 
 _controlMap = {
@@ -161,9 +179,16 @@ _controlMap = {
     u'\\r': u'\r',
     u'\\"': u'"',
     u'\\\\': u'\\',
+    u'\\/': u'/',
     }
 
 def _stringSub(m):
+    high = m.group('high')
+    if high is not None:
+        # Decoding the pair from UTF-16 joins it into one character on wide
+        # builds, as the standard library's json module does.
+        pair = unichr(int(high, 16)) + unichr(int(m.group('low'), 16))
+        return pair.encode('utf-16-be').decode('utf-16-be')
     u = m.group('unicode')
     if u is None:
         u = m.group('unicode2')
@@ -220,10 +245,43 @@ def parseObject(tokens):
     return o, tokens
 
 
+def _parseNumber(s):
+    """
+    Convert a number with a fraction or an exponent the way L{tokenise} does:
+    only a fraction makes it a float.
+    """
+    if '.' in s:
+        return float(s)
+    return jsonlong(s)
+
+
+def _parseConstant(s):
+    """
+    Reject C{NaN} and C{Infinity}, which are not literals L{tokenise} accepts.
+    """
+    raise ParseError("Unexpected %r" % (s,))
+
+
+if c_scanstring is not None:
+    _decoder = _stdjson.JSONDecoder(
+        parse_float=_parseNumber, parse_int=long,
+        parse_constant=_parseConstant, strict=False)
+else:
+    _decoder = None
+
+
 def parse(s):
     """
     Return the object represented by the JSON-encoded string C{s}.
     """
+    if _decoder is not None:
+        try:
+            return _decoder.decode(s)
+        except ValueError:
+            # Either a syntax error, which the tokenizer will report, or
+            # something only this dialect allows, like a comment or a \x
+            # escape.
+            pass
     tokens = tokenise(s)
     value, tokens = parseValue(tokens)
     if tokens:
@@ -249,6 +307,22 @@ def stringEncode(s):
     return s.translate(_translation).encode('utf-8')
 
 
+_infinity = float('inf')
+
+def _floatEncode(f):
+    """
+    Represent C{f} exactly, using JavaScript's names for the values which
+    have no literal, as the standard library's C{json} module does.
+    """
+    if f != f:
+        return 'NaN'
+    if f == _infinity:
+        return 'Infinity'
+    if f == -_infinity:
+        return '-Infinity'
+    return repr(f)
+
+
 def _serialize(obj, w, seen):
     from nevow import athena
 
@@ -257,7 +331,9 @@ def _serialize(obj, w, seen):
             w('true')
         else:
             w('false')
-    elif isinstance(obj, (int, long, float)):
+    elif isinstance(obj, float):
+        w(_floatEncode(obj))
+    elif isinstance(obj, (int, long)):
         w(str(obj))
     elif isinstance(obj, unicode):
         w('"')
@@ -268,13 +344,16 @@ def _serialize(obj, w, seen):
     elif id(obj) in seen:
         raise CycleError(type(obj))
     elif isinstance(obj, (tuple, list)):
+        seen[id(obj)] = True
         w('[')
         for n, e in enumerate(obj):
             _serialize(e, w, seen)
             if n != len(obj) - 1:
                 w(',')
         w(']')
+        del seen[id(obj)]
     elif isinstance(obj, dict):
+        seen[id(obj)] = True
         w('{')
         for n, (k, v) in enumerate(obj.iteritems()):
             _serialize(k, w, seen)
@@ -283,6 +362,7 @@ def _serialize(obj, w, seen):
             if n != len(obj) - 1:
                 w(',')
         w('}')
+        del seen[id(obj)]
     elif isinstance(obj, (athena.LiveFragment, athena.LiveElement)):
         _serialize(obj._structured(), w, seen)
     elif isinstance(obj, (rend.Fragment, page.Element)):
@@ -307,6 +387,44 @@ def _serialize(obj, w, seen):
 
 
 
+class _NotPlain(Exception):
+    """
+    Raised to abandon the C encoder when it reaches something only
+    L{_serialize} knows how to serialize.
+    """
+
+
+def _encodeString(s):
+    """
+    Quote a string for the C encoder exactly as L{_serialize} would, refusing
+    byte strings as it does.
+    """
+    if not isinstance(s, unicode):
+        raise _NotPlain()
+    return '"' + stringEncode(s) + '"'
+
+
+def _notPlain(obj):
+    raise _NotPlain()
+
+
+def _fastSerialize(obj):
+    """
+    Serialize C{obj} with the C encoder from the standard library's C{json}
+    module.
+
+    @raise _NotPlain: If C{obj} contains anything other than None, booleans,
+        numbers, unicode strings, lists, tuples and dictionaries.
+    @raise CycleError: If C{obj} contains itself.
+    """
+    encode = c_make_encoder(
+        {}, _notPlain, _encodeString, None, ':', ',', False, False, True)
+    try:
+        return ''.join(encode(obj, 0))
+    except ValueError:
+        raise CycleError(type(obj))
+
+
 _undefined = object()
 def serialize(obj=_undefined, **kw):
     """
@@ -315,9 +433,19 @@ def serialize(obj=_undefined, **kw):
     @param obj: None, True, False, an int, long, float, unicode string,
     list, tuple, or dictionary the JSON-encoded form of which will be
     returned.
+
+    @raise CycleError: If C{obj} contains itself.
     """
     if obj is _undefined:
         obj = kw
+    if c_make_encoder is not None:
+        try:
+            return _fastSerialize(obj)
+        except (_NotPlain, TypeError):
+            # Fragments, widgets and transportables are not JSON, and
+            # unsupported objects and keys get their error message from
+            # _serialize.
+            pass
     L = []
     _serialize(obj, L.append, {})
     return ''.join(L)
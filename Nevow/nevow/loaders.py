@@ -33,6 +33,15 @@ from nevow.flat import flatsax
 from nevow.util import CachedFile
 
 
+# Parsed and precompiled disk templates, shared by all of the xmlfile loaders
+# in the process which load them without preprocessors.  Maps everything
+# which affects how a template is loaded to the CachedFile for it, which
+# reloads it when the file is modified.  It is emptied when it holds
+# XMLFILE_CACHE_SIZE templates.
+XMLFILE_CACHE_SIZE = 500
+_xmlfileCache = {}
+
+
 class stan(object):
     """A stan tags document factory"""
 
@@ -167,6 +176,14 @@ class xmlstr(object):
 
 
 class xmlfile(object):
+    """
+    A document factory for an XML disk template.
+
+    Loaded templates are shared with any other xmlfile loading the same file in
+    the same way, and reloaded when the file's modification time changes.
+    Templates loaded with preprocessors, which may be bound to the objects
+    using them, are only kept by this loader.
+    """
 
     implements(inevow.IDocFactory)
 
@@ -177,7 +194,6 @@ class xmlfile(object):
     ignoreComment = False
 
     def __init__(self, template=None, pattern=None, templateDir=None, ignoreDocType=None, ignoreComment=None):
-        self._cache = {}
         if template is not None:
             self.template = template
         if pattern is not None:
@@ -202,10 +218,18 @@ class xmlfile(object):
             if r is not None:
                 rendererFactoryClass = getClass(r)
 
-        cacheKey = (self._filename, self.pattern, rendererFactoryClass)
-        cachedFile = self._cache.get(cacheKey)
+        preprocessors = tuple(preprocessors)
+        if preprocessors:
+            cache = self._cache
+        else:
+            cache = _xmlfileCache
+        cacheKey = (self._filename, self.pattern, rendererFactoryClass,
+                    self.ignoreDocType, self.ignoreComment, preprocessors)
+        cachedFile = cache.get(cacheKey)
         if cachedFile is None:
-            cachedFile = self._cache[cacheKey] = CachedFile(self._filename, self._reallyLoad)
+            if len(cache) >= XMLFILE_CACHE_SIZE:
+                cache.clear()
+            cachedFile = cache[cacheKey] = CachedFile(self._filename, self._reallyLoad)
 
         return cachedFile.load(ctx, preprocessors)
 
@@ -1,5 +1,9 @@
 
 import os, sets
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
 from itertools import izip
 from xml.dom.minidom import parseString
 
@@ -60,6 +64,113 @@ class MappingResourceTests(unittest.TestCase):
 
 
 
+class JSBundleCacheTests(unittest.TestCase):
+    """
+    Tests for L{athena.JSBundleCache}.
+    """
+    def setUp(self):
+        self.cache = athena.JSBundleCache()
+        self.sources = {u'Foo': 'var x = 1;', u'Foo.Bar': 'Foo.Bar.y = 2;'}
+        self.cache.getSource = self.sources.__getitem__
+
+
+    def test_contents(self):
+        """
+        A bundle contains the declaration and then the source of each module,
+        in the order given.
+        """
+        bundle = self.cache.getBundle([u'Foo', u'Foo.Bar'])
+        self.assertEqual(bundle.moduleNames, (u'Foo', u'Foo.Bar'))
+        self.assertEqual(
+            bundle.contents,
+            athena.jsModuleDeclaration(u'Foo') + '\nvar x = 1;\n' +
+            athena.jsModuleDeclaration(u'Foo.Bar') + '\nFoo.Bar.y = 2;\n')
+        self.assertEqual(bundle.hashValue, sha1(bundle.contents).hexdigest())
+
+
+    def test_shared(self):
+        """
+        Asking for the same modules again returns the same bundle, until the
+        cache is cleared.
+        """
+        bundle = self.cache.getBundle([u'Foo', u'Foo.Bar'])
+        self.assertIdentical(
+            self.cache.getBundle((u'Foo', u'Foo.Bar')), bundle)
+        self.sources[u'Foo'] = 'var x = 3;'
+        self.assertIdentical(
+            self.cache.getBundle((u'Foo', u'Foo.Bar')), bundle)
+        self.cache.clear()
+        newBundle = self.cache.getBundle((u'Foo', u'Foo.Bar'))
+        self.assertNotEqual(newBundle.hashValue, bundle.hashValue)
+
+
+    def test_locateBundle(self):
+        """
+        Bundles are served by hash, even after the cache has been cleared.
+        """
+        bundle = self.cache.getBundle([u'Foo'])
+        self.cache.clear()
+        resource, segments = self.cache.locateChild(None, (bundle.hashValue,))
+        self.assertEqual(segments, [])
+        self.assertEqual(resource.data, bundle.contents)
+        self.assertEqual(resource.type, 'text/javascript')
+        self.assertEqual(
+            self.cache.locateChild(None, ('0' * 40,)), rend.NotFound)
+
+
+    def test_supersededBundlesLimited(self):
+        """
+        Only the C{maxSupersededBundles} most recently served of the bundles
+        forgotten by L{athena.JSBundleCache.clear} are still served.
+        """
+        self.cache.maxSupersededBundles = 2
+        bundles = []
+        for source in ['var x = 1;', 'var x = 2;', 'var x = 3;']:
+            self.sources[u'Foo'] = source
+            bundles.append(self.cache.getBundle([u'Foo']))
+            self.cache.clear()
+            self.cache.locateChild(None, (bundles[0].hashValue,))
+        self.assertEqual(sorted(self.cache._bundlesByHash),
+                         sorted([bundles[0].hashValue, bundles[2].hashValue]))
+        self.assertEqual(
+            self.cache.locateChild(None, (bundles[1].hashValue,)),
+            rend.NotFound)
+
+
+    def test_supersededBundleReused(self):
+        """
+        A forgotten bundle which is created again is current again, and counts
+        as a single superseded bundle once it is forgotten again.
+        """
+        self.cache.maxSupersededBundles = 1
+        bundle = self.cache.getBundle([u'Foo'])
+        self.cache.clear()
+        self.cache.getBundle([u'Foo'])
+        self.cache.clear()
+        self.assertEqual(self.cache._bundlesByHash.keys(), [bundle.hashValue])
+        self.assertEqual(self.cache._superseded, [bundle.hashValue])
+
+
+    def test_renderCache(self):
+        """
+        L{athena.JSBundleCache} isn't directly renderable.
+        """
+        self.failUnless(
+            isinstance(self.cache.renderHTTP(None), rend.FourOhFour))
+
+
+    def test_realModules(self):
+        """
+        By default, module source is read from the file which implements it.
+        """
+        cache = athena.JSBundleCache()
+        module = athena.jsDeps.getModuleForName(u'Divmod')
+        self.assertEqual(
+            cache.getSource(u'Divmod'),
+            file(module.mapping[u'Divmod'], 'rb').read())
+
+
+
 class ModuleRegistryTestMixin:
     """
     Mixin for testing module registry objects.
@@ -1257,6 +1368,137 @@ class Transport(unittest.TestCase):
         self.assertEqual(self.outgoingMessages, [(None, [athena.CLOSE, []])])
 
 
+    def _coalescingDelivery(self, **kw):
+        """
+        Replace C{self.rdm} with a L{athena.ReliableMessageDelivery} which
+        holds on to messages for a second, and uses C{self.now} as the time.
+        """
+        self.rdm.close()
+        self.scheduled = []
+        self.now = 0
+        self.rdm = athena.ReliableMessageDelivery(
+            self,
+            connectTimeout=self.connectTimeout,
+            transportlessTimeout=self.transportlessTimeout,
+            idleTimeout=self.idleTimeout,
+            connectionMade=lambda: None,
+            connectionLost=lambda reason: self.events.append(reason),
+            scheduler=self._schedule,
+            seconds=lambda: self.now,
+            coalesceDelay=1, **kw)
+
+
+    def test_coalesceMessages(self):
+        """
+        With a C{coalesceDelay}, messages added while an output is available
+        are held until the delay elapses and then sent together.
+        """
+        self._coalescingDelivery()
+        self.rdm.addOutput(mappend(self.transport))
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.addMessage(self.theMessage + '-2')
+        self.assertEquals(self.transport, [])
+        [(delay, f, a, kw)] = [
+            t for t in self.scheduled if t[0] == 1]
+        self.now = 1
+        f(*a, **kw)
+        self.assertEquals(
+            self.transport,
+            [[(0, self.theMessage), (1, self.theMessage + '-2')]])
+        self.assertEquals(self.rdm.lastLatency, 1)
+        self.assertEquals(self.rdm.maxQueueLength, 2)
+
+
+    def test_coalesceCount(self):
+        """
+        Once C{coalesceCount} messages have been added, they are sent without
+        waiting for the rest of C{coalesceDelay}.
+        """
+        self._coalescingDelivery(coalesceCount=2)
+        self.rdm.addOutput(mappend(self.transport))
+        self.rdm.addMessage(self.theMessage)
+        self.assertEquals(self.transport, [])
+        self.rdm.addMessage(self.theMessage + '-2')
+        self.assertEquals(
+            self.transport,
+            [[(0, self.theMessage), (1, self.theMessage + '-2')]])
+        self.assertEquals([t for t in self.scheduled if t[0] == 1], [])
+        self.assertEquals(self.rdm.lastLatency, 0)
+
+
+    def test_coalesceWithoutOutput(self):
+        """
+        Messages which were waiting for an output are sent as soon as one is
+        added, whatever the C{coalesceDelay}.
+        """
+        self._coalescingDelivery()
+        self.rdm.addMessage(self.theMessage)
+        self.now = 5
+        self.rdm.addOutput(mappend(self.transport))
+        self.assertEquals(self.transport, [[(0, self.theMessage)]])
+        self.assertEquals(self.rdm.lastLatency, 5)
+        self.assertEquals(self.rdm.maxLatency, 5)
+
+
+    def test_closeWhileCoalescing(self):
+        """
+        Closing sends any held messages and cancels the coalescing delay.
+        """
+        self._coalescingDelivery()
+        self.rdm.addOutput(mappend(self.transport))
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.close()
+        self.assertEquals(
+            self.transport,
+            [[(0, self.theMessage), (1, (athena.CLOSE, []))]])
+        self.assertEquals(self.scheduled, [])
+
+
+    def test_maxQueuedMessages(self):
+        """
+        Adding more than C{maxQueuedMessages} unacknowledged messages drops
+        them, closes the connection and notifies C{connectionLost}.
+        """
+        self._coalescingDelivery(maxQueuedMessages=2)
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.addMessage(self.theMessage)
+        self.assertEquals(self.events, [])
+        self.rdm.addMessage(self.theMessage)
+        [reason] = self.events
+        reason.trap(athena.ConnectionLost)
+        self.rdm.addOutput(mappend(self.transport))
+        self.assertEquals(self.transport, [[(2, (athena.CLOSE, []))]])
+
+
+    def test_closeFullQueue(self):
+        """
+        Closing a delivery whose queue is full sends the close message after
+        the queued ones, as for any other close, rather than treating it as
+        an overflow.
+        """
+        self._coalescingDelivery(maxQueuedMessages=1)
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.close()
+        self.assertEquals(self.events, [])
+        self.rdm.addOutput(mappend(self.transport))
+        self.assertEquals(
+            self.transport,
+            [[(0, self.theMessage), (1, (athena.CLOSE, []))]])
+
+
+    def test_maxQueuedMessagesWithoutConnectionLost(self):
+        """
+        A delivery without a C{connectionLost} callback is closed when its
+        queue overflows.
+        """
+        self._coalescingDelivery(maxQueuedMessages=1)
+        self.rdm.connectionLost = None
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.addMessage(self.theMessage)
+        self.rdm.addOutput(mappend(self.transport))
+        self.assertEquals(self.transport, [[(1, (athena.CLOSE, []))]])
+
+
 
 class LiveMixinTestsMixin(CSSModuleTestMixin):
     """
@@ -1590,6 +1832,64 @@ class LivePageTests(unittest.TestCase, CSSModuleTestMixin):
         self.assertIn(expectDependee, result)
 
 
+    def test_bundledPageDependencies(self):
+        """
+        With L{LivePage.bundleModules} set, L{LivePage.render_liveglue} loads
+        the modules the page needs from a single bundle below
+        L{LivePage.jsBundleRoot}, rather than one at a time.
+        """
+        self.page.bundleModules = True
+        self.page.jsBundles = athena.JSBundleCache()
+        self.page.jsClass = u'PythonTestSupport.Dependor.PageTest'
+        freq = FakeRequest()
+        self.page._becomeLive(url.URL.fromRequest(freq))
+        ctx = WovenContext(tag=tags.div())
+        ctx.remember(freq, IRequest)
+        self.page.render_liveglue(ctx, None)
+        result = flat.flatten(ctx.tag, ctx)
+
+        bundle = self.page.jsBundles.getBundle(
+            [u'PythonTestSupport', u'PythonTestSupport.Dependee',
+             u'PythonTestSupport.Dependor'])
+        self.assertEqual(
+            self.page.jsBundles._bundlesByNames.values(), [bundle])
+        self.assertIn(
+            flat.flatten(self.page.getJSBundleURL(bundle)), result)
+        self.assertEqual(
+            self.page.getJSBundleURL(bundle),
+            url.URL.fromRequest(freq).child(self.page.clientID).child(
+                'jsbundle').child(bundle.hashValue))
+        self.assertNotIn(
+            flat.flatten(self.page.getJSModuleURL(u'PythonTestSupport.Dependor')),
+            result)
+        self.assertIdentical(
+            self.page.child_jsbundle(ctx), self.page.jsBundles)
+
+
+    def test_bundledElementDependencies(self):
+        """
+        With L{LivePage.bundleModules} set, L{LiveElement.liveElement} loads
+        the modules the element needs which the page has not already loaded
+        from a single bundle.
+        """
+        self.page.bundleModules = True
+        self.page.jsBundles = athena.JSBundleCache()
+        freq = FakeRequest()
+        self.page._becomeLive(url.URL.fromRequest(freq))
+        self.page._shouldInclude(u'PythonTestSupport')
+        element = LiveElement(stan(tags.div()))
+        element.jsClass = u'PythonTestSupport.Dependor.PageTest'
+        element.setFragmentParent(self.page)
+        element.render(freq)
+        result = flat.flatten(element.liveElement(freq, tags.div()))
+
+        bundle = self.page.jsBundles.getBundle(
+            [u'PythonTestSupport.Dependee', u'PythonTestSupport.Dependor'])
+        self.assertEqual(
+            self.page.jsBundles._bundlesByNames.values(), [bundle])
+        self.assertIn(flat.flatten(self.page.getJSBundleURL(bundle)), result)
+
+
     def test_pageCSSModuleDependencies(self):
         """
         L{athena.LivePage.render_liveglue} should include CSS modules that
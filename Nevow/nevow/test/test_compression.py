@@ -1,6 +1,7 @@
 """
 Tests for on-the-fly content compression encoding.
 """
+import zlib
 from StringIO import StringIO
 from gzip import GzipFile
 
@@ -8,6 +9,7 @@ from zope.interface import implements
 
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
 
 from nevow.inevow import IResource, IRequest
 from nevow.testutil import FakeRequest
@@ -126,6 +128,7 @@ class RequestWrapperTests(TestCase):
         """
         self.request = FakeRequest()
         self.wrapper = CompressingRequestWrapper(self.request)
+        self.clock = self.wrapper.clock = Clock()
 
 
     def test_attributes(self):
@@ -176,7 +179,7 @@ class RequestWrapperTests(TestCase):
         This is necessary to avoid terminating the header too quickly.
         """
         self.assertEqual(self.request.accumulator, '')
-        self.wrapper.write('foo')
+        self.wrapper.write('foo' * self.wrapper.minimumSize)
         self.assertNotEqual(self.request.accumulator, '')
 
 
@@ -192,12 +195,76 @@ class RequestWrapperTests(TestCase):
         """
         Response content should be written out in compressed format.
         """
+        self.wrapper.minimumSize = 0
         self.wrapper.write('foo')
         self.wrapper.write('bar')
         self.wrapper.finishRequest(True)
         self.assertEqual(self._ungzip(self.request.accumulator), 'foobar')
 
 
+    def test_smallResponse(self):
+        """
+        A response which is finished before C{minimumSize} bytes have been
+        written is sent uncompressed.
+        """
+        self.wrapper.write('foo')
+        self.assertEqual(self.request.accumulator, '')
+        self.wrapper.finishRequest(True)
+        self.assertEqual(self.request.accumulator, 'foo')
+        self.assertNotIn('content-encoding', self.request.headers)
+        self.assertTrue(self.request.finished)
+
+
+    def test_incompressibleType(self):
+        """
+        Content with one of the C{incompressibleTypes} is sent uncompressed
+        however large it is.
+        """
+        self.wrapper.setHeader('content-type', 'image/png')
+        data = 'x' * self.wrapper.minimumSize
+        self.wrapper.write(data)
+        self.wrapper.write('y')
+        self.wrapper.finishRequest(True)
+        self.assertEqual(self.request.accumulator, data + 'y')
+        self.assertNotIn('content-encoding', self.request.headers)
+
+
+    def test_syncFlush(self):
+        """
+        Once control returns to the reactor, everything written so far is
+        flushed through the compressor, even if it is less than
+        C{minimumSize}, and can be decompressed before the response is
+        finished.
+        """
+        self.wrapper.write('foo')
+        self.wrapper.write('bar')
+        self.assertEqual(self.request.accumulator, '')
+        self.clock.advance(0)
+        self.assertEqual(self.request.headers['content-encoding'], 'gzip')
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(
+            decompressor.decompress(self.request.accumulator), 'foobar')
+
+        self.wrapper.write('baz')
+        self.wrapper.finishRequest(True)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self._ungzip(self.request.accumulator), 'foobarbaz')
+
+
+    def test_counters(self):
+        """
+        The wrapper counts the bytes passed through the compressor, the bytes
+        it produced and the time it took.
+        """
+        data = 'foo' * self.wrapper.minimumSize
+        self.wrapper.write(data)
+        self.wrapper.finishRequest(True)
+        self.assertEqual(self.wrapper.uncompressedBytes, len(data))
+        self.assertEqual(
+            self.wrapper.compressedBytes, len(self.request.accumulator))
+        self.assertTrue(self.wrapper.compressionTime >= 0)
+
+
     def test_finish(self):
         """
         Calling C{finishRequest()} on the wrapper should cause the underlying
@@ -332,6 +332,29 @@ class FlattenIntegrationTests(TestCase):
         return finished
 
 
+    def test_oldFlattenableJoined(self):
+        """
+        The output of an L{Element} flattened with the old flatten function is
+        written in one string, rather than one for each part of the element,
+        without the buffering L{newFlatten} can be asked for.
+        """
+        class PartsElement(Element):
+            docFactory = stan(invisible(render=directive('parts')))
+            def parts(self, request, tag):
+                return [u'ab', u'cd', u'ef']
+            renderer(parts)
+
+        result = []
+        request = FakeRequest()
+        context = WovenContext()
+        context.remember(request)
+        finished = oldFlatten(
+            PartsElement(), context, result.append, lambda ign: ign)
+        finished.addCallback(
+            lambda ign: self.assertEqual(result, ['abcdef']))
+        return finished
+
+
     def test_oldFlattenableInAttribute(self):
         """
         Flattening a L{Element} as the value of an attribute of a L{Tag} XML
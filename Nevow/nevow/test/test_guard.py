@@ -13,6 +13,7 @@ from twisted.cred.checkers import InMemoryUsernamePasswordDatabaseDontUse, Allow
 from twisted.cred.portal import Portal, IRealm
 from twisted.cred.credentials import IUsernamePassword, IAnonymous
 from twisted.internet import address
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 
 from nevow import rend
@@ -859,3 +860,107 @@ class GuardTest_NotAtRoot_oneLevel(GuardTestSuper, GuardTestFuncs):
 
 class GuardTest_NotAtRoot_manyLevels(GuardTestSuper, GuardTestFuncs):
     guardPath = ['foo', 'bar', 'baz']
+
+
+
+class SessionExpiryTests(TestCase):
+    """
+    Tests for the expiry of sessions by L{guard.SessionWrapper}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.wrapper = guard.SessionWrapper(None)
+        self.wrapper.clock = self.clock
+        self.wrapper.expiryResolution = 1
+
+
+    def tearDown(self):
+        for session in self.wrapper.sessions.values():
+            session.expire()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def makeSession(self, key, lifetime=10):
+        """
+        Create a session the way L{guard.SessionWrapper.createSession} does.
+        """
+        session = self.wrapper.sessionFactory(self.wrapper, key)
+        self.wrapper.sessions[key] = session
+        session.setLifetime(lifetime)
+        session.checkExpired()
+        return session
+
+
+    def test_expired(self):
+        """
+        A session which is not touched is expired within a lifetime and a
+        resolution of its last check.
+        """
+        expired = []
+        session = self.makeSession('a')
+        session.notifyOnExpire(lambda: expired.append(True))
+        self.clock.advance(10)
+        self.assertEquals(expired, [])
+        self.clock.advance(1)
+        self.assertEquals(expired, [True])
+        self.assertEquals(self.wrapper.sessions, {})
+        self.assertEquals(self.wrapper.liveSessionCount(), 0)
+        self.assertEquals(self.wrapper.expiredSessionCount(), 1)
+
+
+    def test_touched(self):
+        """
+        A session which has been touched in the last half lifetime when it is
+        checked survives until the next check.
+        """
+        session = self.makeSession('a')
+        self.clock.advance(8)
+        session.touch()
+        self.clock.advance(3)
+        self.assertIn('a', self.wrapper.sessions)
+        self.clock.advance(11)
+        self.assertEquals(self.wrapper.sessions, {})
+
+
+    def test_sharedCall(self):
+        """
+        Sessions share a single delayed call, which goes away when the last
+        session does.
+        """
+        sessions = [self.makeSession(str(i)) for i in range(10)]
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.assertEquals(self.wrapper.liveSessionCount(), 10)
+        for session in sessions:
+            session.expire()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.assertEquals(self.wrapper.liveSessionCount(), 0)
+        self.assertEquals(self.wrapper.expiredSessionCount(), 0)
+
+
+    def test_clockJump(self):
+        """
+        Sessions which came due while the clock was not advancing are checked
+        when it next does.
+        """
+        self.makeSession('a')
+        self.clock.advance(1000)
+        self.assertEquals(self.wrapper.sessions, {})
+
+
+    def test_maxSessions(self):
+        """
+        Creating more than L{guard.SessionWrapper.maxSessions} sessions
+        expires the oldest ones.
+        """
+        self.wrapper.maxSessions = 2
+        self.makeSession('a')
+        self.makeSession('b')
+        self.makeSession('c')
+        self.assertEquals(sorted(self.wrapper.sessions), ['b', 'c'])
+        self.wrapper.sessions['b'].expire()
+        self.makeSession('d')
+        self.assertEquals(sorted(self.wrapper.sessions), ['c', 'd'])
+        self.makeSession('e')
+        self.assertEquals(sorted(self.wrapper.sessions), ['d', 'e'])
+        self.assertEquals(self.wrapper.liveSessionCount(), 2)
+        self.assertEquals(self.wrapper.evictedSessionCount(), 2)
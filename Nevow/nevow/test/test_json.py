@@ -123,6 +123,106 @@ class JavascriptObjectNotationTestCase(unittest.TestCase):
             u"\f\b\n\t\r")
 
 
+    def test_parseComments(self):
+        """
+        L{json.parse} skips comments, which strict JSON parsers do not.
+        """
+        self.assertEquals(
+            json.parse('/* leading */ [1, // trailing\n 2]'), [1, 2])
+
+
+    def test_parseLongs(self):
+        """
+        L{json.parse} returns integers as C{long}s.
+        """
+        value = json.parse('[1, -2]')
+        self.assertEquals(value, [1, -2])
+        self.assertEquals([type(v) for v in value], [long, long])
+
+
+    def test_parseConstants(self):
+        """
+        L{json.parse} rejects C{NaN} and C{Infinity}.
+        """
+        self.assertRaises(ValueError, json.parse, 'NaN')
+        self.assertRaises(ValueError, json.parse, '[Infinity]')
+
+
+    def test_serializeLikeFallback(self):
+        """
+        L{json.serialize} produces the same bytes as L{json._serialize} for
+        plain data, including strings with control and non-ASCII characters.
+        """
+        for struct in TEST_OBJECTS + TEST_STRINGLIKE_OBJECTS + [
+            u'\x00\x1f\x7f', [10L, -3], (1, (2,)), {u'a': [{u'b': u'\u2222'}]},
+            [1 / 3., float('inf'), float('-inf'), float('nan')]]:
+            L = []
+            json._serialize(struct, L.append, {})
+            self.assertEquals(json.serialize(struct), ''.join(L))
+
+
+    def test_parseLikeFallback(self):
+        """
+        L{json.parse} returns the same values as the tokenizer it falls back
+        to, including for surrogate pairs and escaped solidi, which the
+        standard library's C{json} module also accepts.
+        """
+        for s in ['"\\ud83d\\ude00"', '"\\/"', '["a\\/b", "\\u2222"]',
+                  '{"\\ud800\\udc00": [1, 2.5, 1e3]}']:
+            value, tokens = json.parseValue(json.tokenise(s))
+            self.assertEquals(json.parse(s), value)
+        self.assertEquals(json.parse('"\\ud83d\\ude00"'), u'\U0001f600')
+        self.assertEquals(json.parse('"\\/"'), u'/')
+
+
+    def test_serializeFloats(self):
+        """
+        L{json.serialize} and L{json._serialize} represent floats exactly, and
+        infinities and NaN by their JavaScript names.
+        """
+        for f, expected in [(1 / 3., '0.3333333333333333'),
+                            (float('inf'), 'Infinity'),
+                            (float('-inf'), '-Infinity'),
+                            (float('nan'), 'NaN')]:
+            L = []
+            json._serialize(f, L.append, {})
+            self.assertEquals(''.join(L), expected)
+            self.assertEquals(json.serialize([f]), '[' + expected + ']')
+
+
+    def test_serializeCycle(self):
+        """
+        L{json.serialize} raises L{json.CycleError} if passed a list or
+        dictionary which contains itself.
+        """
+        l = []
+        l.append([l])
+        self.assertRaises(json.CycleError, json.serialize, l)
+        d = {}
+        d[u'd'] = d
+        self.assertRaises(json.CycleError, json.serialize, d)
+        L = []
+        self.assertRaises(json.CycleError, json._serialize, l, L.append, {})
+
+
+    def test_serializeSharedChild(self):
+        """
+        An object which appears more than once, but does not contain itself,
+        is not a cycle.
+        """
+        shared = [1]
+        self.assertEquals(json.serialize([shared, shared]), '[[1],[1]]')
+
+
+    def test_serializeBytes(self):
+        """
+        L{json.serialize} only accepts C{unicode} strings, not C{str}.
+        """
+        self.assertRaises(TypeError, json.serialize, 'bytes')
+        self.assertRaises(TypeError, json.serialize, [u'text', 'bytes'])
+        self.assertRaises(TypeError, json.serialize, {'bytes': 1})
+
+
     def _rendererTest(self, cls):
         self.assertEquals(
             json.serialize(
@@ -302,12 +302,72 @@ class TestDocFactoriesCache(unittest.TestCase):
 
         l1 = loaders.xmlfile(temp, pattern='1')
         l2 = loaders.xmlfile(temp, pattern='1')
-        self.assertNotEqual( id(l1.load()), id(l2.load()) )
+        self.assertEquals( id(l1.load()), id(l2.load()) )
 
         l1 = loaders.xmlfile(temp, pattern='1')
         l2 = loaders.xmlfile(temp, pattern='2')
         self.assertNotEqual( id(l1.load()), id(l2.load()) )
 
+    def test_xmlfileSharing(self):
+        """
+        Loaders for the same file share the loaded template only if they load
+        it in the same way.
+        """
+        temp = self.mktemp()
+        f = file(temp, 'w')
+        f.write(self.nsdoc)
+        f.close()
+
+        doc = loaders.xmlfile(temp).load()
+        self.assertIdentical(loaders.xmlfile(temp).load(), doc)
+        self.assertNotIdentical(
+            loaders.xmlfile(temp, ignoreComment=True).load(), doc)
+        self.assertNotIdentical(
+            loaders.xmlfile(temp).load(preprocessors=[lambda doc: doc]), doc)
+
+        os.utime(temp, (os.path.getatime(temp), os.path.getmtime(temp)+5))
+        self.assertNotIdentical(loaders.xmlfile(temp).load(), doc)
+
+    def test_xmlfilePreprocessorsNotShared(self):
+        """
+        Templates loaded with preprocessors are kept only by the loader which
+        loaded them, so that the preprocessors are not kept alive by the
+        cache shared by all loaders.
+        """
+        temp = self.mktemp()
+        f = file(temp, 'w')
+        f.write(self.nsdoc)
+        f.close()
+
+        preprocessors = [lambda doc: doc]
+        loader = loaders.xmlfile(temp)
+        doc = loader.load(preprocessors=preprocessors)
+        self.assertIdentical(loader.load(preprocessors=preprocessors), doc)
+        self.assertNotIdentical(
+            loaders.xmlfile(temp).load(preprocessors=preprocessors), doc)
+        for key in loaders._xmlfileCache:
+            self.assertEquals(key[-1], ())
+
+
+    def test_xmlfileCacheSize(self):
+        """
+        The shared cache of templates is emptied when it holds
+        L{loaders.XMLFILE_CACHE_SIZE} of them.
+        """
+        self.patch(loaders, 'XMLFILE_CACHE_SIZE', 2)
+        self.patch(loaders, '_xmlfileCache', {})
+        temps = []
+        for i in range(3):
+            temp = self.mktemp()
+            f = file(temp, 'w')
+            f.write(self.nsdoc)
+            f.close()
+            temps.append(temp)
+            loaders.xmlfile(temp).load()
+        self.assertEquals(
+            [key[0] for key in loaders._xmlfileCache], [temps[2]])
+
+
     def test_xmlfileReload(self):
 
         temp = self.mktemp()
@@ -10,11 +10,11 @@ import sys, traceback
 from zope.interface import implements
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import Deferred, succeed
+from twisted.internet.defer import Deferred, succeed, fail
 
 from nevow.inevow import IRequest, IQ, IRenderable, IData
 from nevow._flat import FlattenerError, UnsupportedType, UnfilledSlot
-from nevow._flat import flatten, deferflatten
+from nevow._flat import flatten, deferflatten, _flattensome
 from nevow.tags import Proto, Tag, slot, raw, xml
 from nevow.tags import invisible, br, div, directive
 from nevow.entities import nbsp
@@ -1349,3 +1349,134 @@ class DeferflattenTests(TestCase, FlattenMixin):
         finished.addCallback(lambda ignored: "".join(result))
         finished.addCallback(self.assertStringEqual, '"&amp;&lt;&gt;')
         return finished
+
+
+
+class FlattensomeTests(TestCase):
+    """
+    Tests for L{nevow._flat._flattensome}.
+    """
+    def setUp(self):
+        self.writes = []
+        self.scheduled = []
+        self.result = Deferred()
+
+
+    def schedule(self, f, *a):
+        self.scheduled.append((f, a))
+
+
+    def flattensome(self, root):
+        _flattensome(flatten(None, root, False, False), self.writes.append,
+                     self.schedule, self.result)
+
+
+    def test_firedDeferreds(self):
+        """
+        L{_flattensome} continues past L{Deferred}s which already have results
+        without scheduling a call.
+        """
+        self.flattensome(["a", succeed("b"), [succeed("c")], "d"])
+        self.assertEqual(self.writes, ["a", "b", "c", "d"])
+        self.assertEqual(self.scheduled, [])
+        self.assertTrue(self.result.called)
+
+
+    def test_unfiredDeferred(self):
+        """
+        L{_flattensome} stops at a L{Deferred} without a result, and schedules
+        a call to resume once it has one.
+        """
+        deferred = Deferred()
+        self.flattensome(["a", deferred, "c"])
+        self.assertEqual(self.writes, ["a"])
+        self.assertEqual(self.scheduled, [])
+        deferred.callback("b")
+        self.assertEqual(len(self.scheduled), 1)
+        f, a = self.scheduled.pop()
+        f(*a)
+        self.assertEqual(self.writes, ["a", "b", "c"])
+        self.assertTrue(self.result.called)
+
+
+    def test_failedDeferred(self):
+        """
+        A L{Deferred} which has already failed fails the result without
+        scheduling a call.
+        """
+        self.flattensome(["a", fail(RuntimeError()), "b"])
+        self.assertEqual(self.writes, ["a"])
+        self.assertEqual(self.scheduled, [])
+        return self.assertFailure(self.result, RuntimeError)
+
+
+
+class BufferedDeferflattenTests(DeferflattenTests):
+    """
+    Tests for L{nevow._flat.deferflatten} with a C{bufferSize}.
+    """
+    def deferflatten(self, root, request=None, bufferSize=16):
+        """
+        Helper to get a string from L{deferflatten}, collecting output in a
+        buffer of C{bufferSize} bytes.
+        """
+        result = []
+        d = deferflatten(request, root, False, False, result.append, bufferSize)
+        def cbFlattened(ignored):
+            return "".join(result)
+        d.addCallback(cbFlattened)
+        return d
+
+
+    def test_coalesced(self):
+        """
+        Output smaller than C{bufferSize} is passed to C{write} all at once.
+        """
+        writes = []
+        deferflatten(
+            None, div[[br for i in range(10)]], False, False, writes.append,
+            1024)
+        self.assertEqual(writes, ["<div>" + "<br />" * 10 + "</div>"])
+
+
+    def test_bufferSize(self):
+        """
+        Output is passed to C{write} once at least C{bufferSize} bytes of it
+        have been produced.
+        """
+        writes = []
+        deferflatten(
+            None, div[[br for i in range(10)]], False, False, writes.append,
+            12)
+        self.assertEqual(
+            "".join(writes), "<div>" + "<br />" * 10 + "</div>")
+        for data in writes[:-1]:
+            self.assertTrue(len(data) >= 12)
+
+
+    def test_flushBeforeWaiting(self):
+        """
+        Output produced before a L{Deferred} without a result is passed to
+        C{write} before waiting for it.
+        """
+        writes = []
+        deferred = Deferred()
+        finished = deferflatten(
+            None, ["foo", deferred, "bar"], False, False, writes.append, 1024)
+        self.assertEqual(writes, ["foo"])
+        deferred.callback("baz")
+        def cbFlattened(ignored):
+            self.assertEqual(writes, ["foo", "bazbar"])
+        finished.addCallback(cbFlattened)
+        return finished
+
+
+    def test_flushOnError(self):
+        """
+        Output produced before an error is passed to C{write}.
+        """
+        writes = []
+        finished = deferflatten(
+            None, ["foo", object()], False, False, writes.append, 1024)
+        self.assertEqual(writes, ["foo"])
+        return self.assertFailure(finished, FlattenerError)
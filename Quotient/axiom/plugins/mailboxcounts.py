@@ -0,0 +1,29 @@
+from axiom.scripts import axiomatic
+
+from xquotient.exmess import (
+    rebuildMailboxCounts, checkMailboxCounts, keepsMailboxCounts)
+
+
+class MailboxCounts(axiomatic.AxiomaticCommand):
+
+    name = 'mailbox-counts'
+    description = 'Check or rebuild the stored counts of messages in a mailbox'
+
+    optFlags = [("rebuild", None, "Count every message again and replace the stored counts.")]
+
+    def postOptions(self):
+        s = self.store
+        if self['rebuild']:
+            s.transact(rebuildMailboxCounts, s)
+            print 'Mailbox counts rebuilt.'
+            return
+        if not keepsMailboxCounts(s):
+            raise SystemExit("Mailbox counts are not kept for this store; "
+                             "run with --rebuild to start keeping them.")
+        wrong = s.transact(checkMailboxCounts, s)
+        for (key, stored, actual) in wrong:
+            print '%r: stored %r, actual %r' % (key, stored, actual)
+        if wrong:
+            raise SystemExit("%d mailbox counts are wrong; run with "
+                             "--rebuild to fix them." % (len(wrong),))
+        print 'Mailbox counts are correct.'
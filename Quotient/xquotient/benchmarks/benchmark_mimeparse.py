@@ -0,0 +1,93 @@
+
+"""
+Parse the messages in the I{messages} directory with L{MIMEMessageReceiver},
+as delivery does, and report the parser's throughput.
+
+Each message is parsed C{REPEAT} times as it is, and once more wrapped in a
+multipart message along with a C{ATTACHMENT_SIZE} byte base64 attachment, so
+that both header-heavy and body-heavy input are measured.
+"""
+
+import time
+from base64 import encodestring
+
+from twisted.python.filepath import FilePath
+
+from epsilon.scripts import benchmark
+
+from xquotient.mimepart import MIMEMessageReceiver
+
+REPEAT = 200
+ATTACHMENT_SIZE = 20 * 1024 * 1024
+
+
+class NullFile(object):
+    """
+    Stand-in for the L{AtomicFile} a message is written to during delivery.
+    """
+    def write(self, bytes):
+        pass
+
+
+    def close(self):
+        pass
+
+
+    def abort(self):
+        pass
+
+
+
+def withAttachment(source, size):
+    """
+    Return C{source} as the first part of a multipart message which also
+    contains an attachment of C{size} bytes.
+    """
+    return (
+        'From: benchmark@example.com\r\n'
+        'Content-Type: multipart/mixed; boundary="BENCHMARK"\r\n'
+        '\r\n'
+        '--BENCHMARK\r\n'
+        'Content-Type: message/rfc822\r\n'
+        '\r\n' +
+        source +
+        '\r\n--BENCHMARK\r\n'
+        'Content-Type: application/octet-stream\r\n'
+        'Content-Transfer-Encoding: base64\r\n'
+        '\r\n' +
+        encodestring('\xa5' * size).replace('\n', '\r\n') +
+        '--BENCHMARK--\r\n')
+
+
+
+def parse(sources):
+    """
+    Parse each of C{sources} and return the number of bytes parsed.
+    """
+    total = 0
+    for source in sources:
+        MIMEMessageReceiver(NullFile()).feedStringNow(source)
+        total += len(source)
+    return total
+
+
+
+def main():
+    messages = [path.getContent()
+                for path in FilePath(__file__).sibling('messages').children()]
+    sources = messages * REPEAT
+    sources.extend([withAttachment(message, ATTACHMENT_SIZE)
+                    for message in messages])
+
+    benchmark.start()
+    before = time.time()
+    total = parse(sources)
+    elapsed = time.time() - before
+    benchmark.stop()
+    print '%d bytes in %.2f seconds (%.2f MB/s)' % (
+        total, elapsed, total / elapsed / 1024 / 1024)
+
+
+
+if __name__ == '__main__':
+    main()
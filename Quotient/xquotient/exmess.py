@@ -18,7 +18,8 @@ from datetime import timedelta
 from zope.interface import implements
 
 from twisted.python.components import registerAdapter
-from twisted.python.util import sibpath
+from twisted.internet.interfaces import IPullProducer
+from twisted.python.util import sibpath, mergeFunctionMetadata
 from twisted.web import microdom
 from twisted.web.sux import ParseError
 
@@ -161,6 +162,219 @@ def getMessageSources(store):
         sort=_DistinctMessageSourceValue.value.ascending).getColumn("value")
 
 
+
+class _MailboxCount(item.Item):
+    """
+    The number of messages with a particular status, tag and source.
+
+    These are kept up to date as messages change, so that
+    L{MailboxSelector.count} need not count messages itself, but only once
+    L{rebuildMailboxCounts} has been run on a store.
+    """
+    statusName = attributes.text(doc="""
+    The status of the counted messages.
+    """, allowNone=False)
+
+    tag = attributes.text(doc="""
+    A tag of the counted messages, or None to count messages regardless of
+    their tags.
+    """)
+
+    source = attributes.text(doc="""
+    The source of the counted messages, or None to count messages regardless
+    of their source.
+    """)
+
+    messages = attributes.integer(doc="""
+    The number of messages with this status, tag and source.
+    """, default=0, allowNone=False)
+
+    unread = attributes.integer(doc="""
+    The number of those messages which also have L{UNREAD_STATUS}.
+    """, default=0, allowNone=False)
+
+    attributes.compoundIndex(statusName, tag, source)
+
+
+
+class _MailboxCountState(item.Item):
+    """
+    The presence of one of these in a store means that its L{_MailboxCount}
+    items are kept up to date.
+    """
+    rebuilt = attributes.timestamp(doc="""
+    When the counts were last rebuilt by L{rebuildMailboxCounts}.
+    """, allowNone=False)
+
+
+
+def _mailboxCountKeys(statuses, tags, sources):
+    """
+    Find the counts a message is included in.
+
+    @param statuses: the names of the hard statuses of a message.
+    @param tags: the names of its tags.
+    @param sources: its sources.
+
+    @return: a C{dict} mapping the (status, tag, source) keys of the
+    L{_MailboxCount} items which include the message to 1 if the message
+    is also counted as unread in them, 0 otherwise.
+    """
+    unread = int(UNREAD_STATUS in statuses)
+    tags = [None] + list(tags)
+    sources = [None] + list(sources)
+    return dict(((statusName, tag, source), unread)
+                for statusName in statuses
+                for tag in tags
+                for source in sources)
+
+
+
+def _mailboxCountsFor(message):
+    """
+    Find the counts C{message} is included in, as L{_mailboxCountKeys} does.
+    """
+    store = message.store
+    return _mailboxCountKeys(
+        set(store.query(_MessageStatus,
+                        _MessageStatus.message == message).getColumn(
+                'statusName')),
+        set(store.query(Tag, Tag.object == message).getColumn('name')),
+        set(store.query(_MessageSourceValue,
+                        _MessageSourceValue.message == message).getColumn(
+                'value')))
+
+
+
+def keepsMailboxCounts(store):
+    """
+    Determine whether the L{_MailboxCount} items in C{store} are kept up to
+    date.
+    """
+    return store.findUnique(_MailboxCountState, default=None) is not None
+
+
+
+def _adjustMailboxCounts(store, before, after):
+    """
+    Update the L{_MailboxCount} items in C{store} for a message which used to
+    be included in the counts C{before} and is now included in C{after}, as
+    returned by L{_mailboxCountsFor}.
+    """
+    for key in set(before) | set(after):
+        messages = (key in after) - (key in before)
+        unread = after.get(key, 0) - before.get(key, 0)
+        if messages or unread:
+            statusName, tag, source = key
+            count = store.findOrCreate(
+                _MailboxCount, statusName=statusName, tag=tag, source=source)
+            count.messages += messages
+            count.unread += unread
+
+
+
+def _countingMailboxChanges(method):
+    """
+    Decorate a L{Message} method which may change the statuses or tags of the
+    message, so that the L{_MailboxCount} items in its store are updated for
+    the change, in the same transaction, if they are being kept.  Changes
+    made by one decorated method calling another are counted once, by the
+    outermost.
+    """
+    def counting(self, *a, **kw):
+        if self._adjustingMailboxCounts or not keepsMailboxCounts(self.store):
+            return method(self, *a, **kw)
+        def change():
+            before = _mailboxCountsFor(self)
+            self._adjustingMailboxCounts = True
+            try:
+                result = method(self, *a, **kw)
+            finally:
+                self._adjustingMailboxCounts = False
+            _adjustMailboxCounts(self.store, before, _mailboxCountsFor(self))
+            return result
+        return self.store.transact(change)
+    return mergeFunctionMetadata(method, counting)
+
+
+
+def _countMailbox(store):
+    """
+    Count the messages in C{store} from scratch.
+
+    @return: a C{dict} mapping (status, tag, source) keys to (messages,
+    unread) pairs, for every count which is not zero.
+    """
+    def columns(itemType, comparison, column):
+        query = store.query(itemType, comparison, sort=itemType.storeID.ascending)
+        result = {}
+        for (messageID, value) in zip(query.getColumn('message', raw=True),
+                                      query.getColumn(column)):
+            result.setdefault(messageID, set()).add(value)
+        return result
+    statuses = columns(_MessageStatus, None, 'statusName')
+    tags = {}
+    query = store.query(Tag, Tag.object == Message.storeID,
+                        sort=Tag.storeID.ascending)
+    for (messageID, name) in zip(query.getColumn('object', raw=True),
+                                 query.getColumn('name')):
+        tags.setdefault(messageID, set()).add(name)
+    sources = columns(_MessageSourceValue, None, 'value')
+
+    counts = {}
+    for messageID, messageStatuses in statuses.iteritems():
+        keys = _mailboxCountKeys(messageStatuses,
+                                 tags.get(messageID, ()),
+                                 sources.get(messageID, ()))
+        for key, unread in keys.iteritems():
+            messages, unreadMessages = counts.get(key, (0, 0))
+            counts[key] = (messages + 1, unreadMessages + unread)
+    return counts
+
+
+
+def rebuildMailboxCounts(store):
+    """
+    Count the messages in C{store} from scratch, replacing any existing
+    L{_MailboxCount} items, and keep the counts up to date from now on so
+    that L{MailboxSelector.count} can use them.
+
+    This should be run in a transaction.
+    """
+    store.query(_MailboxCount).deleteFromStore()
+    for (statusName, tag, source), (messages, unread) in (
+            _countMailbox(store).iteritems()):
+        _MailboxCount(store=store, statusName=statusName, tag=tag,
+                      source=source, messages=messages, unread=unread)
+    state = store.findOrCreate(_MailboxCountState, rebuilt=Time())
+    state.rebuilt = Time()
+
+
+
+def checkMailboxCounts(store):
+    """
+    Compare the L{_MailboxCount} items in C{store} with a count of its
+    messages from scratch.
+
+    @return: a C{list} of C{((status, tag, source), (messages, unread),
+    (actualMessages, actualUnread))} tuples, one for each count which is
+    wrong, sorted by key.
+    """
+    actual = _countMailbox(store)
+    stored = {}
+    for count in store.query(_MailboxCount):
+        stored[count.statusName, count.tag, count.source] = (
+            count.messages, count.unread)
+    wrong = []
+    for key in set(actual) | set(stored):
+        counts = stored.get(key, (0, 0))
+        actualCounts = actual.get(key, (0, 0))
+        if counts != actualCounts:
+            wrong.append((key, counts, actualCounts))
+    wrong.sort()
+    return wrong
+
+
 class MailboxSelector(object):
     """
     A mailbox selector is a view onto a user's mailbox.
@@ -392,11 +606,49 @@ class MailboxSelector(object):
     def count(self):
         """
         Return the number of results in this query.
+
+        If L{_MailboxCount} items are being kept in my store, and this query
+        has a single status, or a single status and L{UNREAD_STATUS}, and is
+        not refined by person, the number is looked up rather than counted.
         """
         if self.earlyOut:
             return 0
-        return self.store.query(Message, self._getComparison(),
-                                limit=self.limit).distinct().count()
+        count = self._storedCount()
+        if count is None:
+            return self.store.query(Message, self._getComparison(),
+                                    limit=self.limit).distinct().count()
+        if self.limit is not None:
+            count = min(count, self.limit)
+        return count
+
+
+    def _storedCount(self):
+        """
+        Look up the number of results in this query in the L{_MailboxCount}
+        items of my store.
+
+        @return: the number of results, or None if it can't be looked up.
+        """
+        statuses = set(self.statuses)
+        if (self.addresses or not statuses
+            or not keepsMailboxCounts(self.store)):
+            return None
+        if len(statuses) == 1:
+            column = 'messages'
+        elif len(statuses) == 2 and UNREAD_STATUS in statuses:
+            statuses.remove(UNREAD_STATUS)
+            column = 'unread'
+        else:
+            return None
+        count = self.store.findUnique(
+            _MailboxCount,
+            attributes.AND(_MailboxCount.statusName == statuses.pop(),
+                           _MailboxCount.tag == self.tag,
+                           _MailboxCount.source == self.source),
+            default=None)
+        if count is None:
+            return 0
+        return getattr(count, column)
 
 
     def __iter__(self):
@@ -624,6 +876,7 @@ class Message(item.Item):
         """, allowNone=True, default=None)
 
     _prefs = attributes.inmemory()
+    _adjustingMailboxCounts = attributes.inmemory()
 
     # End of schema.
 
@@ -754,6 +1007,7 @@ class Message(item.Item):
                 statusName=statusName,
                 statusDate=self.receivedWhen)
         return None
+    addHardStatus = _countingMailboxChanges(addHardStatus)
 
 
     def addStatus(self, statusName):
@@ -791,6 +1045,7 @@ class Message(item.Item):
                            _MessageStatus.statusName == statusName)
             ).deleteFromStore()
         return None
+    removeHardStatus = _countingMailboxChanges(removeHardStatus)
 
 
     def removeStatus(self, statusName):
@@ -837,6 +1092,7 @@ class Message(item.Item):
         # frozen status.  Freeze everything else.
         self._frozenWith = freezeType
         self.addHardStatus(freezeType)
+    freezeStatus = _countingMailboxChanges(freezeStatus)
 
 
     def unfreezeStatus(self, freezeType):
@@ -865,6 +1121,7 @@ class Message(item.Item):
             self.removeStatus(freezeType)
         else:
             raise ValueError("Message not frozen with %r status" % (freezeType,))
+    unfreezeStatus = _countingMailboxChanges(unfreezeStatus)
 
 
     def _unfreezeAll(self):
@@ -877,6 +1134,33 @@ class Message(item.Item):
                                   _MessageStatus.message == self):
             if isFrozen(s.statusName):
                 s.statusName = unfrozen(s.statusName)
+    _unfreezeAll = _countingMailboxChanges(_unfreezeAll)
+
+
+    def addTag(self, catalog, tagName, tagger=None):
+        """
+        Tag this message.
+
+        @param catalog: the L{Catalog} to apply the tag in.
+        @param tagName: the name of the tag to apply.
+        @param tagger: the item applying the tag, or None.
+        """
+        catalog.tag(self, tagName, tagger)
+    addTag = _countingMailboxChanges(addTag)
+
+
+    def removeTag(self, tagName):
+        """
+        Remove a tag from this message.
+
+        @param tagName: the name of a tag which has been applied to this
+        message.
+        """
+        self.store.findUnique(Tag,
+                              attributes.AND(Tag.object == self,
+                                             Tag.name == tagName)
+                              ).deleteFromStore()
+    removeTag = _countingMailboxChanges(removeTag)
 
 
     def statusesFrozen(self):
@@ -1290,6 +1574,7 @@ class Message(item.Item):
 
     def activate(self):
         self._prefs = None
+        self._adjustingMailboxCounts = False
 
 
     def deleteFromStore(self):
@@ -1300,7 +1585,13 @@ class Message(item.Item):
         # XXX This is a hack because real deletion notification is hard.
         for indexer in self.store.powerupsFor(ixmantissa.IFulltextIndexer):
             indexer.remove(self)
-        super(Message, self).deleteFromStore()
+        if keepsMailboxCounts(self.store):
+            def delete():
+                _adjustMailboxCounts(self.store, _mailboxCountsFor(self), {})
+                super(Message, self).deleteFromStore()
+            self.store.transact(delete)
+        else:
+            super(Message, self).deleteFromStore()
 
 
     def walkMessage(self, prefer=None):
@@ -1343,7 +1634,8 @@ class Message(item.Item):
         if not tmpdir.exists():
             tmpdir.makedirs()
 
-        zipf = zipfile.ZipFile(tmpdir.temporarySibling().path, 'w')
+        zipPath = tmpdir.temporarySibling()
+        zipf = zipfile.ZipFile(zipPath.path, 'w')
 
         nameless = 0
         for a in self.walkAttachments():
@@ -1354,9 +1646,22 @@ class Message(item.Item):
             else:
                 fname = fname.encode('ascii')
 
-            zipf.writestr(fname, a.part.getBody(decode=True))
+            # ZipFile can only add a whole string or a whole file, so decode
+            # each attachment into a file first rather than into memory.
+            bodyPath = tmpdir.temporarySibling()
+            bodyFile = bodyPath.open('w')
+            try:
+                for chunk in a.part.iterBody(decode=True):
+                    bodyFile.write(chunk)
+            finally:
+                bodyFile.close()
+            try:
+                zipf.write(bodyPath.path, fname)
+            finally:
+                bodyPath.remove()
 
-        return zipf.fp.name
+        zipf.close()
+        return zipPath.path
 
 
     # IFulltextIndexable
@@ -2009,6 +2314,39 @@ class ItemGrabber(rend.Page):
         return rend.NotFound
 
 
+class _BodyTransfer(object):
+    """
+    Write the body of a message part to a request a chunk at a time, as the
+    request is ready for more of it.
+
+    @ivar chunks: an iterator of C{str}, as returned by
+    L{xquotient.mimestorage.Part.iterBody}.
+    """
+    implements(IPullProducer)
+
+    def __init__(self, chunks, request):
+        self.chunks = chunks
+        self.request = request
+        request.registerProducer(self, False)
+
+
+    def resumeProducing(self):
+        if self.request is None:
+            return
+        chunk = next(self.chunks, None)
+        if chunk is not None:
+            self.request.write(chunk)
+        else:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.request = self.chunks = None
+
+
+    def stopProducing(self):
+        self.request = self.chunks = None
+
+
+
 class PartDisplayer(ItemGrabber):
     """
     somewhere there needs to be an IResource that can display the standalone
@@ -2089,6 +2427,23 @@ class PartDisplayer(ItemGrabber):
         return tags.xml(content)
 
 
+    def renderHTTP(self, ctx):
+        """
+        Render text parts as usual, since they may need to be scrubbed, but
+        write the bodies of any other parts, such as attachments being
+        downloaded, to the request as they are decoded.
+        """
+        ctype = self.item.getContentType()
+        if ctype.startswith('text/'):
+            return ItemGrabber.renderHTTP(self, ctx)
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', ctype)
+        if request.method == 'HEAD':
+            return ''
+        _BodyTransfer(self.item.iterBody(decode=True), request)
+        return request.deferred
+
+
     def render_content(self, ctx, data):
         request = inevow.IRequest(ctx)
         ctype = self.item.getContentType()
@@ -2601,13 +2956,10 @@ class MessageDetail(athena.LiveFragment, rend.ChildLookupMixin, ButtonRenderingM
         c = self.original.store.findOrCreate(Catalog)
 
         for t in tagsToAdd:
-            c.tag(self.original, t)
+            self.original.addTag(c, t)
 
         for t in tagsToDelete:
-            self.original.store.findUnique(Tag,
-                                    attributes.AND(
-                                        Tag.object == self.original,
-                                        Tag.name == t)).deleteFromStore()
+            self.original.removeTag(t)
 
         return list(self.catalog.tagsOf(self.original))
     expose(modifyTags)
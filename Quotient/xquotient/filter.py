@@ -113,7 +113,7 @@ class FixedTagAction(item.Item):
 
 
     def actOn(self, pup, rule, item, extraData):
-        pup.tagCatalog.tag(item, self.tagName, rule)
+        item.addTag(pup.tagCatalog, self.tagName, rule)
 
 
 
@@ -125,13 +125,13 @@ class VariableTagAction(item.Item):
 
 
     def actOn(self, pup, rule, item, extraData):
-        pup.tagCatalog.tag(item, extraData['tagName'], rule)
+        item.addTag(pup.tagCatalog, extraData['tagName'], rule)
 
 
 
 class MailingListTagAction(object):
     def actOn(self, pup, rule, item, extraData):
-        pup.tagCatalog.tag(item, extraData['mailingListName'], rule)
+        item.addTag(pup.tagCatalog, extraData['mailingListName'], rule)
 
 
 
@@ -706,9 +706,15 @@ def messageFromStructure(avatar, headers, parts):
 # message ended (body ends)
 
 class MIMEMessageReceiver(object):
+    """
+    @ivar blockSize: The number of bytes L{feedFile} and L{feedFileNow} read
+        at a time.  L{feedFile} gives control back to the cooperator after
+        each block.
+    """
     implements(smtp.IMessage)
 
     done = False
+    blockSize = 2 ** 16
 
     def __init__(self, fileObj, partFactory=MIMEPart):
         """
@@ -788,15 +794,99 @@ class MIMEMessageReceiver(object):
     def feedStringNow(self, s):
         return self.feedFileNow(StringIO(s))
 
+    def _skippingBody(self):
+        """
+        Determine whether the current parser is in a part of a body where
+        only lines which could be boundaries are of any interest to it.
+        """
+        parser = self.parser
+        return (not parser.parsingHeaders and
+                parser.bodyMode in ('body', 'preamble', 'postamble'))
+
+
+    def _bodyLinesReceived(self, lines):
+        """
+        Handle a run of complete lines, none of which could be a boundary,
+        while L{_skippingBody}, without looking at them one at a time.
+
+        The result is exactly what passing each to L{lineReceived} would
+        have done: line endings are normalized to C{\\n} and the parser's
+        lengths are updated as of the beginning of the last line.
+
+        @return: C{False} if the lines contain a carriage return which is not
+            part of a line ending, in which case nothing has been done.
+        """
+        lines = lines.replace('\r\n', '\n')
+        if '\r' in lines:
+            return False
+        lastLineBegin = self.bytecount + lines.rfind('\n', 0, -1) + 1
+        self.file.write(lines)
+        self.bytecount += len(lines)
+        self.parser.updateLength(lastLineBegin)
+        return True
+
+
+    def _linesReceived(self, buf, pos, end):
+        """
+        Pass each of the complete lines in C{buf[pos:end]} to
+        L{lineReceived}.
+        """
+        for line in buf[pos:end].split('\n')[:-1]:
+            self.lineReceived(line.strip('\r\n'))
+
+
+    def _boundaryCandidate(self, buf, pos, end,
+                           dashes=re.compile('\r*--')):
+        """
+        Return the index of the first line in C{buf[pos:end]} which could be
+        a boundary, or C{end} if there is none.  C{pos} must be the index of
+        the beginning of a line.
+        """
+        # Carriage returns are stripped from the beginnings of lines too, so
+        # a line can still be a boundary if they come before the dashes.
+        if dashes.match(buf, pos):
+            return pos
+        candidate = buf.find('\n--', pos, end)
+        if candidate == -1:
+            candidate = end
+        else:
+            candidate += 1
+        returned = buf.find('\n\r', pos, candidate)
+        while returned != -1:
+            if dashes.match(buf, returned + 1):
+                return returned + 1
+            returned = buf.find('\n\r', returned + 1, candidate)
+        return candidate
+
+
     def _deliverer(self, f):
+        # Every line goes through lineReceived, except that runs of body lines
+        # which cannot be boundaries are handed to _bodyLinesReceived in one
+        # go.
+        buf = ''
         try:
             while True:
-                line = f.readline()
-                if not line:
+                block = f.read(self.blockSize)
+                if not block:
                     break
-                line = line.strip('\r\n')
-                self.lineReceived(line)
+                buf += block
+                end = buf.rfind('\n') + 1
+                pos = 0
+                while pos < end:
+                    if self._skippingBody():
+                        stop = self._boundaryCandidate(buf, pos, end)
+                        if stop > pos:
+                            if not self._bodyLinesReceived(buf[pos:stop]):
+                                self._linesReceived(buf, pos, stop)
+                            pos = stop
+                            continue
+                    eol = buf.index('\n', pos) + 1
+                    self.lineReceived(buf[pos:eol].strip('\r\n'))
+                    pos = eol
+                buf = buf[end:]
                 yield None
+            if buf:
+                self.lineReceived(buf.strip('\r\n'))
         except:
             self.file.abort()
             raise
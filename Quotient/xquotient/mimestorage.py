@@ -1,7 +1,7 @@
 # -*- test-case-name: xquotient.test.test_mimepart -*-
 
-import itertools
-import quopri, binascii, rfc822
+import itertools, mmap, string
+import binascii, rfc822
 
 from zope.interface import implements
 
@@ -10,13 +10,144 @@ from twisted.python import log
 from epsilon.extime import Time
 
 from axiom import item, attributes, iaxiom
+from axiom.upgrade import registerUpgrader
 
 from xquotient import mimepart, equotient, mimeutil, exmess, iquotient, smtpout
 
 
+def _encodeHeaders(headers):
+    """
+    Serialize headers for storage in L{Part.headerData}.
+
+    Each name and value is encoded as UTF-8 and written as a netstring, so
+    values may contain any character, including newlines and colons.
+
+    @param headers: an iterable of objects with C{name} and C{value} unicode
+    attributes.
+
+    @rtype: C{str}
+    """
+    data = []
+    for hdr in headers:
+        for field in hdr.name, hdr.value:
+            field = field.encode('utf-8')
+            data.append('%d:%s' % (len(field), field))
+    return ''.join(data)
+
+
+
+def _decodeHeaders(data):
+    """
+    Reverse L{_encodeHeaders}.
+
+    @type data: C{str}
+
+    @return: a C{list} of L{mimepart.Header} instances, in their original
+    order.
+    """
+    fields = []
+    pos = 0
+    while pos < len(data):
+        colon = data.index(':', pos)
+        end = colon + 1 + int(data[pos:colon])
+        fields.append(data[colon + 1:end].decode('utf-8'))
+        pos = end
+    return [mimepart.Header(fields[i], fields[i + 1])
+            for i in xrange(0, len(fields), 2)]
+
+
+
+_IDENTITY = string.maketrans('', '')
+_NOT_BASE64 = _IDENTITY.translate(
+    _IDENTITY, string.ascii_letters + string.digits + '+/=')
+
+def _decodeBase64(chunks):
+    """
+    Decode base64 a chunk at a time, keeping no more than three undecoded
+    characters between chunks.
+
+    The result is the same as decoding all of the chunks joined together,
+    except that where the encoding cannot be repaired by adding padding, the
+    undecodable trailing characters are dropped instead of the whole body
+    being returned undecoded.
+
+    @param chunks: an iterable of C{str} holding base64 encoded data.
+
+    @return: an iterator of C{str}.
+    """
+    data = ''
+    for chunk in chunks:
+        data += chunk.translate(_IDENTITY, _NOT_BASE64)
+        while True:
+            # Padding ends the encoded data, unless it comes too early in a
+            # quad to mean anything, in which case it is ignored.
+            pad = data.find('=')
+            if pad == -1:
+                end = len(data) - len(data) % 4
+            elif pad % 4 < 2:
+                data = data[:pad] + data[pad + 1:]
+                continue
+            elif pad % 4 == 3:
+                yield binascii.a2b_base64(data[:pad + 1])
+                return
+            elif pad + 1 == len(data):
+                end = pad - 2
+            elif data[pad + 1] == '=':
+                yield binascii.a2b_base64(data[:pad + 2])
+                return
+            else:
+                data = data[:pad] + data[pad + 1:]
+                continue
+            if end:
+                yield binascii.a2b_base64(data[:end])
+                data = data[end:]
+            break
+    for extraPadding in ('', '=', '=='):
+        try:
+            decoded = binascii.a2b_base64(data + extraPadding)
+        except binascii.Error:
+            pass
+        else:
+            if decoded:
+                yield decoded
+            return
+
+
+
+def _decodeQuotedPrintable(chunks):
+    """
+    Decode quoted-printable a line at a time.
+
+    No escape sequence continues past the end of a line, so decoding only
+    whole lines gives the same result as decoding all of the chunks joined
+    together.  Quoted-printable lines are short, so little is held between
+    chunks.
+
+    @param chunks: an iterable of C{str} holding quoted-printable encoded
+    data.
+
+    @return: an iterator of C{str}.
+    """
+    data = ''
+    for chunk in chunks:
+        data += chunk
+        end = data.rfind('\n') + 1
+        if end:
+            yield binascii.a2b_qp(data[:end])
+            data = data[end:]
+    if data:
+        yield binascii.a2b_qp(data)
+
+
+
 class Header(item.Item):
     """
     Database resident representation of a MIME header.
+
+    Headers are stored with the L{Part} they belong to, in
+    L{Part.headerData}.  Items of this type are only created for the headers
+    named in L{Part.indexedHeaders}, so that those can be found with a query,
+    and for parts stored before L{Part.headerData} existed.
     """
     typeName = 'quotient_mime_header'
     schemaVersion = 1
@@ -55,7 +186,12 @@ class Part(item.Item):
     implements(iquotient.IMessageData)
 
     typeName = 'quotient_mime_part'
-    schemaVersion = 1
+    schemaVersion = 2
+
+    # The names of the headers which get a Header item, as well as a place in
+    # headerData, so that messages can be found by their values.
+    indexedHeaders = frozenset([
+        u'message-id', u'in-reply-to', u'references', u'list-id'])
 
     parent = attributes.reference(
         "A reference to another Part object, or None for the top-level part.")
@@ -80,6 +216,11 @@ class Part(item.Item):
     bodyLength = attributes.integer(
         "The length in bytes that my body consumes within the source file.")
 
+    headerData = attributes.bytes(
+        "All of my headers, serialized by L{_encodeHeaders}, or None if my "
+        "headers are stored only as L{Header} items.",
+        default=None)
+
 
     _partCounter = attributes.inmemory(
         "Temporary Part-ID factory function used to assign IDs to parts "
@@ -87,9 +228,14 @@ class Part(item.Item):
     _headers = attributes.inmemory(
         "Temporary storage for header data before this Part is added to "
         "a database.")
+    _headerCache = attributes.inmemory(
+        "The decoded contents of headerData, a list of "
+        "L{mimepart.Header} instances.")
     _children = attributes.inmemory(
         "Temporary storage for child parts before this Part is added to "
         "a database.")
+    _childParts = attributes.inmemory(
+        "A list of the stored child parts of this Part, set by L{loadTree}.")
 
     def __init__(self, *a, **kw):
         super(Part, self).__init__(*a, **kw)
@@ -103,11 +249,8 @@ class Part(item.Item):
         if not hasattr(self, '_headers'):
             self._headers = []
 
-        self._headers.append(Header(name=name.decode('ascii', 'ignore').lower(),
-                                    value=value,
-                                    part=self,
-                                    message=self.message,
-                                    index=len(self._headers)))
+        self._headers.append(
+            mimepart.Header(name.decode('ascii', 'ignore').lower(), value))
 
     def walk(self, shallow=False):
         """
@@ -120,14 +263,47 @@ class Part(item.Item):
 
     def _walkDeep(self):
         yield self
-        for child in self.store.query(Part, Part.parent == self):
-            for grandchild in child.walk():
+        for child in self._walkShallow():
+            for grandchild in child._walkDeep():
                 yield grandchild
 
     def _walkShallow(self):
+        self.loadTree()
+        if hasattr(self, '_childParts'):
+            return iter(self._childParts)
         return self.store.query(Part, Part.parent == self)
 
+    def loadTree(self):
+        """
+        Load all of the parts of my message with a single query and remember
+        the children of each of them, so that L{walk} and L{getSubPart} need
+        no further queries on any part of the message.  Their headers come
+        along with them, in L{headerData}.
+
+        Nothing is loaded if this has been done already, or if I am not
+        part of a stored message.
+
+        @return: C{self}
+        """
+        if (hasattr(self, '_childParts')
+            or self.store is None or self.message is None):
+            return self
+        parts = list(self.store.query(Part, Part.message == self.message,
+                                      sort=Part.storeID.ascending))
+        children = {}
+        for part in parts:
+            part._childParts = children.setdefault(part.storeID, [])
+        for part in parts:
+            if part.parent is not None:
+                children.setdefault(part.parent.storeID, []).append(part)
+        return self
+
     def getSubPart(self, partID):
+        self.loadTree()
+        if hasattr(self, '_childParts'):
+            for child in self._childParts:
+                if child.partID == partID:
+                    return child
         return self.store.findUnique(Part,
                 attributes.AND(Part.parent==self,
                                Part.partID==partID))
@@ -137,9 +313,28 @@ class Part(item.Item):
             return hdr.value
         raise equotient.NoSuchHeader(name)
 
+    def _getHeaderList(self):
+        """
+        Return all of my headers as a list of L{mimepart.Header} instances,
+        decoding L{headerData} the first time it is needed, or None if my
+        headers are stored only as L{Header} items.
+        """
+        if self.store is None:
+            if not hasattr(self, '_headers'):
+                self._headers = []
+            return self._headers
+        try:
+            return self._headerCache
+        except AttributeError:
+            if self.headerData is None:
+                return None
+            self._headerCache = _decodeHeaders(self.headerData)
+            return self._headerCache
+
     def getHeaders(self, name, _limit=None):
         name = name.lower()
-        if self.store is not None:
+        headers = self._getHeaderList()
+        if headers is None:
             if not isinstance(name, unicode):
                 name = name.decode("ascii")
             return self.store.query(
@@ -148,22 +343,17 @@ class Part(item.Item):
                                Header.name == name),
                 sort=Header.index.ascending,
                 limit=_limit)
-        else:
-            if not hasattr(self, '_headers'):
-                self._headers = []
-            return (hdr for hdr in self._headers if hdr.name == name)
+        return itertools.islice(
+            (hdr for hdr in headers if hdr.name == name), _limit)
 
     def getAllHeaders(self):
-        if self.store is not None:
+        headers = self._getHeaderList()
+        if headers is None:
             return self.store.query(
                 Header,
                 Header.part == self,
                 sort=Header.index.ascending)
-        else:
-            if hasattr(self, '_headers'):
-                return iter(self._headers)
-            else:
-                return iter(())
+        return iter(headers)
 
     def newChild(self):
         if self.store is not None:
@@ -181,13 +371,14 @@ class Part(item.Item):
     def _addToStore(self, store, message, sourcepath):
         self.source = sourcepath
         self.message = message
+        self.headerData = _encodeHeaders(self._getHeaderList())
         self.store = store
 
-        if hasattr(self, '_headers'):
-            for hdr in self._headers:
-                hdr.part = self
-                hdr.message = self.message
-                hdr.store = store
+        for index, hdr in enumerate(self._headers):
+            if hdr.name in self.indexedHeaders:
+                Header(store=store, part=self, message=message,
+                       name=hdr.name, value=hdr.value, index=index)
+        self._headerCache = self._headers
 
         if hasattr(self, '_children'):
             for child in self._children:
@@ -254,25 +445,48 @@ class Part(item.Item):
         return default
 
     def getBody(self, decode=False):
-        f = self.source.open()
-        offt = self.bodyOffset
-        leng = self.bodyLength
-        f.seek(offt)
-        data = f.read(leng)
+        return ''.join(self.iterBody(decode))
+
+    def iterBody(self, decode=False, chunkSize=2 ** 16):
+        """
+        Return my body a piece at a time, so that no more than about
+        C{chunkSize} bytes of it need be in memory at once, however large it
+        is.
+
+        @param decode: if true, undo my content-transfer-encoding.
+
+        @param chunkSize: the number of bytes of my source file to read at a
+        time.
+
+        @return: an iterator of C{str}.
+        """
+        chunks = self._iterSourceBody(chunkSize)
         if decode:
             ct = self.getContentTransferEncoding()
             if ct == 'quoted-printable':
-                return quopri.decodestring(data)
+                return _decodeQuotedPrintable(chunks)
             elif ct == 'base64':
-                for extraPadding in ('', '=', '=='):
-                    try:
-                        return (data + extraPadding).decode('base64')
-                    except binascii.Error:
-                        pass
-                return data
-            elif ct == '7bit':
-                return data
-        return data
+                return _decodeBase64(chunks)
+        return chunks
+
+    def _iterSourceBody(self, chunkSize):
+        """
+        Generate the undecoded bytes of my body, sliced from a memory map of
+        my source file.
+        """
+        if not self.bodyLength:
+            return
+        f = self.source.open()
+        try:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            end = self.bodyOffset + self.bodyLength
+            for offset in xrange(self.bodyOffset, end, chunkSize):
+                yield source[offset:min(offset + chunkSize, end)]
+        finally:
+            source.close()
 
     def getUnicodeBody(self, default='utf-8'):
         """Get the payload of this part as a unicode object."""
@@ -586,6 +800,45 @@ class Part(item.Item):
                 yield (sibling.getContentType(), sibling)
 
 
+
+item.declareLegacyItem(Part.typeName, 1, dict(
+    parent=attributes.reference(),
+    message=attributes.reference(),
+    partID=attributes.integer(),
+    source=attributes.path(),
+    headersOffset=attributes.integer(),
+    headersLength=attributes.integer(),
+    bodyOffset=attributes.integer(),
+    bodyLength=attributes.integer()))
+
+def part1to2(old):
+    """
+    Copy the attributes of version 1 L{Part}s, and move their headers from
+    L{Header} items into L{Part.headerData}, keeping the items only for
+    L{Part.indexedHeaders}.
+    """
+    new = old.upgradeVersion(
+        Part.typeName, 1, 2,
+        parent=old.parent,
+        message=old.message,
+        partID=old.partID,
+        source=old.source,
+        headersOffset=old.headersOffset,
+        headersLength=old.headersLength,
+        bodyOffset=old.bodyOffset,
+        bodyLength=old.bodyLength)
+    headers = list(new.store.query(
+        Header, Header.part == new, sort=Header.index.ascending))
+    new.headerData = _encodeHeaders(headers)
+    for hdr in headers:
+        if hdr.name not in Part.indexedHeaders:
+            hdr.deleteFromStore()
+    return new
+
+registerUpgrader(part1to2, Part.typeName, 1, 2)
+
+
+
 class _MIMEMessageStorerBase(mimepart.MIMEMessageReceiver):
     """
     Base class for different kinds of persistent MIME parser classes.
@@ -436,6 +436,11 @@ class FromAddressConfigFragment(LiveElement):
     fragmentName = 'from-address-config'
     title = 'From Addresses'
 
+    # The FromAddressScrollTable rendered by this fragment, which is told
+    # about addresses added with addAddress, or None if it has not been
+    # rendered.
+    _scrollTable = None
+
     def __init__(self, composePrefs):
         self.composePrefs = composePrefs
         LiveElement.__init__(self)
@@ -455,6 +460,14 @@ class FromAddressConfigFragment(LiveElement):
         if default:
             addr.setAsDefault()
 
+        if self._scrollTable is not None:
+            if default:
+                # Another address stopped being the default, which may move
+                # it too.
+                self._scrollTable.invalidate()
+            else:
+                self._scrollTable.itemAdded(addr)
+
 
     def addAddressForm(self, req, tag):
         """
@@ -512,6 +525,7 @@ class FromAddressConfigFragment(LiveElement):
         f = FromAddressScrollTable(self.composePrefs.store)
         f.docFactory = getLoader(f.fragmentName)
         f.setFragmentParent(self)
+        self._scrollTable = f
         return f
     renderer(fromAddressScrollTable)
 
@@ -543,9 +557,15 @@ class FromAddressScrollTable(ScrollingFragment):
     """
     L{xmantissa.scrolltable.ScrollingFragment} subclass for browsing
     and editing L{FromAddress} items.
+
+    The row count and anchors are cached between requests.  Changes made by
+    actions and by L{FromAddressConfigFragment.addAddress} are reported to
+    the cache; others are noticed within C{cacheLifetime} seconds.
     """
     jsClass = u'Quotient.Compose.FromAddressScrollTable'
 
+    cacheLifetime = 60
+
 
     def __init__(self, store):
         ScrollingFragment.__init__(
@@ -0,0 +1,44 @@
+from axiom.dependency import installOn
+from axiom.scheduler import SubScheduler
+from axiom.test.historic.stubloader import saveStub
+
+from xquotient.mimestorage import IncomingMIMEMessageStorer
+
+msg = """\
+Received: from a.example.com by b.example.com; Thu, 21 Jun 2007 09:28:19 -0400
+Received: from c.example.com by a.example.com; Thu, 21 Jun 2007 09:28:17 -0400
+Message-ID: <part1to2@example.com>
+In-Reply-To: <parent@example.com>
+References: <grandparent@example.com> <parent@example.com>
+List-Id: Example list <list.example.com>
+Date: Thu, 21 Jun 2007 09:27:57 -0400
+From: Bob <bob@example.org>
+To: Alice <alice@example.com>
+Subject: =?utf-8?q?caf=C3=A9?=
+X-Colons: one: two: three
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain; charset=us-ascii
+Content-Transfer-Encoding: 7bit
+
+la ti da
+--BOUNDARY
+Content-Type: text/plain; charset=us-ascii
+Content-Disposition: inline
+
+tirra lirra
+--BOUNDARY--
+"""
+
+def createDatabase(s):
+    installOn(SubScheduler(store=s), s)
+    mms = IncomingMIMEMessageStorer(
+        s, s.newFile("mail", "1.eml"),
+        u'migration://migration')
+    for line in msg.splitlines():
+        mms.lineReceived(line)
+    mms.messageDone()
+
+if __name__ == '__main__':
+    saveStub(createDatabase, 'b32e7c8')
@@ -0,0 +1,72 @@
+"""
+Tests for the upgrade of L{Part} from version 1 to version 2, which moves
+each part's headers into L{Part.headerData}.
+"""
+
+from axiom.test.historic.stubloader import StubbedTest
+
+from xquotient.exmess import Message
+from xquotient.mimestorage import Part, Header
+
+
+class PartUpgradeTest(StubbedTest):
+    def _parts(self):
+        return list(self.store.query(Part, sort=Part.storeID.ascending))
+
+
+    def test_headerData(self):
+        """
+        L{Part.headerData} holds every header of each part, in its original
+        order.
+        """
+        root, first, second = self._parts()
+        self.assertIdentical(self.store.findUnique(Message).impl, root)
+        for part in root, first, second:
+            self.assertNotIdentical(part.headerData, None)
+        headers = [(hdr.name, hdr.value) for hdr in root.getAllHeaders()]
+        self.assertEqual(headers[:-1], [
+                (u'received', u'from a.example.com by b.example.com; '
+                 u'Thu, 21 Jun 2007 09:28:19 -0400'),
+                (u'received', u'from c.example.com by a.example.com; '
+                 u'Thu, 21 Jun 2007 09:28:17 -0400'),
+                (u'message-id', u'<part1to2@example.com>'),
+                (u'in-reply-to', u'<parent@example.com>'),
+                (u'references', u'<grandparent@example.com>'),
+                (u'references', u'<parent@example.com>'),
+                (u'list-id', u'Example list <list.example.com>'),
+                (u'date', u'Thu, 21 Jun 2007 09:27:57 -0400'),
+                (u'from', u'Bob <bob@example.org>'),
+                (u'to', u'Alice <alice@example.com>'),
+                (u'subject', u'caf\N{LATIN SMALL LETTER E WITH ACUTE}'),
+                (u'x-colons', u'one: two: three'),
+                (u'content-type', u'multipart/mixed; boundary="BOUNDARY"')])
+        self.assertEqual(headers[-1][0], u'x-divmod-processed')
+        self.assertEqual(
+            [(hdr.name, hdr.value) for hdr in first.getAllHeaders()],
+            [(u'content-type', u'text/plain; charset=us-ascii'),
+             (u'content-transfer-encoding', u'7bit')])
+        self.assertEqual(
+            [(hdr.name, hdr.value) for hdr in second.getAllHeaders()],
+            [(u'content-type', u'text/plain; charset=us-ascii'),
+             (u'content-disposition', u'inline')])
+
+
+    def test_indexedHeaderItems(self):
+        """
+        Only the headers named in L{Part.indexedHeaders} keep L{Header} items,
+        which still refer to their place among the part's headers.
+        """
+        root = self._parts()[0]
+        headers = list(root.getAllHeaders())
+        items = list(self.store.query(Header, sort=Header.index.ascending))
+        self.assertEqual(
+            [(hdr.name, hdr.value, hdr.index) for hdr in items],
+            [(u'message-id', u'<part1to2@example.com>', 2),
+             (u'in-reply-to', u'<parent@example.com>', 3),
+             (u'references', u'<grandparent@example.com>', 4),
+             (u'references', u'<parent@example.com>', 5),
+             (u'list-id', u'Example list <list.example.com>', 6)])
+        for hdr in items:
+            self.assertIdentical(hdr.part, root)
+            self.assertIn(hdr.name, Part.indexedHeaders)
+            self.assertEqual(headers[hdr.index].value, hdr.value)
@@ -266,6 +266,9 @@ class MockPart:
     def getBody(self, decode):
         return self.body
 
+    def iterBody(self, decode):
+        return iter([self.body])
+
 
 
 class PartItem(Item):
@@ -292,6 +295,10 @@ class PartItem(Item):
     def getBody(self, decode=True):
         return self.getUnicodeBody().encode('ascii')
 
+    def iterBody(self, decode=True):
+        body = self.getBody(decode)
+        return (body[i:i + 2] for i in xrange(0, len(body), 2))
+
     def walkMessage(self, preferred):
         self.preferred = preferred
 
@@ -477,6 +484,35 @@ class WebTestCase(TestCase, MIMEReceiverMixin):
         return D
 
 
+    def test_partDisplayerStreamsAttachments(self):
+        """
+        L{PartDisplayer} writes the body of a part which is not text to the
+        request a chunk at a time, as L{Part.iterBody} produces it.
+        """
+        s = Store()
+        installOn(PrivateApplication(store=s), s)
+        part = PartItem(
+            store=s, contentType=u'application/octet-stream', body=u'abcde')
+        partDisplayer = PartDisplayer(None)
+        partDisplayer.item = part
+
+        req = makeRequest()
+        writes = []
+        write = req.write
+        def recordingWrite(bytes):
+            writes.append(bytes)
+            write(bytes)
+        req.write = recordingWrite
+        D = deferredRender(partDisplayer, req)
+        def checkBody(renderedBody):
+            self.assertEqual(renderedBody, 'abcde')
+            self.assertEqual(filter(None, writes), ['ab', 'cd', 'e'])
+            self.assertEqual(req.headers.get('content-type'),
+                             'application/octet-stream')
+        D.addCallback(checkBody)
+        return D
+
+
     def _testPartDisplayerScrubbing(self, input, scrub=True):
         """
         Set up a store, a PartItem with a body of C{input},
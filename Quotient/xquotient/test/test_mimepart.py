@@ -12,9 +12,12 @@ from twisted.python import filepath
 
 from epsilon import extime
 from axiom.store import Store, AtomicFile
+from axiom.errors import ItemNotFound
 
 from xquotient import mimepart, smtpout
-from xquotient.mimestorage import Part, ExistingMessageMIMEStorer
+from xquotient.mimestorage import (
+    Part, Header, ExistingMessageMIMEStorer, _encodeHeaders, _decodeHeaders,
+    _decodeBase64, _decodeQuotedPrintable)
 from xquotient.test import test_grabber
 from xquotient.test.util import MIMEReceiverMixin, PartMaker
 from xquotient.exmess import (
@@ -1188,6 +1191,199 @@ Hi
 
 
 
+class HeaderStorageTests(unittest.TestCase, PersistenceMixin):
+    """
+    Tests for the storage of L{Part} headers in L{Part.headerData}.
+    """
+    def test_encodeHeaders(self):
+        """
+        L{_decodeHeaders} returns headers equal to those given to
+        L{_encodeHeaders}, in the same order, whatever characters they
+        contain.
+        """
+        headers = [
+            mimepart.Header(u'subject', u'colons: and\r\n newlines'),
+            mimepart.Header(u'x-empty', u''),
+            mimepart.Header(u'from', u'T\N{LATIN SMALL LETTER E WITH ACUTE}st'),
+            mimepart.Header(u'subject', u'12:34')]
+        self.assertEquals(
+            [(hdr.name, hdr.value)
+             for hdr in _decodeHeaders(_encodeHeaders(headers))],
+            [(hdr.name, hdr.value) for hdr in headers])
+
+
+    def test_indexedHeaders(self):
+        """
+        L{Header} items are created only for the headers named in
+        L{Part.indexedHeaders}, with their position among all of the part's
+        headers.
+        """
+        part = self.setUpMailStuff().feedStringNow(
+            MessageTestMixin.trivialMessage)
+        self.assertEquals(
+            [(hdr.name, hdr.value, hdr.index)
+             for hdr in self.substore.query(
+                    Header, Header.part == part,
+                    sort=Header.index.ascending)],
+            [(u'references', u'<one@domain>', 5),
+             (u'references', u'<two@domain>', 6),
+             (u'references', u'<three@domain>', 7)])
+
+
+    def test_headersWithoutQueries(self):
+        """
+        The headers of a stored L{Part} are decoded from L{Part.headerData}
+        without querying the store.
+        """
+        part = self.setUpMailStuff().feedStringNow(
+            MessageTestMixin.trivialMessage)
+        del part._headerCache
+        def query(*a, **kw):
+            self.fail("Headers should not be queried for.")
+        self.substore.query = query
+        self.assertEquals(part.getHeader(u'subject'),
+                          u'a test message, comma separated')
+        self.assertEquals(
+            [hdr.value for hdr in part.getHeaders(u'references', _limit=2)],
+            [u'<one@domain>', u'<two@domain>'])
+        self.assertEquals(len(list(part.getAllHeaders())), 9)
+
+
+    def test_headerItems(self):
+        """
+        The headers of a L{Part} without L{Part.headerData} are found by
+        querying for its L{Header} items.
+        """
+        store = Store()
+        part = Part(store=store)
+        for index, (name, value) in enumerate([(u'to', u'bob@example.com'),
+                                               (u'subject', u'first'),
+                                               (u'subject', u'second')]):
+            Header(store=store, part=part, name=name, value=value, index=index)
+        self.assertEquals(part.getHeader(u'subject'), u'first')
+        self.assertEquals(
+            [(hdr.name, hdr.value) for hdr in part.getAllHeaders()],
+            [(u'to', u'bob@example.com'),
+             (u'subject', u'first'),
+             (u'subject', u'second')])
+
+
+
+class PartTreeTests(unittest.TestCase, PersistenceMixin):
+    """
+    Tests for L{Part.loadTree} and the walking of stored parts.
+    """
+    def setUp(self):
+        """
+        Deliver a message with a nested part structure, forget any part tree
+        loaded during delivery, and start counting queries.
+        """
+        self.part = self.setUpMailStuff().feedStringNow(
+            multipartMessageWithEmbeddedMultipartMessage)
+        for part in self.substore.query(Part):
+            if hasattr(part, '_childParts'):
+                del part._childParts
+        self.queries = []
+        query = self.substore.query
+        def countingQuery(*a, **kw):
+            self.queries.append(a)
+            return query(*a, **kw)
+        self.substore.query = countingQuery
+
+
+    def test_walk(self):
+        """
+        Walking a stored message loads all of its parts with one query,
+        after which walking any of them needs no more.
+        """
+        parts = list(self.part.walk())
+        self.assertEquals([part.partID for part in parts], range(6))
+        self.assertEquals(len(self.queries), 1)
+        self.assertEquals([part.partID for part in parts[2].walk()],
+                          [2, 3, 4, 5])
+        self.assertEquals([part.partID for part in parts[2].walk(True)], [3])
+        self.assertEquals(len(self.queries), 1)
+
+
+    def test_getSubPart(self):
+        """
+        L{Part.getSubPart} finds the immediate children of a part in the tree
+        loaded by L{Part.loadTree}.
+        """
+        self.assertIdentical(self.part.loadTree(), self.part)
+        self.assertEquals(self.part.getSubPart(2).getContentType(),
+                          'message/rfc822')
+        self.assertEquals(len(self.queries), 1)
+        self.assertRaises(ItemNotFound, self.part.getSubPart, 3)
+
+
+
+def chunk(data, size):
+    """
+    Split C{data} into a list of strings of C{size} bytes.
+    """
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+
+class BodyTests(unittest.TestCase, PersistenceMixin):
+    """
+    Tests for L{Part.iterBody} and the decoders it uses.
+    """
+    bytes = ''.join(map(chr, range(256))) * 4
+
+    def test_decodeBase64(self):
+        """
+        L{_decodeBase64} decodes base64 split into chunks anywhere.
+        """
+        encoded = self.bytes.encode('base64').replace('\n', '\r\n')
+        for size in 1, 3, 4, 7, len(encoded):
+            self.assertEquals(''.join(_decodeBase64(chunk(encoded, size))),
+                              self.bytes)
+
+
+    def test_decodeBase64Padding(self):
+        """
+        L{_decodeBase64} supplies missing padding, ignores padding which
+        comes too early in a group of four characters, and stops at padding
+        which ends the encoded data.
+        """
+        self.assertEquals(''.join(_decodeBase64(['QUJD', 'RA'])), 'ABCD')
+        self.assertEquals(''.join(_decodeBase64(['Q=UJ', 'DRA'])), 'ABCD')
+        self.assertEquals(''.join(_decodeBase64(['QUJDRA=', '=QUJD'])), 'ABCD')
+
+
+    def test_decodeQuotedPrintable(self):
+        """
+        L{_decodeQuotedPrintable} decodes quoted-printable split into chunks
+        anywhere.
+        """
+        encoded = 'caf=C3=A9 =\r\nau lait=3D=\nnoir\r\n'
+        for size in 1, 2, 3, 11, len(encoded):
+            self.assertEquals(
+                ''.join(_decodeQuotedPrintable(chunk(encoded, size))),
+                'caf\xc3\xa9 au lait=noir\r\n')
+
+
+    def test_iterBody(self):
+        """
+        L{Part.iterBody} decodes the body of a stored part in pieces no
+        larger than the chunk size it is given.
+        """
+        part = self.setUpMailStuff().feedStringNow(msg("""\
+From: alice@example.com
+Content-Type: application/octet-stream
+Content-Transfer-Encoding: base64
+""") + '\r\n\r\n' + self.bytes.encode('base64').replace('\n', '\r\n'))
+        chunks = list(part.iterBody(decode=True, chunkSize=100))
+        self.assertEquals(''.join(chunks), self.bytes)
+        self.assertEquals(part.getBody(decode=True), self.bytes)
+        self.assertTrue(max(map(len, chunks)) <= 100)
+        self.assertEquals(''.join(part.iterBody(chunkSize=100)),
+                          part.getBody())
+
+
+
 class ExistingMessageStorerTests(unittest.TestCase):
     """
     Verify that L{ExistingMessageMIMEStorer} correctly associates the
@@ -1249,3 +1445,88 @@ class FeedTests(unittest.TestCase):
             self.assertTrue(receiver.done)
         d.addCallback(cbFed)
         return d
+
+
+    def _receiver(self):
+        temp = filepath.FilePath(self.mktemp())
+        temp.makedirs()
+        return mimepart.MIMEMessageReceiver(AtomicFile(
+            temp.child("tmp.eml").path, temp.child("message.eml")))
+
+
+    def _structure(self, receiver, part):
+        """
+        Return the offsets and headers of each part under C{part}, and what
+        C{receiver} wrote to its file.
+        """
+        parts = [(p.headersOffset, p.headersLength,
+                  p.bodyOffset, p.bodyLength,
+                  [(h.name, h.value) for h in p.headers
+                   if h.name != u'x-divmod-processed'])
+                 for p in part.walk()]
+        return parts, receiver.file.finalpath.getContent()
+
+
+    def assertFedLikeLines(self, source):
+        """
+        Assert that feeding C{source} to L{MIMEMessageReceiver.feedStringNow}
+        with various block sizes results in the same parts and file as
+        passing each of its lines to L{MIMEMessageReceiver.lineReceived}.
+        """
+        receiver = self._receiver()
+        for line in StringIO(source):
+            receiver.lineReceived(line.strip('\r\n'))
+        receiver.messageDone()
+        expected = self._structure(receiver, receiver.part)
+        for blockSize in [1, 5, 64, mimepart.MIMEMessageReceiver.blockSize]:
+            receiver = self._receiver()
+            receiver.blockSize = blockSize
+            part = receiver.feedStringNow(source)
+            self.assertEqual(self._structure(receiver, part), expected)
+
+
+    def test_feedMultipart(self):
+        """
+        Feeding a multipart message a block at a time finds the same parts,
+        at the same offsets, as feeding it a line at a time.
+        """
+        self.assertFedLikeLines(
+            "Content-Type: multipart/mixed; boundary=XX\r\n"
+            "\r\n"
+            "preamble\r\n"
+            "--XX\r\n"
+            "Content-Type: text/plain\r\n"
+            "\r\n"
+            "line one\r\n"
+            "\r\n"
+            "--not a boundary\r\n"
+            "\r--XX\r\n"
+            "Content-Type: message/rfc822\r\n"
+            "\r\n"
+            "Subject: inner\r\n"
+            "Content-Type: multipart/alternative; boundary=YY\r\n"
+            "\r\n"
+            "--YY\r\n"
+            "\r\n"
+            "stray\rcarriage return\r\n"
+            "--YY--\r\n"
+            "--XX\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            "\r\n" +
+            "QUJDRA==\r\n" * 100 +
+            "--XX--\r\n"
+            "epilogue\n"
+            "no newline")
+
+
+    def test_feedTruncated(self):
+        """
+        Feeding a message which ends in the middle of a part a block at a time
+        leaves the same lengths as feeding it a line at a time.
+        """
+        self.assertFedLikeLines(
+            "Content-Type: multipart/mixed; boundary=XX\n"
+            "\n"
+            "--XX\n"
+            "\n" +
+            "body\n" * 100)
@@ -3,10 +3,12 @@ from twisted.internet.defer import succeed
 from twisted.mail import smtp
 from twisted.python.failure import Failure
 from twisted.trial import unittest
+from twisted.internet.task import Clock
 
 from axiom.iaxiom import IScheduler
 from axiom import attributes, item, store, userbase
 from axiom.dependency import installOn
+from axiom.test.util import QueryCounter
 
 from xquotient import exmess, smtpout, compose
 from xquotient.test.util import DummyMessageImplementation
@@ -237,6 +239,56 @@ class FromAddressConfigFragmentTest(unittest.TestCase):
         self.assertEquals(smtpout.FromAddress.findDefault(self.store), item)
 
 
+    def _addAddress(self, address, default=False):
+        self.frag.addAddress(address=address, smtpHost=u'bar',
+                             smtpUsername=u'foo', smtpPort=25,
+                             smtpPassword=u'secret', default=default)
+
+
+    def _addresses(self, table, rangeBegin, rangeEnd):
+        return [item._address
+                for item in table.performQuery(rangeBegin, rangeEnd)]
+
+
+    def test_addAddressUpdatesScrollTable(self):
+        """
+        L{smtpout.FromAddressConfigFragment.addAddress} reports the new
+        address to the scrolltable it rendered, whose row count and anchors
+        are kept between requests.
+        """
+        for address in [u'b@host', u'd@host', u'f@host']:
+            self._addAddress(address)
+        table = self.frag.fromAddressScrollTable(None, None)
+        table.clock = Clock()
+        expected = sorted([addr._address for addr in
+                           self.store.query(smtpout.FromAddress)])
+        self.assertEquals(table.requestCurrentSize(), len(expected))
+        self.assertEquals(self._addresses(table, 0, 2), expected[:2])
+        self.assertEquals(self._addresses(table, 2, 4), expected[2:4])
+
+        table.clock.advance(30)
+        self._addAddress(u'c@host')
+        expected = sorted(expected + [u'c@host'])
+        counter = QueryCounter(self.store)
+        self.assertEquals(counter.measure(table.performCount), 0)
+        self.assertEquals(table.performCount(), len(expected))
+        self.assertEquals(self._addresses(table, 2, 4), expected[2:4])
+        self.assertNotEquals(table._anchors, {})
+
+
+    def test_addDefaultAddressInvalidatesScrollTable(self):
+        """
+        Adding a default address discards the cache of the scrolltable, since
+        the old default address changes too.
+        """
+        table = self.frag.fromAddressScrollTable(None, None)
+        table.clock = Clock()
+        count = table.requestCurrentSize()
+        self._addAddress(u'a@host', default=True)
+        self.assertIdentical(table._cachedCount, None)
+        self.assertEquals(table.performCount(), count + 1)
+
+
 
 class FromAddressExtractionTest(unittest.TestCase):
     """
@@ -15,7 +15,7 @@ from epsilon.extime import Time
 
 from axiom.store import Store
 from axiom.item import Item, transacted
-from axiom.attributes import integer, inmemory, text
+from axiom.attributes import integer, inmemory, text, AND
 from axiom.iaxiom import IScheduler
 from axiom.dependency import installOn
 from axiom.test.util import QueryCounter
@@ -33,7 +33,9 @@ from xquotient.exmess import (
 
 from xquotient.exmess import SENDER_RELATION, RECIPIENT_RELATION
 
-from xquotient.exmess import _MessageStatus
+from xquotient import exmess
+from xquotient.exmess import _MessageStatus, _MailboxCount
+from xquotient.exmess import rebuildMailboxCounts, checkMailboxCounts
 
 from xquotient.mimestorage import Part, Header
 from xquotient.mimepart import AttachmentPart
@@ -787,6 +789,155 @@ class MailboxSelectorComplexity(_WorkflowMixin, TestCase):
         #### self.assertEquals(beforeL, afterL)
 
 
+
+class MailboxCountTests(_WorkflowMixin, TestCase):
+    """
+    Tests for the stored message counts used by L{MailboxSelector.count}.
+    """
+
+    def setUp(self):
+        """
+        Create some messages with different statuses, tags and sources.
+        """
+        _WorkflowMixin.setUp(self)
+        self.catalog = Catalog(store=self.store)
+        self.first = Message.createIncoming(
+            self.store, DummyMessageImplementation(store=self.store), u'a')
+        self.first.classifyClean()
+        self.first.addTag(self.catalog, u'work')
+        self.second = Message.createIncoming(
+            self.store, DummyMessageImplementation(store=self.store), u'b')
+        self.second.classifyClean()
+        self.second.markRead()
+
+
+    def count(self, *statuses, **kw):
+        """
+        Return the number of messages with all of C{statuses}, and the tag
+        and source given by the C{tag} and C{source} keyword arguments.
+        """
+        sq = MailboxSelector(self.store)
+        sq.setLimit(None)
+        for statusName in statuses:
+            sq.refineByStatus(statusName)
+        if kw.get('tag') is not None:
+            sq.refineByTag(kw['tag'])
+        if kw.get('source') is not None:
+            sq.refineBySource(kw['source'])
+        return sq.count()
+
+
+    def test_notKept(self):
+        """
+        Counts are not stored until L{rebuildMailboxCounts} has been run.
+        """
+        self.first.markRead()
+        self.assertEquals(self.store.query(_MailboxCount).count(), 0)
+        self.assertEquals(self.count(INBOX_STATUS), 2)
+
+
+    def test_rebuild(self):
+        """
+        L{rebuildMailboxCounts} stores counts which agree with the messages.
+        """
+        rebuildMailboxCounts(self.store)
+        self.assertEquals(checkMailboxCounts(self.store), [])
+        self.assertEquals(self.count(INBOX_STATUS), 2)
+        self.assertEquals(self.count(INBOX_STATUS, UNREAD_STATUS), 1)
+        self.assertEquals(self.count(INBOX_STATUS, tag=u'work'), 1)
+        self.assertEquals(self.count(INBOX_STATUS, source=u'b'), 1)
+        self.assertEquals(
+            self.count(INBOX_STATUS, UNREAD_STATUS, source=u'b'), 0)
+
+
+    def test_check(self):
+        """
+        L{checkMailboxCounts} reports stored counts which are wrong.
+        """
+        rebuildMailboxCounts(self.store)
+        count = self.store.findUnique(
+            _MailboxCount,
+            AND(_MailboxCount.statusName == INBOX_STATUS,
+                _MailboxCount.tag == None,
+                _MailboxCount.source == None))
+        count.messages = 5
+        self.assertEquals(self.count(INBOX_STATUS), 5)
+        self.assertEquals(
+            checkMailboxCounts(self.store),
+            [((INBOX_STATUS, None, None), (5, 1), (2, 1))])
+        rebuildMailboxCounts(self.store)
+        self.assertEquals(checkMailboxCounts(self.store), [])
+
+
+    def test_changes(self):
+        """
+        Stored counts are kept up to date as messages change.
+        """
+        rebuildMailboxCounts(self.store)
+        self.second.markUnread()
+        self.assertEquals(self.count(INBOX_STATUS, UNREAD_STATUS), 2)
+        self.first.archive()
+        self.assertEquals(self.count(INBOX_STATUS), 1)
+        self.assertEquals(self.count(ARCHIVE_STATUS, tag=u'work'), 1)
+        self.second.addTag(self.catalog, u'work')
+        self.assertEquals(self.count(INBOX_STATUS, tag=u'work'), 1)
+        self.first.removeTag(u'work')
+        self.assertEquals(self.count(ARCHIVE_STATUS, tag=u'work'), 0)
+        self.second.trainSpam()
+        self.assertEquals(self.count(INBOX_STATUS), 0)
+        self.assertEquals(self.count(SPAM_STATUS, source=u'b'), 1)
+        self.second.trainClean()
+        self.assertEquals(self.count(INBOX_STATUS, UNREAD_STATUS), 1)
+        self.first.deleteFromStore()
+        self.assertEquals(self.count(ARCHIVE_STATUS), 0)
+        self.assertEquals(checkMailboxCounts(self.store), [])
+
+
+    def test_failedAdjustment(self):
+        """
+        A change whose counts cannot be adjusted is rolled back along with
+        the adjustment, leaving the stored counts in agreement with the
+        messages.
+        """
+        rebuildMailboxCounts(self.store)
+        def failing(store, before, after):
+            raise ZeroDivisionError()
+        self.patch(exmess, '_adjustMailboxCounts', failing)
+        self.assertRaises(ZeroDivisionError, self.first.archive)
+        self.assertRaises(ZeroDivisionError, self.second.deleteFromStore)
+        self.assertEquals(
+            list(self.store.query(Message, sort=Message.storeID.ascending)),
+            [self.first, self.second])
+        self.assertEquals(self.count(INBOX_STATUS), 2)
+        self.assertEquals(checkMailboxCounts(self.store), [])
+
+
+    def test_limit(self):
+        """
+        A stored count is no greater than the limit of the selector.
+        """
+        rebuildMailboxCounts(self.store)
+        sq = MailboxSelector(self.store)
+        sq.refineByStatus(INBOX_STATUS)
+        sq.setLimit(1)
+        self.assertEquals(sq.count(), 1)
+
+
+    def test_countComplexity(self):
+        """
+        Counting with stored counts does the same amount of work regardless
+        of the number of messages counted.
+        """
+        rebuildMailboxCounts(self.store)
+        qc = QueryCounter(self.store)
+        before = qc.measure(self.count, INBOX_STATUS, UNREAD_STATUS)
+        for x in range(10):
+            self.createIncomingMessage().classifyClean()
+        after = qc.measure(self.count, INBOX_STATUS, UNREAD_STATUS)
+        self.assertEquals(before, after)
+        self.assertEquals(self.count(INBOX_STATUS, UNREAD_STATUS), 11)
+
+
 class DraftStatusChangeMethodTests(_WorkflowMixin, TestCase):
     """
     Test cases for various state changes that draft messages can go through.